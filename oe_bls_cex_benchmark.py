@@ -0,0 +1,276 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the PUMD processing functions.  Each benchmark builds its own
+PUMD-shaped input so it can be run offline, and reports throughput as rows/sec.
+
+    oe_bls_cex_benchmark_flags    - times oe_bls_cex_pumd_process_flags on FMLI and FMLD shaped frames
+    oe_bls_cex_benchmark_tables   - times the MSA and national report parsing over years and regions
+    oe_bls_cex_benchmark_pipeline - times and memory profiles open_files, interpret_meta, interpret_data
+                                    and process_flags on synthetic PUMD years of increasing size
+
+The pipeline benchmark writes its inputs with oe_bls_cex_synthetic_pumd, one
+folder per scale, and reuses them on later runs.
+
+"""
+
+import os
+import time
+import tempfile
+from functools import reduce
+import pandas as pd
+import numpy as np
+from oe_bls_cex_pumd import (oe_bls_cex_pumd_process_flags, oe_bls_cex_pumd_open_files,
+                             oe_bls_cex_pumd_interpret_meta, oe_bls_cex_pumd_interpret_data)
+from oe_bls_cex_metrics import PipelineMetrics
+from oe_bls_cex_synthetic import oe_bls_cex_synthetic_pumd
+from oe_bls_cex_tables import oe_bls_cex_tables_columns
+from oe_bls_cex_msa import oe_bls_cex_msa_parse
+from oe_bls_cex_totals import oe_bls_cex_totals_parse
+
+
+def oe_bls_cex_benchmark_family(rows, nflagged, filename, seed=0):
+    """
+    Builds an FMLI/FMLD shaped dataframe of string columns with nflagged
+    variable/flag column pairs, and the matching Variable Dictionary rows.
+
+    :return df, vd
+    """
+    rng = np.random.default_rng(seed)
+    data = {"NEWID": np.char.zfill(np.arange(rows).astype(str), 8)}
+    vdrows = []
+    for i in range(nflagged):
+        var = "VAR" + str(i).zfill(3) + "X"
+        flag = var[:-1] + "_"
+        data[var] = rng.integers(0, 100000, rows).astype(str)
+        data[flag] = rng.choice(["A", "B", "C", "D", "T"], rows)
+        vdrows.append({"File": filename, "Variable Name": var, "Flag name": flag})
+    return pd.DataFrame(data), pd.DataFrame(vdrows)
+
+
+def _legacy_process_flags(df, filename, vd):
+    # The row-wise implementation, kept as the reference for timing and output checks
+    flags = {}
+    flag_candidates = vd[["Variable Name","Flag name"]][~vd["Flag name"].isna()][vd["File"] == filename].drop_duplicates()
+    for i,r in flag_candidates.iterrows():
+        if (r["Variable Name"] in df.columns) & (r["Flag name"] in df.columns):
+            flags[r["Variable Name"]] = r["Flag name"]
+    for col in flags.keys():
+        df[col[:-1]] = df.apply(lambda row: np.nan if row[flags[col]] in ["A","B","C"] else row[col], axis=1)
+    df.drop([c for c in flags.values()], axis=1, inplace=True)
+    return df
+
+
+def oe_bls_cex_benchmark_flags(rows=20000, nflagged=40, legacy=True):
+    """
+    Times the flag processing for FMLI and FMLD shaped frames.
+
+    :param  rows:      the number of CU rows in each synthetic file
+    :param  nflagged:  the number of flagged variables
+    :param  legacy:    also time the row-wise implementation and check the outputs match
+
+    :return a dataframe with seconds and rows/sec by file and implementation
+    """
+    results = []
+    for filename in ("FMLI", "FMLD"):
+        df, vd = oe_bls_cex_benchmark_family(rows, nflagged, filename)
+        runs = [("vectorized", oe_bls_cex_pumd_process_flags)]
+        if legacy:
+            runs.append(("row-wise", _legacy_process_flags))
+        outputs = {}
+        for name, func in runs:
+            work = df.copy()
+            start = time.perf_counter()
+            func(work, filename, vd)
+            seconds = time.perf_counter() - start
+            outputs[name] = work
+            results.append({"file": filename, "implementation": name, "rows": rows,
+                            "seconds": seconds, "rows_per_sec": rows / seconds})
+        if legacy:
+            pd.testing.assert_frame_equal(outputs["vectorized"], outputs["row-wise"])
+    return pd.DataFrame(results)
+
+
+def oe_bls_cex_benchmark_sheets(regions, items=45, msas=6, seed=0):
+    """
+    Builds raw MSA region sheets and a national report sheet shaped like the BLS
+    spreadsheets, with footnote marks, currency formatting, wrapped headers and
+    title rows.
+
+    :return a list of region sheets, the national sheet
+    """
+    rng = np.random.default_rng(seed)
+
+    def value(n):
+        v = np.round(rng.uniform(10, 100000, n), 2)
+        return np.where(rng.random(n) < 0.5, ["$" + format(x, ",") for x in v],
+                        np.where(rng.random(n) < 0.1, ["b/ " + str(x) for x in v], v)).astype(object)
+
+    labels = np.array(["Item " + str(i) + (" a/ " if i % 7 == 0 else "") + (":" if i % 5 == 0 else "")
+                       for i in range(items)], dtype=object)
+    sheets = []
+    for r, region in enumerate(regions):
+        data = {"Item": labels, "All consumer units in\n" + region: value(items)}
+        for m in range(msas):
+            data["Metro " + str(r) + "-\n" + str(m)] = value(items)
+        df = pd.DataFrame(data)
+        df.iloc[::9, 1:] = np.nan      # title rows
+        sheets.append(df)
+
+    rows = [["Number of consumer units (in thousands)", value(1)[0]]]
+    for i in range(items * 8):
+        label = "Detail " + str(i % (items * 6)) + (" a/ " if i % 11 == 0 else "") + (" [D]" if i % 13 == 0 else "")
+        rows += [[label, np.nan], ["Mean", value(1)[0]], ["Standard error", value(1)[0]], ["Percent", value(1)[0]]]
+    national = pd.DataFrame(rows, columns=["Item", "All\nconsumer\nunits"], dtype=object)
+    return sheets, national
+
+
+def _legacy_msa_parse(sheets):
+    # The per column regex, reduce/merge implementation, kept as the reference
+    filelist = []
+    for df in sheets:
+        df = df[df.iloc[:, 1].notnull()]
+        df.columns = [c.replace('\n',' ').replace('- ','-') for c in df.columns]
+        for c in df.columns:
+            if c == "Item":
+                df[c] = df[c].replace({' a/ ': '', ':': ''}, regex=True)
+            else:
+                df[c] = df[c].replace({'\\$': '', ',': '','b/ ':''}, regex=True).astype(float)
+        filelist.append(df)
+    msa = reduce(lambda left,right: pd.merge(left,right,on=['Item'], how='outer'), filelist)
+    msa.drop([c for c in msa.columns if "All consumer units in" in c], axis=1, inplace=True)
+    return msa
+
+
+def _legacy_totals_parse(ustotal):
+    # The iterrows implementation, kept as the reference.  This is the original
+    # oe_bls_cex_totals after the download, with r[0] and r[1] written as
+    # r.iloc[0] and r.iloc[1] since pandas no longer falls back to positions,
+    # and '\$' as '\\$', the same string without the invalid escape.
+    ustotal.columns = [c.replace('\n',' ').replace('- ','-') for c in ustotal.columns]
+
+    replacedict = {'a/ ': '','b/ ':'', ':': '','n.a.':'',
+                    ' []':'',' [D]':'',' [I]':'',
+                   '\\$': '', ',': '','a/ ':'','b/ ':''}
+
+    for r in replacedict.keys():
+        ustotal["Item"] = ustotal["Item"].str.replace(r,replacedict[r],regex=False)
+
+    usdict = {}
+    for i,r in ustotal.iterrows():
+        # The total row labels its own value
+        # but all other Items have a label followed by 3 addl rows for "Mean","Variance","%"
+        # Look for any rows with Item "Mean" and generate a row with the prev Item label
+        if "Number of consumer units (in thousands)" in str(r.iloc[0]):
+            usdict["Number of consumer units (in thousands)"] = r.iloc[1]
+        if r.Item == "Mean":
+            usdict[lastitem]=r.iloc[1]
+        lastitem = r.Item
+
+    ussum = pd.DataFrame.from_dict({"Item":usdict.keys(),"Amount":usdict.values()})
+    ussum["Amount"] = ussum.Amount.fillna(np.nan).apply(lambda x: pd.to_numeric(x, errors='coerce'))
+
+    return ussum
+
+
+def oe_bls_cex_benchmark_tables(years=('2016','2017','2018','2019','2020'),
+                                regions=('midwest','northeast','west','south'), items=45, msas=6, legacy=True):
+    """
+    Times the parsing of the MSA region sheets and the national report of each
+    year.  Every year gets its own synthetic sheets.
+
+    :param  items:   the number of Items in each MSA sheet, the national sheet has 8 times as many
+    :param  msas:    the number of MSA columns in each region sheet
+    :param  legacy:  also time the row-wise implementations and check the outputs match
+
+    :return a dataframe with seconds and rows/sec by report and implementation, over all years
+    """
+    timings = {}
+    for y, year in enumerate(years):
+        sheets, national = oe_bls_cex_benchmark_sheets(list(regions), items, msas, seed=y)
+        runs = [("msa", "vectorized", oe_bls_cex_msa_parse, sheets),
+                ("totals", "vectorized", oe_bls_cex_totals_parse, national)]
+        if legacy:
+            runs += [("msa", "row-wise", _legacy_msa_parse, sheets),
+                     ("totals", "row-wise", _legacy_totals_parse, national)]
+        outputs = {}
+        for report, name, func, raw in runs:
+            if report == "msa":
+                work = [df.copy() for df in raw]
+                for df in work:
+                    df.columns = oe_bls_cex_tables_columns(df.columns) if name == "vectorized" else df.columns
+                rows = sum(len(df) for df in work)
+            else:
+                work = raw.copy()
+                work.columns = oe_bls_cex_tables_columns(work.columns) if name == "vectorized" else work.columns
+                rows = len(work)
+            start = time.perf_counter()
+            outputs[(report, name)] = func(work)
+            seconds = time.perf_counter() - start
+            total = timings.setdefault((report, name), [0, 0.0])
+            total[0] += rows
+            total[1] += seconds
+        if legacy:
+            pd.testing.assert_frame_equal(outputs[("msa", "vectorized")], outputs[("msa", "row-wise")])
+            # The row-wise parser makes amounts written as text ("$1,234.50" eg) NaN,
+            # where oe_bls_cex_totals_parse reads them, so only its numbers are compared
+            vectorized, rowwise = outputs[("totals", "vectorized")], outputs[("totals", "row-wise")]
+            pd.testing.assert_series_equal(vectorized["Item"], rowwise["Item"].astype(vectorized["Item"].dtype))
+            parsed = rowwise["Amount"].notna()
+            pd.testing.assert_series_equal(vectorized["Amount"][parsed], rowwise["Amount"][parsed])
+    return pd.DataFrame([{"report": report, "implementation": name, "years": len(years), "rows": rows,
+                          "seconds": seconds, "rows_per_sec": rows / seconds}
+                         for (report, name), (rows, seconds) in timings.items()])
+
+
+def oe_bls_cex_benchmark_pipeline(scales=(10000, 100000, 1000000), workdir=None, year='2018',
+                                  join='wide', trace_memory=True, report=None):
+    """
+    Times and memory profiles the PUMD pipeline on a synthetic year at each
+    scale: open_files reads the four file types, interpret_meta narrows the
+    dictionary and HG, and interpret_data builds the family, expend and costs,
+    with process_flags recorded inside it.
+
+    :param  scales:        the numbers of expenditure rows, 10,000 to 10,000,000
+    :param  workdir:       the folder holding a synthetic pumddir per scale, a temporary folder by default
+    :param  year:          the synthetic year
+    :param  join:          the join passed to oe_bls_cex_pumd_interpret_data
+    :param  trace_memory:  when True, peak_mb is the tracemalloc peak of each stage,
+                           otherwise it is empty.  maxrss_mb, the process' peak resident
+                           memory so far, is always given.
+    :param  report:        optionally, a .csv or .json path for the stage records of every scale
+
+    :return a dataframe with seconds, rows, rows/sec, peak_mb and maxrss_mb by scale and stage
+    """
+    workdir = os.path.join(tempfile.gettempdir(), 'oe_bls_cex_benchmark') if workdir is None else workdir
+    results = []
+    runs = PipelineMetrics(trace_memory)
+    for scale in scales:
+        pumddir = oe_bls_cex_synthetic_pumd(os.path.join(workdir, 'pumd'+str(scale)), [year], rows=scale)
+        metrics = PipelineMetrics(trace_memory)
+        pumd, hg, vardict, codedict = oe_bls_cex_pumd_open_files([year], pumddir, typed=True, metrics=metrics)
+        h, sumrules, v, c = oe_bls_cex_pumd_interpret_meta(hg, vardict, codedict, year, metrics=metrics)
+        oe_bls_cex_pumd_interpret_data(pumd, v, year, sumrules, join=join, metrics=metrics, members=True,
+                                       summarize=True)
+        del pumd
+
+        summary = metrics.summary().reset_index()
+        # The file types the generator doesn't write are read as empty frames
+        summary = summary[~(summary["stage"].str.startswith("read_") & (summary["bytes_read"] == 0))]
+        summary.insert(0, "scale", scale)
+        # Throughput is of the rows each stage started from, or produced when it doesn't know them
+        rows = summary["rows_in"].where(summary["rows_in"] > 0, summary["rows_out"])
+        summary["rows_per_sec"] = rows / summary["seconds"]
+        results.append(summary)
+        runs.extend([dict(r, stage=str(scale)+':'+r['stage']) for r in metrics.records])
+    if report is not None:
+        runs.report(report)
+    return pd.concat(results, ignore_index=True)[["scale", "stage", "calls", "seconds", "rows_in", "rows_out",
+                                                  "rows_per_sec", "bytes_read", "peak_mb", "maxrss_mb"]]
+
+
+if __name__ == "__main__":
+
+    print(oe_bls_cex_benchmark_flags())
+    print(oe_bls_cex_benchmark_tables())
+    print(oe_bls_cex_benchmark_pipeline())
@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental builds of the PUMD outputs.  Each year's outputs are recorded in a
+build.json in the output folder together with the inputs they were built from:
+the year's FMLI, FMLD, MTBI, EXPD, MEMI and MEMD sources and HG stub, by zip
+member CRC or by file size and modification time, and a hash of the dictionary
+rows in effect that year.  A later build only recomputes the years whose inputs
+changed, and the multi-year outputs only if any year was recomputed.  So a new BLS release,
+which also refreshes the dictionary and stubs.zip, only builds its own year.
+
+    oe_bls_cex_build_inputs    - lists the input files a year's outputs depend on
+    oe_bls_cex_build_pumd      - rebuilds the outputs of the years whose inputs changed
+
+Per year, the outputs are blockgroupspending (the family file), costs (costs by
+CU, UCC and HG summary variable) and estimates (national means and standard
+errors), written by oe_bls_cex_output_write.  They are Parquet datasets
+partitioned by year and source, or <year><name>.csv files, in which case
+estimates.csv stacks every year's estimates.
+"""
+
+import os
+import json
+import hashlib
+import zipfile
+import logging
+import pandas as pd
+from oe_bls_cex_cache import oe_bls_cex_cache_signature
+from oe_bls_cex_pumd import (oe_bls_cex_pumd_sources, oe_bls_cex_pumd_hg_source, oe_bls_cex_pumd_read_dictionary,
+                             oe_bls_cex_pumd_in_year, oe_bls_cex_pumd_process_years, oe_bls_cex_pumd_write)
+from oe_bls_cex_estimate import oe_bls_cex_estimate_means
+from oe_bls_cex_output import oe_bls_cex_output_read
+from oe_bls_cex_metrics import oe_bls_cex_metrics_stage
+
+log = logging.getLogger(__name__)
+
+# Changing this forces every year to be rebuilt, for when the processing itself changes
+oe_bls_cex_build_version = '2'
+
+# The file types a year's outputs are built from.  The member files give the MEM_* columns of family.
+oe_bls_cex_build_filetypes = ['fmli','fmld','mtbi','expd','memi','memd']
+
+
+def _signature(sources):
+    # Zip members are identified by their CRC and size, so re-downloading a zip
+    # that holds other years too (stubs.zip eg) doesn't invalidate this one
+    signature = []
+    for path, member in sources:
+        if member is None:
+            signature += oe_bls_cex_cache_signature([path])
+        else:
+            with zipfile.ZipFile(path) as zf:
+                info = zf.getinfo(member)
+            signature.append([os.path.basename(path), member, info.CRC, info.file_size])
+    return signature
+
+
+def _dictionary_version(vardict, codedict, year):
+    # Only the dictionary rows in effect for the year matter to its outputs
+    digest = hashlib.sha1()
+    for d in (vardict, codedict):
+        inyear = oe_bls_cex_pumd_in_year(d, year)
+        digest.update(pd.util.hash_pandas_object(inyear.astype(str), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def oe_bls_cex_build_inputs(year, pumddir, cachedir = None, dictionary = None):
+    """
+    :param  dictionary:  optionally, the (vardict, codedict) pair from oe_bls_cex_pumd_read_dictionary,
+                         so a build of several years reads the workbook once
+
+    :return a dictionary with the signatures of a year's data sources and HG, and 
+            a hash of the dictionary rows in effect that year
+    """
+    sources = []
+    for ftype in oe_bls_cex_build_filetypes:
+        sources += oe_bls_cex_pumd_sources(year, ftype, pumddir)
+    vardict, codedict = oe_bls_cex_pumd_read_dictionary(pumddir, cachedir) if dictionary is None else dictionary
+    return {"version": oe_bls_cex_build_version,
+            "sources": _signature(sources),
+            "dictionary": _dictionary_version(vardict, codedict, year),
+            "hg": _signature([oe_bls_cex_pumd_hg_source(year, pumddir)])}
+
+
+def _key(inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def oe_bls_cex_build_pumd(years, pumddir = './pumd/', outdir = './output/', cachedir = None,
+                          typed = True, workers = 1, force = False, format = 'parquet', compression = 'snappy',
+                          metrics = None, report = None):
+    """
+    Builds the outputs of each year whose inputs changed since its last build,
+    or whose outputs are missing, then the multi-year outputs if any year was built.
+
+    :param  years:    a list of 4 digit years that are strings     ['2018','2019','2020']
+    :param  pumddir:  the folder with the downloaded PUMD files
+    :param  outdir:   the folder for the outputs and build.json
+    :param  cachedir: an optional folder for the columnar cache
+    :param  workers:  the number of years processed in parallel
+    :param  force:    when True, every year is rebuilt
+    :param  format:   "parquet" or "csv", see oe_bls_cex_output_write
+    :param  compression: the Parquet or CSV compression codec
+    :param  metrics:  optionally, a PipelineMetrics recording the stages of the build
+    :param  report:   optionally, a .json or .csv path for the metrics report
+
+    :return the list of years that were rebuilt
+    """
+    os.makedirs(outdir, exist_ok=True)
+    manifestpath = os.path.join(outdir, 'build.json')
+    manifest = {"years": {}, "derived": None}
+    if os.path.exists(manifestpath):
+        with open(manifestpath) as f:
+            manifest = json.load(f)
+
+    dictionary = oe_bls_cex_pumd_read_dictionary(pumddir, cachedir)
+    inputs = {yr: oe_bls_cex_build_inputs(yr, pumddir, cachedir, dictionary) for yr in years}
+    for yr in years:
+        inputs[yr]["format"] = [format, compression]
+    stale = []
+    for yr in years:
+        entry = manifest["years"].get(yr)
+        present = (entry is not None) and all(os.path.exists(os.path.join(outdir, o)) for o in entry["outputs"])
+        if force or (not present) or (entry["key"] != _key(inputs[yr])):
+            stale.append(yr)
+    log.info("Up to date: %s rebuilding: %s", [yr for yr in years if yr not in stale], stale)
+
+    results = oe_bls_cex_pumd_process_years(stale, pumddir, cachedir, typed, workers, metrics) if len(stale) > 0 else {}
+    for yr in stale:
+        sumrules, family, costs = results[yr]
+        with oe_bls_cex_metrics_stage(metrics, 'estimate', yr, len(family)) as stage:
+            estimates = oe_bls_cex_estimate_means(family, costs)
+            stage.rows_out = len(estimates)
+        outputs = [oe_bls_cex_pumd_write(family, yr, outdir, format=format, compression=compression, metrics=metrics),
+                   oe_bls_cex_pumd_write(costs.reset_index(), yr, outdir, 'costs', format, compression=compression,
+                                         metrics=metrics),
+                   oe_bls_cex_pumd_write(estimates, yr, outdir, 'estimates', format, compression=compression,
+                                         metrics=metrics)]
+        manifest["years"][yr] = {"key": _key(inputs[yr]), "inputs": inputs[yr],
+                                 "outputs": [os.path.relpath(o, outdir) for o in outputs]}
+        # Record each year as it completes, so an interrupted build keeps its progress
+        with open(manifestpath + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifestpath + '.tmp', manifestpath)
+
+    # A Parquet output is already one dataset across the years.  For CSV, the
+    # multi-year outputs depend on the keys of every year they include.
+    if format != 'csv':
+        if (metrics is not None) and (report is not None):
+            metrics.report(report)
+        return stale
+    derivedkey = _key({yr: manifest["years"][yr]["key"] for yr in sorted(years)})
+    derivedpath = os.path.join(outdir, 'estimates.csv')
+    if (manifest.get("derived") != derivedkey) or (not os.path.exists(derivedpath)):
+        log.info("Combining estimates for %s", sorted(years))
+        estimates = oe_bls_cex_output_read('estimates', outdir, sorted(years), format='csv', dtype={"item": str})
+        estimates.to_csv(derivedpath + '.tmp', index=False)
+        os.replace(derivedpath + '.tmp', derivedpath)
+        manifest["derived"] = derivedkey
+        with open(manifestpath + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(manifestpath + '.tmp', manifestpath)
+
+    if (metrics is not None) and (report is not None):
+        metrics.report(report)
+    return stale
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    PUMDDIR = "D:\\Open Environments\\data\\bls\\cex\\pumd\\"
+    YEARS = ['2016','2017','2018','2019','2020']
+
+    oe_bls_cex_build_pumd(YEARS, pumddir = PUMDDIR, outdir = os.path.join(PUMDDIR, "output"),
+                          cachedir = os.path.join(PUMDDIR, "cache"))
+
+    print("Done")
@@ -0,0 +1,153 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A persistent, columnar cache for dataframes parsed from BLS source files.
+
+Each cached entry is stored as a Parquet file alongside a small JSON manifest
+that records the path, size and modification time of every source file it
+was built from.  When any source changes, the key no longer matches and the
+entry is rebuilt on the next read.
+
+    oe_bls_cex_cache_signature    - lists the (path, size, mtime) of a set of source files
+    oe_bls_cex_cache_key          - hashes a signature into a cache key
+    oe_bls_cex_cache_frame        - returns a cached dataframe, building and storing it if stale
+    oe_bls_cex_cache_object       - the same for any picklable object, like compiled metadata
+
+Parquet support requires pyarrow.  Without it the cache is bypassed and
+every frame is built from its sources.  Objects are stored with pickle, so
+they are always cached.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import pickle
+import logging
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+
+def oe_bls_cex_cache_signature(sources):
+    """
+    :param  sources:  a list of source file paths
+    :return a list of [absolute path, size, mtime in ns], one per source
+    """
+    signature = []
+    for path in sources:
+        stat = os.stat(path)
+        signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def oe_bls_cex_cache_key(sources, variant=''):
+    """
+    :param  sources:  a list of source file paths
+    :param  variant:  a string that distinguishes different parses of the same sources
+    :return a hex digest identifying this exact set of source file versions
+    """
+    payload = json.dumps({"sources": oe_bls_cex_cache_signature(sources), "variant": variant})
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _parquet_ready(df):
+    # Parquet needs string column names and a single type per column.  Spreadsheet
+    # columns like comments can mix numbers and text, so those are stored as text.
+    df = df.copy()
+    df.columns = [str(c) for c in df.columns]
+    for c in df.columns:
+        if df[c].dtype == object and pd.api.types.infer_dtype(df[c], skipna=True).startswith('mixed'):
+            df[c] = df[c].where(df[c].isna(), df[c].astype(str))
+    return df
+
+
+def _write_replace(write, path):
+    # write(tmp) to a temporary name unique to this call, beside path, then rename it
+    # over path.  Processes sharing the folder never touch each other's files.
+    tmp = path + '.' + uuid.uuid4().hex + '.tmp'
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _cached(name, sources, build, cachedir, variant, extension, read, write):
+    # Returns read(datafile) when the entry's manifest has the sources' key, otherwise
+    # stores build() with write(value, path) and records the key in the manifest
+    os.makedirs(cachedir, exist_ok=True)
+    datafile = os.path.join(cachedir, name + extension)
+    manifest = os.path.join(cachedir, name + '.json')
+    key = oe_bls_cex_cache_key(sources, variant)
+
+    if os.path.exists(datafile) and os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f).get("key") == key:
+                return read(datafile)
+
+    value = build()
+    # The data is replaced before the manifest, so a manifest with the key is
+    # only ever found next to its complete data file
+    _write_replace(lambda path: write(value, path), datafile)
+    record = {"key": key, "sources": oe_bls_cex_cache_signature(sources), "variant": variant}
+
+    def dump(path):
+        with open(path, 'w') as f:
+            json.dump(record, f)
+    _write_replace(dump, manifest)
+    return value
+
+
+def _read_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _write_pickle(obj, path):
+    with open(path, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def oe_bls_cex_cache_frame(name, sources, build, cachedir=None, variant=''):
+    """
+    Returns the dataframe for a cache entry.  A fresh entry is read from its
+    Parquet file, otherwise build() is called and its result stored.
+
+    :param  name:      the entry name, '2018-fmli' eg, used as the file name
+    :param  sources:   a list of the source file paths the frame is built from
+    :param  build:     a function without arguments returning the dataframe
+    :param  cachedir:  the cache directory, or None to always build
+    :param  variant:   a string that distinguishes different parses of the same sources
+
+    :return a dataframe
+    """
+    if cachedir is None:
+        return build()
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        log.warning("pyarrow is not installed, the cache at %s is not used", cachedir)
+        return build()
+    return _cached(name, sources, build, cachedir, variant, '.parquet', pd.read_parquet,
+                   lambda df, path: _parquet_ready(df).to_parquet(path))
+
+
+def oe_bls_cex_cache_object(name, sources, build, cachedir=None, variant=''):
+    """
+    Returns the object for a cache entry, like oe_bls_cex_cache_frame but stored
+    as a pickle.  A pickle is only as portable as the classes it holds, so the
+    variant should change whenever their layout does.
+
+    :param  name:      the entry name, 'meta-2018' eg, used as the file name
+    :param  sources:   a list of the source file paths the object is built from
+    :param  build:     a function without arguments returning the object
+    :param  cachedir:  the cache directory, or None to always build
+    :param  variant:   a string that distinguishes different builds from the same sources
+
+    :return the object
+    """
+    if cachedir is None:
+        return build()
+    return _cached(name, sources, build, cachedir, variant, '.pkl', _read_pickle, _write_pickle)
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A download manager for the BLS files used by the PUMD and MSA modules.
+
+    oe_bls_cex_download_file       - downloads one URL, resuming a partial download and skipping a complete one
+    oe_bls_cex_download_files      - downloads a list of URLs across a bounded pool of threads
+    oe_bls_cex_download_extract    - streams selected members out of a zip file
+
+Completed downloads are recorded in a manifest.json in the destination folder
+with their URL, size and sha256 checksum.  A file whose size matches its
+manifest entry is not downloaded again, and an interrupted download is kept
+as <file>.part and continued with an HTTP Range request on the next run.
+
+Any base URL can be used, so a local HTTP server can stand in for www.bls.gov.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import zipfile
+import logging
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+_manifest_lock = threading.Lock()
+
+
+def oe_bls_cex_download_sha256(path, chunksize=1 << 20):
+    """
+    :return the sha256 hex digest of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_manifest(destdir):
+    path = os.path.join(destdir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _record(destdir, filename, entry):
+    # Threads share the manifest, so it is re-read and replaced under a lock
+    with _manifest_lock:
+        manifest = _read_manifest(destdir)
+        manifest[filename] = entry
+        path = os.path.join(destdir, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+
+def oe_bls_cex_download_file(url, destdir, verify=False, chunksize=1 << 20, timeout=60):
+    """
+    Downloads a URL into destdir, keeping its file name.
+
+    :param  url:        the URL of the file
+    :param  destdir:    the destination folder, created if needed
+    :param  verify:     when True, a file already present is also checked against
+                        its manifest checksum, not just its size
+    :param  chunksize:  the number of bytes read at a time
+    :param  timeout:    the socket timeout in seconds
+
+    :return the path of the downloaded file
+    """
+    os.makedirs(destdir, exist_ok=True)
+    filename = url.rstrip('/').split('/')[-1]
+    path = os.path.join(destdir, filename)
+    part = path + '.part'
+
+    entry = _read_manifest(destdir).get(filename)
+    if (entry is not None) and os.path.exists(path) and (os.path.getsize(path) == entry["size"]):
+        if (not verify) or (oe_bls_cex_download_sha256(path) == entry["sha256"]):
+            log.info('Already downloaded %s', filename)
+            return path
+
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    request = urllib.request.Request(url, headers={'User-Agent': 'oe_bls'})
+    if offset > 0:
+        request.add_header('Range', 'bytes=' + str(offset) + '-')
+        log.info('Resuming %s at %d bytes', filename, offset)
+    else:
+        log.info('Downloading %s', filename)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as err:
+        if (err.code == 416) and (offset > 0):
+            # The partial file is already complete
+            response = None
+        else:
+            raise
+    if response is not None:
+        with response:
+            # A server that ignores the Range header sends the whole file again
+            mode = 'ab' if (offset > 0) and (response.status == 206) else 'wb'
+            expected = response.headers.get('Content-Length')
+            with open(part, mode) as f:
+                start = f.tell()
+                shutil.copyfileobj(response, f, chunksize)
+                received = f.tell() - start
+            if (expected is not None) and (received != int(expected)):
+                raise IOError('Incomplete download of ' + url + ': ' + str(received) +
+                              ' of ' + expected + ' bytes, rerun to resume')
+
+    os.replace(part, path)
+    _record(destdir, filename, {"url": url, "size": os.path.getsize(path),
+                                "sha256": oe_bls_cex_download_sha256(path)})
+    return path
+
+
+def oe_bls_cex_download_files(urls, destdir, workers=4, verify=False):
+    """
+    Downloads a list of URLs into destdir with up to workers at a time.
+
+    :return the list of downloaded paths, in the order of urls
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(oe_bls_cex_download_file, url, destdir, verify) for url in urls]
+        return [f.result() for f in futures]
+
+
+def oe_bls_cex_download_extract(zippath, destdir, keep=None, chunksize=1 << 20):
+    """
+    Extracts members of a zip file one stream at a time.  Members already
+    extracted with the same size are skipped.
+
+    :param  zippath:  the path of the zip file
+    :param  destdir:  the folder the member paths are extracted under
+    :param  keep:     optionally, a function of the member name returning True
+                      for the members to extract
+
+    :return the list of extracted paths
+    """
+    extracted = []
+    root = os.path.abspath(destdir)
+    with zipfile.ZipFile(zippath, 'r') as zf:
+        for info in zf.infolist():
+            if info.is_dir() or ((keep is not None) and (not keep(info.filename))):
+                continue
+            path = os.path.abspath(os.path.join(root, *info.filename.split('/')))
+            if not path.startswith(root + os.sep):
+                raise ValueError('Unsafe path in ' + zippath + ': ' + info.filename)
+            extracted.append(path)
+            if os.path.exists(path) and (os.path.getsize(path) == info.file_size):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with zf.open(info) as src, open(path + '.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunksize)
+            os.replace(path + '.tmp', path)
+    return extracted
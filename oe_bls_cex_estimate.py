@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Weighted estimates from the interpreted PUMD, following the BLS method of
+balanced repeated replication (BRR).  Each CU carries 44 replicate weights
+(WTREP01-WTREP44) and its final weight (FINLWT21).  An estimate is computed
+once per weight; the FINLWT21 result is the estimate and the spread of the
+44 replicates around it gives its variance.
+
+    oe_bls_cex_estimate_means      - weighted means, aggregates and BRR standard errors by UCC and HG summary variable
+    oe_bls_cex_estimate_compare    - compares the estimates to the published national means
+
+The cost matrix is multiplied by the (CUs x 45) weight matrix, so the 45
+weighted copies of each cost are never stored on the pubfile.
+
+See:    https://www.bls.gov/cex/pumd-getting-started-guide.htm
+"""
+
+import pandas as pd
+import numpy as np
+from scipy import sparse
+from oe_bls_cex_pumd import oe_bls_cex_pumd_wtrep, oe_bls_cex_pumd_repwt
+from oe_bls_cex_reference import oe_bls_cex_reference_csv
+
+
+def _as_matrix(costs):
+    # costs from oe_bls_cex_pumd_summarize can be dense or use sparse columns
+    if hasattr(costs, "sparse"):
+        return sparse.csr_matrix(costs.sparse.to_coo())
+    return sparse.csr_matrix(costs.to_numpy(dtype=np.float64))
+
+
+def _brr(estimates):
+    # estimates is (items x 45) with FINLWT21 last: returns the estimate and its standard error
+    full = estimates[:, 44]
+    variance = ((estimates[:, :44] - full[:, None]) ** 2).sum(axis=1) / 44
+    return full, np.sqrt(variance)
+
+
+def oe_bls_cex_estimate_means(family, costs, by=None):
+    """
+    Estimates the mean expenditure per CU, the aggregate expenditure and their
+    BRR standard errors for every column of costs.
+
+    Interview and diary CUs are weighted separately: each source's weighted
+    costs are divided by that source's population (the sum of its REPWT weights)
+    and the two means are added.  Publication flags keep each UCC in one source,
+    so nothing is counted twice.
+
+    :param  family:  the family dataframe from oe_bls_cex_pumd_interpret_data, with
+                     NEWID, source, WTREP01-WTREP44, FINLWT21 and REPWT1-REPWT45
+    :param  costs:   the costs dataframe from oe_bls_cex_pumd_interpret_data, indexed
+                     by NEWID with a column per UCC and HG summary variable
+    :param  by:      optionally, a list of family columns to estimate within
+
+    :return a dataframe with the by columns, item, population, mean, mean_se,
+            aggregate and aggregate_se.  The population is that of the interview
+            CUs, or of the diary CUs for a diary-only group.
+    """
+    by = [] if by is None else list(by)
+    rows = costs.index.get_indexer(family["NEWID"].astype(str))
+    matched = rows >= 0
+    family = family[matched]
+    matrix = _as_matrix(costs)[rows[matched]]
+    weights = family[oe_bls_cex_pumd_wtrep].to_numpy(dtype=np.float64)
+    repwt = family[oe_bls_cex_pumd_repwt].to_numpy(dtype=np.float64)
+    source = family["source"].astype(str).to_numpy()
+
+    if len(by) > 0:
+        groupcodes, groups = pd.MultiIndex.from_frame(family[by].astype(object)).factorize()
+    else:
+        groupcodes, groups = np.zeros(len(family), dtype=np.int64), [()]
+
+    results = []
+    for g, group in enumerate(groups):
+        ingroup = groupcodes == g
+        means = np.zeros((matrix.shape[1], 45))
+        aggregates = np.zeros((matrix.shape[1], 45))
+        populations = {}
+        for s in np.unique(source[ingroup]):
+            pick = np.flatnonzero(ingroup & (source == s))
+            weighted = np.asarray(matrix[pick].T @ weights[pick])     # items x 45
+            population = repwt[pick].sum(axis=0)                      # 45
+            aggregates += weighted
+            populations[s] = population
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means += np.where(population > 0, weighted / population, 0.0)
+        mean, mean_se = _brr(means)
+        aggregate, aggregate_se = _brr(aggregates)
+        population = populations.get("I", populations.get("D", np.zeros(45)))
+        result = pd.DataFrame({"item": costs.columns, "population": population[44],
+                               "mean": mean, "mean_se": mean_se,
+                               "aggregate": aggregate, "aggregate_se": aggregate_se})
+        for col, value in zip(by, group if isinstance(group, tuple) else (group,)):
+            result.insert(by.index(col), col, value)
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+
+def oe_bls_cex_estimate_compare(estimates, year, ussum=None, cexvariables=None, refdir='./reference/'):
+    """
+    Lines up national estimates with the means published by the BLS, using the
+    CEXVariables.csv map from report titles to CEX variable names.
+
+    :param  estimates:     the result of oe_bls_cex_estimate_means without groups
+    :param  year:          a string of the requested year   "2018", eg
+    :param  ussum:         optionally, the published means from oe_bls_cex_totals,
+                           which are read from refdir or downloaded when not given
+    :param  cexvariables:  optionally, the CEXVariables table
+    :param  refdir:        the folder keeping the downloaded BLS reports
+
+    :return a dataframe with Item, Var, published, mean, mean_se, difference and
+            z, the difference in standard errors
+    """
+    if ussum is None:
+        from oe_bls_cex_totals import oe_bls_cex_totals
+        ussum = oe_bls_cex_totals(year, refdir)
+    if cexvariables is None:
+        cexvariables = oe_bls_cex_reference_csv("CEXVariables.csv", dtype=str)
+
+    compare = pd.merge(ussum, cexvariables[["ReportTitle","Var"]], left_on="Item", right_on="ReportTitle", how="inner")
+    compare = pd.merge(compare, estimates[["item","mean","mean_se"]], left_on="Var", right_on="item", how="inner")
+    compare = compare.rename(columns={"Amount": "published"})[["Item","Var","published","mean","mean_se"]]
+    compare["difference"] = compare["mean"] - compare["published"]
+    compare["z"] = compare["difference"] / compare["mean_se"].replace(0, np.nan)
+    return compare
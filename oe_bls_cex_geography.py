@@ -0,0 +1,173 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The geography of the CEX areas, and the allocation of their values down to
+counties and Census block groups.  The MSA summary reports are keyed by BLS CPI
+area codes (S11A eg), which PSUCountyCrosswalk.csv defines as lists of counties
+in "ST: County, County" text.  That text is parsed once into an index of one
+row per CPI area and county, with the state and county FIPS codes, and values
+are moved down the geography by joining on integer positions.
+
+    oe_bls_cex_geography_crosswalk   - parses the crosswalk into a row per CPI area, state and county name
+    oe_bls_cex_geography_index       - the crosswalk with the counties' FIPS codes and 5 digit GEOIDs
+    oe_bls_cex_geography_msa_values  - the values of oe_bls_cex_msa_open's msacoded as a row per county
+    oe_bls_cex_geography_allocate    - broadcasts or shares values from a geography to the one below it
+
+A Census GEOID begins with the GEOIDs of the geographies containing it: the 2
+digit state, 5 digit county, 11 digit tract and 12 digit block group.  So
+counties are allocated to block groups, or states to counties, by the prefix
+of the block group or county GEOID.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+from oe_bls_cex_reference import oe_bls_cex_reference_crosswalk, oe_bls_cex_reference_counties
+
+log = logging.getLogger(__name__)
+
+# The state FIPS codes by USPS abbreviation
+oe_bls_cex_geography_statefips = {
+    'AL': '01', 'AK': '02', 'AZ': '04', 'AR': '05', 'CA': '06', 'CO': '08', 'CT': '09', 'DE': '10',
+    'DC': '11', 'FL': '12', 'GA': '13', 'HI': '15', 'ID': '16', 'IL': '17', 'IN': '18', 'IA': '19',
+    'KS': '20', 'KY': '21', 'LA': '22', 'ME': '23', 'MD': '24', 'MA': '25', 'MI': '26', 'MN': '27',
+    'MS': '28', 'MO': '29', 'MT': '30', 'NE': '31', 'NV': '32', 'NH': '33', 'NJ': '34', 'NM': '35',
+    'NY': '36', 'NC': '37', 'ND': '38', 'OH': '39', 'OK': '40', 'OR': '41', 'PA': '42', 'RI': '44',
+    'SC': '45', 'SD': '46', 'TN': '47', 'TX': '48', 'UT': '49', 'VT': '50', 'VA': '51', 'WA': '53',
+    'WV': '54', 'WI': '55', 'WY': '56', 'PR': '72'}
+
+# Words dropped from county names before matching.  "City" is kept, since
+# St. Louis and St. Louis City eg are different counties.
+oe_bls_cex_geography_county_words = r'\s+(county|parish|borough|municipality|census area|city and borough)$'
+
+
+def oe_bls_cex_geography_county_key(names):
+    """
+    :param  names:  a series of county names
+    :return the names as matching keys: lower case, without the type of county,
+            spaces or punctuation.  "De Kalb" and "DeKalb County" are both "dekalb" eg
+    """
+    names = names.astype(str).str.lower().str.replace('’', "'", regex=False).str.strip()
+    names = names.str.replace(oe_bls_cex_geography_county_words, '', regex=True)
+    return names.str.replace(r'[^a-z0-9]', '', regex=True)
+
+
+def oe_bls_cex_geography_crosswalk(crosswalk=None):
+    """
+    Parses PSUCountyCrosswalk.csv.  The code, name and population of an area are
+    carried down to its continuation rows, then each definition is split into
+    its state and counties.
+
+    :param  crosswalk:  optionally, the crosswalk dataframe, the packaged one by default
+    :return a dataframe with CPI Area, MSA Name, MSA Population, STATE, STATEFP and COUNTY,
+            a row per county
+    """
+    cw = oe_bls_cex_reference_crosswalk() if crosswalk is None else crosswalk.copy()
+    cw = cw.rename(columns={"MSA Code": "CPI Area", "MSA Definition (State and County)": "definition"})
+    cw[["CPI Area", "MSA Name", "MSA Population"]] = cw[["CPI Area", "MSA Name", "MSA Population"]].ffill()
+    cw = cw[cw["definition"].notna()]
+
+    parts = cw["definition"].str.split(':', n=1, expand=True)
+    cw = cw.assign(STATE=parts[0].str.strip(), COUNTY=parts[1].str.split(','))
+    cw = cw.explode("COUNTY", ignore_index=True)
+    cw["COUNTY"] = cw["COUNTY"].str.strip()
+    cw["STATEFP"] = cw["STATE"].map(oe_bls_cex_geography_statefips)
+    cw["MSA Population"] = pd.to_numeric(cw["MSA Population"].str.replace(',', '', regex=False), errors='coerce')
+    return cw[["CPI Area", "MSA Name", "MSA Population", "STATE", "STATEFP", "COUNTY"]]
+
+
+def oe_bls_cex_geography_index(refdir='./reference/', refresh=False, crosswalk=None, counties=None):
+    """
+    Matches the crosswalk's counties to the Census county list by state and
+    name key.  Counties that don't match are logged and left out.
+
+    :param  refdir:     the reference folder keeping the Census county list
+    :param  refresh:    when True, the county list is downloaded again
+    :param  crosswalk:  optionally, the parsed crosswalk from oe_bls_cex_geography_crosswalk
+    :param  counties:   optionally, the county list from oe_bls_cex_reference_counties
+
+    :return a dataframe with the crosswalk columns, COUNTYFP and GEOID, the 5 digit
+            county GEOID, a row per county
+    """
+    cw = oe_bls_cex_geography_crosswalk() if crosswalk is None else crosswalk.copy()
+    counties = oe_bls_cex_reference_counties(refdir, refresh) if counties is None else counties
+
+    keys = pd.Index(counties["STATEFP"].str.zfill(2) + '|' + oe_bls_cex_geography_county_key(counties["COUNTYNAME"]))
+    found = keys.get_indexer(cw["STATEFP"] + '|' + oe_bls_cex_geography_county_key(cw["COUNTY"]))
+    if (found < 0).any():
+        missing = cw[found < 0]
+        log.warning("%d crosswalk counties not in the county list: %s", len(missing),
+                    ", ".join(missing["STATE"] + ": " + missing["COUNTY"]))
+    cw = cw[found >= 0].copy()
+    cw["COUNTYFP"] = counties["COUNTYFP"].str.zfill(3).to_numpy()[found[found >= 0]]
+    cw["GEOID"] = cw["STATEFP"] + cw["COUNTYFP"]
+    return cw.reset_index(drop=True)
+
+
+def oe_bls_cex_geography_msa_values(msacoded, index, variables='Var'):
+    """
+    Spreads the CPI area columns of msacoded to the counties of each area.
+    Every county of an area gets the area's value, the mean per CU.
+
+    :param  msacoded:   the dataframe from oe_bls_cex_msa_open, a row per Item with
+                        a column per CPI area and the CEX variable name
+    :param  index:      the county index from oe_bls_cex_geography_index
+    :param  variables:  the msacoded column naming the variables.  Rows without one
+                        are dropped, and a name repeated keeps its first row.
+
+    :return a dataframe indexed by county GEOID, with CPI Area and a column per variable
+    """
+    areas = [c for c in msacoded.columns if c in set(index["CPI Area"])]
+    rows = msacoded[msacoded[variables].notna()].drop_duplicates(variables)
+    # An (areas x variables) array, with the counties taking the row of their area
+    values = rows[areas].to_numpy(dtype=np.float64).T
+    position = pd.Index(areas).get_indexer(index["CPI Area"])
+    covered = position >= 0
+    df = pd.DataFrame(values[position[covered]], columns=rows[variables].to_numpy(),
+                      index=pd.Index(index["GEOID"].to_numpy()[covered], name="GEOID"))
+    df.insert(0, "CPI Area", index["CPI Area"].to_numpy()[covered])
+    return df
+
+
+def oe_bls_cex_geography_allocate(values, targets, geoid='GEOID', weight=None, how='mean', columns=None):
+    """
+    Allocates values of a geography to the geographies within it, block groups
+    eg from their counties, matched by the prefix of the targets' GEOIDs.
+
+    With how='mean' each target gets its parent's value, for means per CU eg.
+    With how='share' a parent's value is split among its targets in proportion
+    to their weight, for totals eg.  With how='mean' and a weight, the value is
+    multiplied by the weight, turning a mean per CU into a total given the
+    number of CUs.
+
+    :param  values:   a dataframe indexed by the parent GEOIDs, all of one length
+    :param  targets:  a dataframe of the targets with a geoid column, and the weight column if any
+    :param  geoid:    the column of targets holding their GEOIDs
+    :param  weight:   optionally, the column of targets holding their weights, households eg
+    :param  how:      'mean' or 'share'
+    :param  columns:  optionally, the columns of values to allocate, by default all numeric ones
+
+    :return a dataframe indexed by the targets' GEOIDs, for the targets within a parent
+    """
+    if how not in ('mean', 'share'):
+        raise ValueError("how must be 'mean' or 'share', not " + repr(how))
+    columns = list(values.select_dtypes('number').columns) if columns is None else list(columns)
+    length = values.index.astype(str).str.len().max()
+    parent = pd.Index(values.index.astype(str)).get_indexer(targets[geoid].astype(str).str[:length])
+    covered = parent >= 0
+    parent = parent[covered]
+    allocated = values[columns].to_numpy(dtype=np.float64)[parent]
+
+    if weight is not None:
+        w = pd.to_numeric(targets[weight], errors='coerce').fillna(0).to_numpy(dtype=np.float64)[covered]
+        if how == 'share':
+            totals = np.bincount(parent, weights=w, minlength=len(values))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                w = np.where(totals[parent] > 0, w / totals[parent], 0.0)
+        allocated = allocated * w[:, None]
+    elif how == 'share':
+        # Without weights a parent is split evenly
+        allocated = allocated / np.bincount(parent, minlength=len(values))[parent][:, None]
+
+    return pd.DataFrame(allocated, columns=columns,
+                        index=pd.Index(targets[geoid].astype(str).to_numpy()[covered], name=geoid))
@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Integer codes for the PUMD keys.  UCC and NEWID are strings in the source
+files, so every join and pivot on them hashes strings.  A KeyEncoder gives each
+key a compact int32 code, the pipeline joins and sums on the codes, and the
+codes are decoded back to strings when the results are returned.
+
+    KeyEncoder               - maps keys to int32 codes and back, and stores the map
+    oe_bls_cex_keys_open     - the encoder of a key, loaded from the cache folder once per process
+    oe_bls_cex_keys_pipeline - the UCC and NEWID encoders, with the UCCs of the HG and CEXVariables.csv
+
+Codes are assigned in the order keys are first seen and never change.  With a
+cache folder the map is stored as keys/<name>.txt, one key per line with the
+line number as its code, so a key has the same code in every year and run.
+Keys added by worker processes stay in the worker, which only matters for
+their codes, not for the decoded results.
+"""
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+from oe_bls_cex_reference import oe_bls_cex_reference_cexvariables
+
+log = logging.getLogger(__name__)
+
+# The encoders of this process, by name and cache folder
+oe_bls_cex_keys_encoders = {}
+
+
+class KeyEncoder:
+    """
+    A growing map between string keys and int32 codes.
+
+    :param  name:  the key's name, 'UCC' eg
+    :param  keys:  optionally, the keys already coded, in code order
+    :param  path:  optionally, the file the map is saved to
+    """
+
+    def __init__(self, name, keys=None, path=None):
+        self.name = name
+        self.path = path
+        self.keys = np.asarray([] if keys is None else list(keys), dtype=object)
+        self.index = pd.Index(self.keys)
+        self.saved = len(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def encode(self, values, add=True):
+        """
+        Codes an array of keys.  Each distinct value is looked up once.
+
+        :param  values:  an array or series of keys.  Numbers are coded as their strings.
+        :param  add:     when True, keys not yet coded are added, otherwise they are coded -1
+
+        :return an int32 array of codes, -1 for missing values
+        """
+        positions, uniques = pd.factorize(np.asarray(values, dtype=object))
+        uniques = pd.Index(uniques).astype(str)
+        found = self.index.get_indexer(uniques)
+        new = found < 0
+        if add and new.any():
+            found[new] = np.arange(len(self.keys), len(self.keys) + new.sum())
+            self.keys = np.concatenate([self.keys, uniques[new].to_numpy(dtype=object)])
+            self.index = pd.Index(self.keys)
+        if len(self.keys) > np.iinfo(np.int32).max:
+            raise OverflowError(self.name + " has more keys than int32 codes")
+        codes = np.where(positions >= 0, found[positions] if len(found) else -1, -1)
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        """
+        :param  codes:  an array of codes from encode
+        :return an object array of the keys, None for -1
+        """
+        codes = np.asarray(codes)
+        keys = self.keys[np.where(codes >= 0, codes, 0)] if len(self.keys) else np.full(len(codes), None, dtype=object)
+        return np.where(codes >= 0, keys, None)
+
+    def save(self, path=None):
+        """
+        Writes the keys added since the last save, replacing the file so a
+        failed write leaves the previous map.
+
+        :return the path, or None when there is no path
+        """
+        path = self.path if path is None else path
+        if path is None:
+            return None
+        if (self.saved == len(self.keys)) and os.path.exists(path):
+            return path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8', newline='\n') as f:
+            f.write("\n".join(self.keys) + ("\n" if len(self.keys) else ""))
+        os.replace(tmp, path)
+        self.saved = len(self.keys)
+        log.debug("Saved %d %s keys to %s", len(self.keys), self.name, path)
+        return path
+
+    @classmethod
+    def load(cls, name, path):
+        """
+        :return the encoder saved at path, or an empty one saving there
+        """
+        keys = None
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                keys = f.read().split("\n")[:-1]
+        return cls(name, keys, path)
+
+
+def oe_bls_cex_keys_open(name, cachedir=None):
+    """
+    Returns the encoder of a key, shared by every call in the process.
+
+    :param  name:      the key's name, 'UCC' eg
+    :param  cachedir:  optionally, the folder where the map is stored as keys/<name>.txt.
+                       Without one the codes last for the process only.
+
+    :return a KeyEncoder
+    """
+    path = None if cachedir is None else os.path.abspath(os.path.join(cachedir, 'keys', name + '.txt'))
+    if (name, path) not in oe_bls_cex_keys_encoders:
+        oe_bls_cex_keys_encoders[(name, path)] = KeyEncoder(name) if path is None else KeyEncoder.load(name, path)
+    return oe_bls_cex_keys_encoders[(name, path)]
+
+
+def oe_bls_cex_keys_pipeline(cachedir=None, hg=None, save=True):
+    """
+    Returns the encoders used by oe_bls_cex_pumd_interpret_data.  The UCC codes
+    start with the variables of CEXVariables.csv and the UCCs and summary names
+    of the HG, so the UCCs of every year share one small range of codes.
+
+    :param  cachedir:  optionally, the folder storing the maps
+    :param  hg:        optionally, a year's HG from oe_bls_cex_pumd_read_hg
+    :param  save:      when True, the maps are saved once the HG has been added
+
+    :return a dictionary of {'UCC': KeyEncoder, 'NEWID': KeyEncoder}
+    """
+    keys = {name: oe_bls_cex_keys_open(name, cachedir) for name in ('UCC', 'NEWID')}
+    if len(keys['UCC']) == 0:
+        keys['UCC'].encode(oe_bls_cex_reference_cexvariables()["Var"].dropna())
+    if hg is not None:
+        keys['UCC'].encode(hg["ucc"].dropna())
+    if save:
+        keys['UCC'].save()
+    return keys
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stage timing and sizing for the PUMD pipeline.  A PipelineMetrics passed as the
+metrics argument of the download, open, interpret, flag and write functions
+collects one record per stage and year with
+
+    seconds       the wall time of the stage
+    rows_in       the rows the stage started from
+    rows_out      the rows it produced
+    bytes_read    the bytes of source files it parsed
+    peak_mb       the peak memory of the stage in MB, with trace_memory=True
+    maxrss_mb     the process' peak resident memory in MB when the stage ended
+
+    PipelineMetrics           - collects the stage records, and returns them as a dataframe or report file
+    oe_bls_cex_metrics_stage  - times a stage into a PipelineMetrics, or only logs it when there is none
+
+peak_mb is the peak of Python and numpy allocations during the stage, measured
+by tracemalloc at some cost in speed, so it is only recorded with
+trace_memory=True.  Stages can nest: interpret_data includes its process_flags
+stages, and its peak covers theirs.  maxrss_mb is always recorded, but it is the
+peak over the life of the process so far, not of the stage: every stage after
+the largest one shows the same figure.  It is the figure that sizes a worker node.
+
+Progress messages go to the standard logging module under the oe_bls_cex_*
+module names, at INFO for stages and DEBUG for detail.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+oe_bls_cex_metrics_columns = ['stage', 'year', 'seconds', 'rows_in', 'rows_out', 'bytes_read', 'peak_mb', 'maxrss_mb']
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+class PipelineStage:
+    """
+    The record of one stage.  Code inside the stage sets rows_out and adds to
+    bytes_read as it learns them.
+    """
+
+    def __init__(self, stage, year=None, rows_in=None):
+        self.stage = stage
+        self.year = year
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes_read = 0
+        self.seconds = None
+        self.peak_mb = None
+        self.maxrss_mb = None
+
+    def record(self):
+        return {c: getattr(self, c) for c in oe_bls_cex_metrics_columns}
+
+
+class PipelineMetrics:
+    """
+    Collects the stage records of a run.
+
+    :param  trace_memory:  when True, peak_mb is measured per stage with tracemalloc
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.records = []
+        self._open = []
+
+    @contextmanager
+    def stage(self, stage, year=None, rows_in=None):
+        """
+        Times the enclosed block as a stage and records it, even when the block fails.
+
+        :return the PipelineStage, for setting rows_out and bytes_read
+        """
+        s = PipelineStage(stage, year, rows_in)
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            # Stages can nest, so the enclosing stages keep the peak so far before it is reset
+            for outer in self._open:
+                outer.peak_mb = max(outer.peak_mb or 0, tracemalloc.get_traced_memory()[1] / (1 << 20))
+            tracemalloc.reset_peak()
+        self._open.append(s)
+        start = time.perf_counter()
+        try:
+            yield s
+        finally:
+            s.seconds = time.perf_counter() - start
+            self._open.remove(s)
+            if self.trace_memory:
+                s.peak_mb = max(s.peak_mb or 0, tracemalloc.get_traced_memory()[1] / (1 << 20))
+                for outer in self._open:
+                    outer.peak_mb = max(outer.peak_mb or 0, s.peak_mb)
+                if tracing:
+                    tracemalloc.stop()
+            s.maxrss_mb = _peak_rss_mb()
+            self.records.append(s.record())
+            log.debug("%s %s took %.3fs, rows %s -> %s", stage, year or '', s.seconds, s.rows_in, s.rows_out)
+
+    def extend(self, records):
+        """
+        Adds records collected elsewhere, by a worker process eg.
+        """
+        self.records.extend(records.records if isinstance(records, PipelineMetrics) else records)
+
+    def to_frame(self):
+        """
+        :return a dataframe with a row per stage record
+        """
+        return pd.DataFrame(self.records, columns=oe_bls_cex_metrics_columns)
+
+    def summary(self):
+        """
+        :return the records totalled by stage: seconds, rows and bytes summed, peak_mb and maxrss_mb maximized
+        """
+        df = self.to_frame()
+        return df.groupby('stage', sort=False).agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'),
+                                                   rows_in=('rows_in', 'sum'), rows_out=('rows_out', 'sum'),
+                                                   bytes_read=('bytes_read', 'sum'), peak_mb=('peak_mb', 'max'),
+                                                   maxrss_mb=('maxrss_mb', 'max'))
+
+    def report(self, path):
+        """
+        Writes the run report, as JSON with the records and summary when path
+        ends with .json, otherwise as CSV records.
+
+        :return path
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.lower().endswith('.json'):
+            summary = self.summary().reset_index()
+            with open(path, 'w') as f:
+                json.dump({"records": self.records,
+                           "summary": json.loads(summary.to_json(orient='records'))}, f, indent=1, default=str)
+        else:
+            self.to_frame().to_csv(path, index=False)
+        return path
+
+
+def oe_bls_cex_metrics_stage(metrics, stage, year=None, rows_in=None):
+    """
+    :param  metrics:  a PipelineMetrics, or None to only log the stage
+    :return a context manager yielding a PipelineStage
+    """
+    if metrics is not None:
+        return metrics.stage(stage, year, rows_in)
+    return _logged_stage(stage, year, rows_in)
+
+
+@contextmanager
+def _logged_stage(stage, year, rows_in):
+    s = PipelineStage(stage, year, rows_in)
+    start = time.perf_counter()
+    yield s
+    s.seconds = time.perf_counter() - start
+    log.debug("%s %s took %.3fs", stage, year or '', s.seconds)
@@ -15,35 +15,26 @@ so this data may be only useful as providing a control to the model results.
 """
 
 import pandas as pd
-import wget
-import zipfile
-import os
-from functools import reduce
+import logging
+from oe_bls_cex_download import oe_bls_cex_download_files
+from oe_bls_cex_tables import (oe_bls_cex_tables_read, oe_bls_cex_tables_clean_labels,
+                               oe_bls_cex_tables_clean_values, oe_bls_cex_tables_join)
+from oe_bls_cex_reference import oe_bls_cex_reference_cexvariables, oe_bls_cex_reference_msacodes
 import warnings
 warnings.simplefilter("ignore")
 
 
-def oe_bls_cex_msa_download(years, regions, msadir, cexurl):
-    
-    # Avoid conflicts with any previously downloaded
-        
-    try:
-        os.mkdir(msadir)
-    except OSError as err:
-        print()
-        print("Destination directory '"+msadir+"already exists.")
-        print("Please remove it or select a new destination directory.")
-        print()
-        raise err
-
-    for year in years:
-        for region in regions:
-            wget.download(cexurl+'tables/geographic/mean/'+
-                          'cu-msa-'+region+'-2-year-average-'+year+'.xlsx',
-                      out=msadir,
-                      bar=None)
+def oe_bls_cex_msa_download(years, regions, msadir, cexurl, workers=4):
+    """
+    Downloads the MSA summary spreadsheets for each year and region.  Files
+    already downloaded are skipped, so this can be rerun after a failure.
+    """
+    urls = [cexurl+'tables/geographic/mean/'+
+            'cu-msa-'+region+'-2-year-average-'+year+'.xlsx'
+            for year in years for region in regions]
     #For example:
     #    wget https://www.bls.gov/cex/tables/geographic/mean/cu-msa-midwest-2-year-average-2020.xlsx
+    oe_bls_cex_download_files(urls, msadir, workers)
     
     return None
     
@@ -76,7 +67,7 @@ def oe_bls_cex_msa_open(year, regions, msadir):
     codes in it. Unfortunately the BLS maintains its own version of MSA codes called CPI
     Codes.
 
-    The two reference sheets are manually curated from:
+    The two reference sheets, CEXVariables.csv and MSACodes.csv, are manually curated from:
     
         National Bureau of Economic Research (NBER)  https://www.nber.org/
           "CPI MSA to Unemployment (OMB) MSA.xlsx"
@@ -85,43 +76,52 @@ def oe_bls_cex_msa_open(year, regions, msadir):
         
     """
 
-    cexvariables = pd.read_csv("https://raw.githubusercontent.com/OpenEnvironments/oe_bls/main/CEXVariables.csv")    
-    msacodes = pd.read_csv("https://raw.githubusercontent.com/OpenEnvironments/oe_bls/main/MSACodes.csv")
+    # Both reference sheets ship with this package and are read once per process
+    cexvariables = oe_bls_cex_reference_cexvariables()
+    msacodes = oe_bls_cex_reference_msacodes()
     
+    sheets = [oe_bls_cex_tables_read(msadir+"cu-msa-"+region+"-2-year-average-"+year+".xlsx") for region in regions]
+    msa = oe_bls_cex_msa_parse(sheets)
+    msacoded = oe_bls_cex_msa_code(msa, msacodes, cexvariables)
+
+    return msa,msacoded,cexvariables,msacodes
+
+
+# Footnote marks removed from the MSA report Items
+oe_bls_cex_msa_label_marks = [' a/ ', ':']
+
+
+def oe_bls_cex_msa_parse(sheets):
+    """
+    Cleans the region sheets of an MSA summary report and joins them on Item,
+    dropping the regional totals.
+
+    :param  sheets:  a list of region dataframes from oe_bls_cex_tables_read
+    :return a dataframe with Item and a column per MSA
+    """
     filelist = []
-    for region in regions:
-        df = pd.read_excel(msadir+"cu-msa-"+region+"-2-year-average-"+year+".xlsx", skiprows=2)
+    for df in sheets:
         df = df[df.iloc[:, 1].notnull()]
-        df.columns = [c.replace('\n',' ').replace('- ','-') for c in df.columns]
-        for c in df.columns:
-            if c == "Item":
-                df[c] = df[c].replace({' a/ ': '', ':': ''}, regex=True)
-            else:
-                df[c] = df[c].replace({'\$': '', ',': '','b/ ':''}, regex=True).astype(float)
+        df = df.assign(Item=oe_bls_cex_tables_clean_labels(df["Item"], oe_bls_cex_msa_label_marks))
         filelist.append(df)
 
-    msa = reduce(lambda left,right: 
-                        pd.merge(left,right,on=['Item'], how='outer'), 
-                        filelist)
-    
-    msa.drop([c for c in msa.columns if "All consumer units in" in c],
-             axis=1,
-             inplace=True)
-
-    msadict = {}
-    for i,m in msacodes.iterrows():
-        msadict[m.Short] = m["CPI Area"]
-    for i in range(msa.shape[1]):
-        if i == 0:
-            colcodes = ['Item']
-        else:
-            colcodes.append(msadict[msa.columns[i]])
+    msa = oe_bls_cex_tables_join(filelist, on="Item")
+    msa = msa.drop(columns=[c for c in msa.columns if "All consumer units in" in c])
+    # The values of every region are cleaned together
+    return oe_bls_cex_tables_clean_values(msa, [c for c in msa.columns if c != "Item"])
+
 
+def oe_bls_cex_msa_code(msa, msacodes, cexvariables):
+    """
+    Replaces the MSA column names with their CPI codes and adds the CEX variable of each Item.
+
+    :return msacoded
+    """
+    msadict = dict(zip(msacodes["Short"], msacodes["CPI Area"]))
     msacoded = msa.copy()
-    msacoded.columns = colcodes
-    msacoded = pd.merge(msacoded,cexvariables,left_on="Item",right_on="ReportTitle",how="inner")
+    msacoded.columns = ['Item'] + [msadict[c] for c in msa.columns[1:]]
+    return pd.merge(msacoded,cexvariables,left_on="Item",right_on="ReportTitle",how="inner")
 
-    return msa,msacoded,cexvariables,msacodes
 
 if __name__ == "__main__":
     
@@ -131,6 +131,8 @@ if __name__ == "__main__":
     REGIONS = ['midwest','northeast','west','south']
     YEARS = ['2016','2017','2018','2019','2020']
     
+    logging.basicConfig(level=logging.INFO)
+
     #oe_bls_cex_msa_download(years=YEARS, regions=REGIONS, msadir=MSADIR, cexurl=CEXURL)
     
     for year in YEARS:
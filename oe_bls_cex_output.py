@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Writes and reads the PUMD outputs.  Parquet output is a dataset partitioned by
+year and, optionally, by other columns like source, so a downstream job can
+read only the columns and years it needs.  CSV is kept for compatibility.
+
+    oe_bls_cex_output_write    - writes one year of an output as Parquet or CSV
+    oe_bls_cex_output_read     - reads selected columns and years of an output
+
+The layouts under the output folder are
+
+    parquet:  <name>/year=<year>/[source=<source>/]part-0.parquet
+    csv:      <year><name>.csv, or .csv.gz etc with a compression codec
+
+Every write goes to a temporary name first, so a reader never sees a half
+written year.  A CSV file replaces the previous one in one rename.  A Parquet
+year is a folder, which can't be renamed over another, so the previous folder
+is first moved aside to _old-year=<year> and then the new one moved in: a
+reader between the two renames finds the year missing.  If the second rename
+fails the previous folder is moved back, and if the process dies between them
+the next write of the year restores it before writing.  Parquet requires
+pyarrow.  Without it, Parquet writes fall back to CSV.
+"""
+
+import os
+import glob
+import shutil
+import logging
+import pandas as pd
+from oe_bls_cex_cache import _parquet_ready
+
+log = logging.getLogger(__name__)
+
+oe_bls_cex_output_formats = ['parquet', 'csv']
+
+# File suffixes of the CSV compression codecs
+_csv_suffix = {None: '', 'gzip': '.gz', 'bz2': '.bz2', 'zip': '.zip', 'xz': '.xz', 'zstd': '.zst'}
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _write_parquet(df, year, outdir, name, partition_cols, compression):
+    yeardir = os.path.join(outdir, name, 'year=' + str(year))
+    # Names starting with _ are skipped by Parquet dataset readers
+    tmpdir = os.path.join(outdir, name, '_tmp-year=' + str(year))
+    olddir = os.path.join(outdir, name, '_old-year=' + str(year))
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    if os.path.exists(olddir):
+        if os.path.exists(yeardir):
+            shutil.rmtree(olddir, ignore_errors=True)
+        else:
+            # An earlier write died between its renames, so the previous output is put back
+            log.warning("Restoring %s, left aside by an interrupted write", yeardir)
+            os.replace(olddir, yeardir)
+    if "year" in df.columns:
+        # The year is stored by the partition, and read back from it
+        if (df["year"].astype(str) != str(year)).any():
+            raise ValueError('The year column of ' + name + ' holds years other than ' + str(year))
+        df = df.drop(columns="year")
+    df = _parquet_ready(df)
+    if len(partition_cols) > 0:
+        parts = df.groupby(partition_cols, sort=True, dropna=False)
+    else:
+        parts = [((), df)]
+    for keys, part in parts:
+        keys = keys if isinstance(keys, tuple) else (keys,)
+        partdir = os.path.join(tmpdir, *[c + '=' + str(k) for c, k in zip(partition_cols, keys)])
+        os.makedirs(partdir, exist_ok=True)
+        part.drop(columns=partition_cols).to_parquet(os.path.join(partdir, 'part-0.parquet'),
+                                                     index=False, compression=compression)
+    os.makedirs(tmpdir, exist_ok=True)
+    # The previous output is kept aside until the new one is in place
+    if os.path.exists(yeardir):
+        os.replace(yeardir, olddir)
+    try:
+        os.replace(tmpdir, yeardir)
+    except BaseException:
+        if os.path.exists(olddir) and not os.path.exists(yeardir):
+            os.replace(olddir, yeardir)
+        raise
+    shutil.rmtree(olddir, ignore_errors=True)
+    return yeardir
+
+
+def _write_csv(df, year, outdir, name, compression):
+    path = os.path.join(outdir, str(year) + name + '.csv' + _csv_suffix[compression])
+    df.to_csv(path + '.tmp', index=False, compression=compression)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def oe_bls_cex_output_write(df, year, outdir = '.', name = 'blockgroupspending', format = 'parquet',
+                            partition_cols = None, compression = 'snappy'):
+    """
+    Writes one year of an output, replacing that year's previous output.
+
+    :param  df:              the dataframe to write
+    :param  year:            a string of the 4 digit year        "2018", eg
+    :param  outdir:          the output folder, created if needed
+    :param  name:            the output name                     "blockgroupspending", eg
+    :param  format:          "parquet" or "csv"
+    :param  partition_cols:  for Parquet, the columns partitioned under the year    ["source"], eg
+    :param  compression:     the codec.  For Parquet snappy, gzip, zstd, brotli or None,
+                             for CSV gzip, bz2, zip, xz, zstd or None.  snappy means None for CSV.
+
+    :return the path of the written file, or of the year's folder for Parquet
+    """
+    if format not in oe_bls_cex_output_formats:
+        raise ValueError('Unknown output format ' + str(format) + ', expected one of ' + str(oe_bls_cex_output_formats))
+    if (format == 'parquet') and (not _has_pyarrow()):
+        log.warning("pyarrow is not installed, writing %s as CSV", name)
+        format, compression = 'csv', None
+    os.makedirs(outdir, exist_ok=True)
+    log.info("Writing %s %s as %s", year, name, format)
+    if format == 'parquet':
+        partition_cols = [] if partition_cols is None else [c for c in partition_cols if c in df.columns]
+        return _write_parquet(df, year, outdir, name, partition_cols, compression)
+    return _write_csv(df, year, outdir, name, None if compression == 'snappy' else compression)
+
+
+def oe_bls_cex_output_read(name, outdir = '.', years = None, columns = None, format = 'parquet', dtype = None):
+    """
+    Reads an output written by oe_bls_cex_output_write.  Only the requested
+    columns and years are read from a Parquet output.
+
+    :param  name:     the output name                     "blockgroupspending", eg
+    :param  outdir:   the output folder
+    :param  years:    optionally, a list of 4 digit years that are strings, all years by default
+    :param  columns:  optionally, the list of columns to read.  Partition columns like
+                      source can be included.
+    :param  format:   "parquet" or "csv"
+    :param  dtype:    for CSV, the dtypes passed to read_csv
+
+    :return a dataframe with a year column of strings
+    """
+    if format == 'parquet':
+        import pyarrow.dataset as ds
+        root = os.path.join(outdir, name)
+        dataset = ds.dataset(root, format='parquet', partitioning='hive')
+        if years is not None:
+            yearfield = dataset.schema.field('year').type
+            # Hive partitioning infers years as integers
+            wanted = [int(y) for y in years] if str(yearfield).startswith('int') else [str(y) for y in years]
+            filter = ds.field('year').isin(wanted)
+        else:
+            filter = None
+        if columns is not None:
+            columns = list(dict.fromkeys(list(columns) + ['year']))
+        df = dataset.to_table(columns=columns, filter=filter).to_pandas()
+        df["year"] = df["year"].astype(str)
+        for c in df.columns:
+            # Other partition columns come back as categoricals
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype(str)
+        return df
+
+    frames = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(outdir), '*' + name + '.csv*'))):
+        if path.endswith('.tmp'):
+            continue
+        year = os.path.basename(path)[:4]
+        if (not year.isdigit()) or (os.path.basename(path)[4:].split('.csv')[0] != name):
+            continue
+        if (years is not None) and (year not in [str(y) for y in years]):
+            continue
+        frames.append(pd.read_csv(path, usecols=columns, dtype=dtype).assign(year=year))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=([] if columns is None else list(columns)) + ['year'])
+    return pd.concat(frames, ignore_index=True)
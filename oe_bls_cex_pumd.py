@@ -8,11 +8,22 @@ this dataset.
     
     oe_bls_cex_pumd_download          - retrieves the PUMD files from the BLS to a new folder
     oe_bls_cex_pumd_open_files        - opens the downloaded files into python dataframes
+        oe_bls_cex_pumd_read_filetype - reads one file type of a year, through the optional Parquet cache
+        PumdStore                     - a pumd[year][filetype] mapping that reads each file type on first access
     oe_bls_cex_pumd_interpret_meta    - selects a request year of the Variable Dictionary and Historical Grouping
+        oe_bls_cex_pumd_hg_rules      - compiles the Historical Grouping into summarization rules
+        oe_bls_cex_pumd_load_meta     - a year's compiled PumdMeta: flags, dtypes, code tables and rules, stored once
     oe_bls_cex_pumd_interpret_data    - applies rule to combine the FMLI, FMLD, MTBI and EXPD files
-        oe_bls_cex_pumd_flags         - applies flag column rules to fmli, fmld
+        oe_bls_cex_pumd_summarize     - pivots costs by CU and UCC and rolls them up the HG
+    oe_bls_cex_pumd_interpret_stream  - the same, reading MTBI and EXPD in chunks
+        PumdPubfile                   - the family/expend join without materializing the wide pubfile
+        oe_bls_cex_pumd_process_flags - applies flag column rules to fmli, fmld
+        oe_bls_cex_pumd_members       - rolls MEMI and MEMD up to member counts, ages and earners per CU
         oe_bls_cex_pumd_select        - For fmli & fmld, this selects demog, geog and expenditure cols of interest
-    oe_bls_cex_pumd_write             - stores the resulting data structures to pcikle files
+    oe_bls_cex_pumd_write             - stores the resulting data structures as Parquet or CSV files
+
+Within interpret_data and interpret_stream NEWID and UCC are int32 codes from
+oe_bls_cex_keys, and are decoded to strings in the frames they return.
 
 The final section of this files demonstrates these functions for working examples.
 
@@ -20,69 +31,590 @@ The final section of this files demonstrates these functions for working example
 
 import pandas as pd
 import numpy as np
-from datetime import datetime
-import wget
-import zipfile
+from scipy import sparse
 import os
+import zipfile
+from contextlib import contextmanager
+import json
+import hashlib
+from collections.abc import MutableMapping, Mapping
+from concurrent.futures import ProcessPoolExecutor
+from oe_bls_cex_cache import oe_bls_cex_cache_frame, oe_bls_cex_cache_object, oe_bls_cex_cache_key
+from oe_bls_cex_download import oe_bls_cex_download_files, oe_bls_cex_download_extract
+from oe_bls_cex_output import oe_bls_cex_output_write
+from oe_bls_cex_metrics import PipelineMetrics, oe_bls_cex_metrics_stage
+from oe_bls_cex_keys import KeyEncoder, oe_bls_cex_keys_pipeline
+import logging
 import warnings
 warnings.simplefilter("ignore")
 
-def oe_bls_cex_pumd_download(years, pumddir = './pumd/', cexurl='https://www.bls.gov/cex/'):
+log = logging.getLogger(__name__)
+
+def oe_bls_cex_pumd_download(years, pumddir = './pumd/', cexurl='https://www.bls.gov/cex/', workers = 4,
+                             filetypes = None, extract = False, metrics = None):
     """
     This function downloads the files, dictionaries and hierarchical groupings of in
     Bureau of Labor Statistics (BLS), Consumer Expenditure Survey's (CEX) Public Use 
     Microsample Data (PUMD).
+
+    Files already downloaded are skipped and interrupted downloads resume, so
+    the function can be rerun into the same directory after a failure.
         
     :param  years:    a list of 4 digit years that are strings like ['2018','2019','2020'] 
-    :param  pumddir:  a string with the path destination of the download & unzipped files 
+    :param  pumddir:  a string with the path destination of the downloaded files 
     :param  cexurl:   the root URL for the Consumer Expenditure Survey
+    :param  workers:  the number of files downloaded at a time
+    :param  extract:  when True, the CSVs and HG files are also extracted from the zips.
+                      They are read straight from the zips either way.
+    :param  filetypes: the PUMD file types to extract from the zips, all of them by default
+    :param  metrics:  optionally, a PipelineMetrics recording the download stage
 
     :return None   The function either succeeds or fails
     """
     
-    # Avoid conflicts with any previously downloaded
-    if os.path.exists(pumddir):
-        print("Destination directory '"+pumddir+"already exists.")
-        print("Please remove it or select a new destination directory.")
-        raise
-    else:
-        os.mkdir(pumddir)
-
-    # Download and reformat the HGs as a dictionary of dataframes
-    for yr in years:
-        for fn in ('diary','intrvw'):
-            # download
-            print('Downloading',yr,fn)
-            wget.download(cexurl+'pumd/data/comma/'+fn+yr[2:]+'.zip',
-                          out=pumddir,
-                          bar=None)
-            # unzip
-            with zipfile.ZipFile(pumddir+fn+yr[2:]+'.zip', 'r') as zip_ref:
-                zip_ref.extractall(pumddir)
-            
+    os.makedirs(pumddir, exist_ok=True)
+    if filetypes is None:
+        filetypes = oe_bls_cex_pumd_filetypes
+
+    datazips = [fn+yr[2:]+'.zip' for yr in years for fn in ('diary','intrvw')]
+    urls = [cexurl+'pumd/data/comma/'+z for z in datazips]
     # also need the HG file.  It is a zip of all years.
-    print('Downloading Hierarchical Grouping file')
-    wget.download(cexurl+'pumd/stubs.zip', 
-                  out=pumddir,
-                  bar=None)
-    with zipfile.ZipFile(pumddir+'stubs.zip', 'r') as zip_ref:
-        zip_ref.extractall(pumddir)
-
-    # Get the PUMD dictionary
-    print('Getting the PUMD dictionary')
-    wget.download(cexurl+'pumd/ce_pumd_interview_diary_dictionary.xlsx',
-                  out=pumddir,
-                  bar=None)
+    urls.append(cexurl+'pumd/stubs.zip')
+    # and the PUMD dictionary
+    urls.append(cexurl+'pumd/ce_pumd_interview_diary_dictionary.xlsx')
+    with oe_bls_cex_metrics_stage(metrics, 'download') as stage:
+        paths = oe_bls_cex_download_files(urls, pumddir, workers)
+        stage.bytes_read = sum(os.path.getsize(path) for path in paths)
+
+    if extract:
+        # unzip only the CSVs of the requested file types, and the HG of the requested years
+        with oe_bls_cex_metrics_stage(metrics, 'extract'):
+            for z in datazips:
+                log.info('Extracting %s', z)
+                oe_bls_cex_download_extract(os.path.join(pumddir, z), pumddir,
+                    keep=lambda m: m.lower().endswith('.csv') and (m.split('/')[-1][0:4] in filetypes))
+            hgfiles = ['CE-HG-Integ-'+yr+'.txt' for yr in years]
+            oe_bls_cex_download_extract(os.path.join(pumddir, 'stubs.zip'), pumddir,
+                                        keep=lambda m: m.split('/')[-1] in hgfiles)
 
     return None
 
-def oe_bls_cex_pumd_open_files(years, pumddir = './pumd/'):
+
+oe_bls_cex_pumd_filetypes = ['dtbd','dtid','expd','fmld','memd','fmli','itbi','itii','memi','mtbi','ntax']
+
+
+def oe_bls_cex_pumd_folder(pumddir, fn, yr):
+    """
+    Returns the folder, under pumddir, holding the extracted CSVs of a survey and year.
+    """
+    # Sometimes the intrv folder is in another subdir:  intrvw17/intrvw17/*.csv eg 
+    nested = os.path.join(pumddir, fn+yr[-2:], fn+yr[-2:])
+    if (fn == 'intrvw') & os.path.isdir(nested):
+        return nested
+    return os.path.join(pumddir, fn+yr[-2:])
+
+
+def oe_bls_cex_pumd_sources(yr, ftype, pumddir):
+    """
+    Returns the CSVs of one file type for a year, across the diary and interview
+    surveys.  Each source is a (path, member) pair: the CSVs are read straight out
+    of the downloaded diaryYY.zip and intrvwYY.zip, with the member name, or from
+    previously extracted folders, with a member of None.
+    """
+    sources = []
+    for fn in ('diary','intrvw'):
+        zippath = os.path.join(pumddir, fn+yr[-2:]+'.zip')
+        folder = oe_bls_cex_pumd_folder(pumddir, fn, yr)
+        if os.path.exists(zippath):
+            with zipfile.ZipFile(zippath) as zf:
+                # members can sit under any folder nesting, so match on the base name
+                members = [m for m in zf.namelist() if m.lower().endswith('.csv')
+                           and (m.split('/')[-1][0:4] == ftype)]
+            sources += [(zippath, m) for m in sorted(members, key=lambda m: m.split('/')[-1])]
+        elif os.path.isdir(folder):
+            sources += [(os.path.join(folder, f), None) for f in sorted(os.listdir(folder))
+                        if (f[0:4] == ftype) and f.lower().endswith('.csv')]
+    return sources
+
+
+@contextmanager
+def oe_bls_cex_pumd_open_source(source):
+    """
+    Opens a (path, member) source from oe_bls_cex_pumd_sources as a binary file.
+    """
+    path, member = source
+    if member is None:
+        with open(path, 'rb') as f:
+            yield f
+    else:
+        with zipfile.ZipFile(path) as zf, zf.open(member) as f:
+            yield f
+
+
+def oe_bls_cex_pumd_source_size(source):
+    """
+    Returns the uncompressed size in bytes of a source.
+    """
+    path, member = source
+    if member is None:
+        return os.path.getsize(path)
+    with zipfile.ZipFile(path) as zf:
+        return zf.getinfo(member).file_size
+
+
+def oe_bls_cex_pumd_source_name(source):
+    """
+    Returns the file name of a source, without its folder.
+    """
+    path, member = source
+    return os.path.basename(path) if member is None else member.split('/')[-1]
+
+
+# Columns kept as strings: identifiers, plus the added filename and year
+oe_bls_cex_pumd_keycols = ['NEWID','CUID','UCC','filename','year']
+
+# The key columns coded by oe_bls_cex_keys while the data are interpreted
+oe_bls_cex_pumd_codedcols = ['NEWID','UCC']
+
+
+def _join_keys(*columns):
+    # The key columns of a join as compared: as they are when every side is integer,
+    # codes from oe_bls_cex_pumd_encode eg, otherwise all as strings
+    values = [np.asarray(c) for c in columns]
+    if all(pd.api.types.is_integer_dtype(v.dtype) for v in values):
+        return values
+    return [v.astype(str) for v in values]
+
+
+def oe_bls_cex_pumd_encode(df, keys):
+    """
+    Codes the NEWID and UCC columns of a frame as read.  Their values are always
+    coded as their strings, so NEWIDs read as integers by a plain read_csv are
+    keys like any others, never taken for codes.
+
+    :param  df:    a PUMD dataframe with its raw keys
+    :param  keys:  the encoders from oe_bls_cex_keys_pipeline
+    :return a copy of df whose NEWID and UCC columns are int32 codes
+    """
+    coded = {c: keys[c].encode(df[c]) for c in oe_bls_cex_pumd_codedcols if c in df.columns}
+    return df.assign(**coded) if coded else df
+
+
+def oe_bls_cex_pumd_decode(df, keys):
+    """
+    The reverse of oe_bls_cex_pumd_encode, for frames it coded.
+
+    :return a copy of df whose NEWID and UCC columns are strings again
+    """
+    decoded = {c: pd.array(keys[c].decode(df[c].to_numpy()), dtype='str') for c in oe_bls_cex_pumd_codedcols
+               if c in df.columns}
+    return df.assign(**decoded) if decoded else df
+
+
+# Columns whose values are kept at full float64 precision
+oe_bls_cex_pumd_widecols = [("WTREP"+str(i+1).zfill(2)) for i in range(44)] + ['FINLWT21','COST']
+# Values parsed as missing in numeric columns: '.' and the flag codes
+oe_bls_cex_pumd_missing = ['.','A','B','C']
+# The rows of each CSV checked for text in the columns typed numeric
+oe_bls_cex_pumd_sniffrows = 1000
+
+
+def oe_bls_cex_pumd_dtypes(vardict, codedict, filetype):
+    """
+    Derives the column dtypes of a PUMD file type from the Variable Dictionary.
+    Identifiers are strings, coded variables and flag columns are categoricals
+    and all other dictionary variables are numeric.  Numeric columns are parsed
+    as float64 and narrowed after reading by oe_bls_cex_pumd_downcast.  The
+    dictionary doesn't tell text variables apart, PSU eg, so the readers check
+    the numeric columns and keep those holding text as strings.
+
+    :param  vardict:   the Variable Dictionary from oe_bls_cex_pumd_open_files
+    :param  codedict:  the Code Dictionary from oe_bls_cex_pumd_open_files
+    :param  filetype:  a PUMD file type, 'fmli' eg
+
+    :return a dictionary of {column: dtype}, upper case column names
+    """
+    v = vardict[vardict["File"].astype(str).str.upper() == filetype.upper()]
+    dtypes = {}
+    for var in v["Variable Name"].dropna():
+        dtypes[str(var).upper()] = 'float64'
+    for flag in v["Flag name"].dropna():
+        dtypes[str(flag).upper()] = 'category'
+    if "Variable" in codedict.columns:
+        c = codedict[codedict["File"].astype(str).str.upper() == filetype.upper()]
+        for var in c["Variable"].dropna():
+            if str(var).upper() in dtypes:
+                dtypes[str(var).upper()] = 'category'
+    for col in oe_bls_cex_pumd_keycols:
+        if col.upper() in dtypes:
+            dtypes[col.upper()] = 'str'
+    return dtypes
+
+
+def _text_values(values):
+    # True where a value is text: not missing, not a missing code and not a number
+    values = values.astype(object)
+    text = values.notna() & ~values.isin(oe_bls_cex_pumd_missing)
+    return text & pd.to_numeric(values.where(text), errors='coerce').isna()
+
+
+def oe_bls_cex_pumd_text_columns(source, numeric):
+    """
+    Finds the columns typed numeric whose first oe_bls_cex_pumd_sniffrows rows
+    hold text, values other than numbers and the missing codes.
+
+    :param  source:   a (path, member) pair from oe_bls_cex_pumd_sources
+    :param  numeric:  the names of the columns typed numeric, as in the file
+
+    :return the list of those columns
+    """
+    if len(numeric) == 0:
+        return []
+    with oe_bls_cex_pumd_open_source(source) as f:
+        sample = pd.read_csv(f, nrows=oe_bls_cex_pumd_sniffrows, dtype=object, usecols=list(numeric))
+    stacked = sample.stack()
+    if len(stacked) == 0:
+        return []
+    text = _text_values(stacked)
+    found = set(stacked.index.get_level_values(1)[text.to_numpy()])
+    return [c for c in numeric if c in found]
+
+
+def _keep_text(df, numeric, source):
+    # Parses numeric columns read as text.  A column holding text keeps its
+    # values as strings instead of losing them to NaN.
+    kept = []
+    for c in numeric:
+        if _text_values(df[c]).any():
+            df[c] = df[c].astype('str')
+            kept.append(c)
+        else:
+            df[c] = pd.to_numeric(df[c].where(~df[c].isin(oe_bls_cex_pumd_missing)), errors='coerce')
+    if kept:
+        log.warning("%s: %s typed numeric by the dictionary but holding text, kept as strings",
+                    oe_bls_cex_pumd_source_name(source), ", ".join(kept))
+    return df
+
+
+def _read_options(source, dtypes, columns):
+    # read_csv arguments for a source: projection, dtypes and missing values,
+    # and the numeric columns
+    usecols = None
+    if columns is not None:
+        wanted = set(c.upper() for c in columns)
+        usecols = lambda c: c.upper() in wanted
+    if dtypes is None:
+        return {"dtype": object, "usecols": usecols}, []
+
+    with oe_bls_cex_pumd_open_source(source) as f:
+        header = pd.read_csv(f, nrows=0).columns
+    if usecols is not None:
+        header = [c for c in header if usecols(c)]
+    coltypes = {c: dtypes.get(c.upper(), 'str') for c in header}
+    numeric = [c for c in header if coltypes[c] == 'float64']
+    text = oe_bls_cex_pumd_text_columns(source, numeric)
+    if text:
+        log.info("%s: %s hold text, read as strings", oe_bls_cex_pumd_source_name(source), ", ".join(text))
+        coltypes.update({c: 'str' for c in text})
+        numeric = [c for c in numeric if c not in text]
+    return {"dtype": coltypes, "usecols": usecols,
+            "na_values": {c: oe_bls_cex_pumd_missing for c in numeric}}, numeric
+
+
+def oe_bls_cex_pumd_read_csv(source, dtypes=None, columns=None):
+    """
+    Reads one PUMD CSV with upper case column names.  Without dtypes every
+    column is read as a string.  With dtypes, numeric columns treat '.' and the
+    flag codes as missing, and any column not in dtypes is read as a string, as
+    is a numeric column holding text.  With columns, only those (upper case)
+    columns are read.
+
+    :param  source:  a (path, member) pair from oe_bls_cex_pumd_sources
+    """
+    options, numeric = _read_options(source, dtypes, columns)
+    try:
+        with oe_bls_cex_pumd_open_source(source) as f:
+            fdf = pd.read_csv(f, **options)
+    except ValueError:
+        # A numeric column holds text past the rows checked, so the numeric columns
+        # are read as text and parsed one by one
+        options["dtype"] = {c: (object if c in numeric else t) for c, t in options["dtype"].items()}
+        options.pop("na_values")
+        with oe_bls_cex_pumd_open_source(source) as f:
+            fdf = pd.read_csv(f, **options)
+        _keep_text(fdf, numeric, source)
+    fdf.columns = [c.upper() for c in fdf.columns]
+    return fdf
+
+
+def oe_bls_cex_pumd_iter_csv(yr, ftype, pumddir, dtypes=None, columns=None, chunksize=100000):
+    """
+    Reads one file type of a year as a sequence of dataframes of up to chunksize
+    rows, with the filename and year columns, so a file type never has to be
+    held in memory at once.  dtypes and columns are as for oe_bls_cex_pumd_read_csv, 
+    though numeric columns are not narrowed.
+
+    :return a generator of dataframes
+    """
+    for source in oe_bls_cex_pumd_sources(yr, ftype, pumddir):
+        options, numeric = _read_options(source, dtypes, columns)
+        if dtypes is not None:
+            # A chunk can't be reread, so numeric columns are converted after parsing
+            options["dtype"] = {c: (object if c in numeric else t) for c, t in options["dtype"].items()}
+            options.pop("na_values")
+        with oe_bls_cex_pumd_open_source(source) as f:
+            for chunk in pd.read_csv(f, chunksize=chunksize, **options):
+                _keep_text(chunk, numeric, source)
+                chunk.columns = [c.upper() for c in chunk.columns]
+                chunk["filename"] = oe_bls_cex_pumd_source_name(source)
+                chunk["year"] = yr
+                yield chunk
+
+
+def oe_bls_cex_pumd_downcast(df, dtypes):
+    """
+    Narrows the float64 columns of df in place: whole numbers without missing
+    values become the smallest integer type, weights and costs stay float64 and
+    the rest become float32.  Categoricals mixed by concatenation are restored,
+    and a column read as text from any file is text throughout.
+    """
+    for c in df.columns:
+        t = dtypes.get(c)
+        if t == 'category' and not isinstance(df[c].dtype, pd.CategoricalDtype):
+            df[c] = df[c].astype('category')
+        elif t == 'float64' and not pd.api.types.is_numeric_dtype(df[c].dtype):
+            df[c] = df[c].astype('str')
+        elif t == 'float64' and c not in oe_bls_cex_pumd_widecols:
+            x = df[c].to_numpy(dtype=np.float64)
+            if (len(x) > 0) and (not np.isnan(x).any()) and np.all(np.mod(x, 1) == 0):
+                df[c] = pd.to_numeric(df[c], downcast='integer')
+            else:
+                df[c] = df[c].astype(np.float32)
+    return df
+
+
+def oe_bls_cex_pumd_read_filetype(yr, ftype, pumddir, cachedir=None, dtypes=None, columns=None, metrics=None):
+    """
+    Reads and concatenates every CSV of one file type for a year, adding the
+    filename and year columns.
+
+    :param  yr:        a 4 digit year string
+    :param  ftype:     a PUMD file type, 'fmli' eg
+    :param  pumddir:   the folder with the downloaded PUMD files
+    :param  cachedir:  an optional folder for the columnar cache
+    :param  dtypes:    optional column dtypes from oe_bls_cex_pumd_dtypes, 
+                       otherwise every column is read as a string
+    :param  columns:   optionally, the list of columns to read
+    :param  metrics:   optionally, a PipelineMetrics recording a read_<ftype> stage
+
+    :return a dataframe
+    """
+    sources = oe_bls_cex_pumd_sources(yr, ftype, pumddir)
+    with oe_bls_cex_metrics_stage(metrics, 'read_'+ftype, yr) as stage:
+        df = _read_filetype(yr, ftype, sources, cachedir, dtypes, columns, stage)
+        stage.rows_out = len(df)
+    return df
+
+
+# Changing this rereads cached files, as when text columns stopped being read as NaN
+oe_bls_cex_pumd_read_version = '2'
+
+
+def _read_filetype(yr, ftype, sources, cachedir, dtypes, columns, stage):
+    def build():
+        filereads = []
+        for source in sources:
+            # Only sources that are parsed count as read, not cache hits
+            stage.bytes_read += oe_bls_cex_pumd_source_size(source)
+            fdf = oe_bls_cex_pumd_read_csv(source, dtypes, columns)
+            fdf["filename"] = oe_bls_cex_pumd_source_name(source)
+            fdf["year"] = yr
+            filereads.append(fdf)
+        if len(filereads) == 0:
+            return pd.DataFrame()
+        df = pd.concat(filereads)
+        if dtypes is not None:
+            oe_bls_cex_pumd_downcast(df, dtypes)
+        return df
+
+    variant = json.dumps({"dtypes": dtypes, "columns": columns, "read": oe_bls_cex_pumd_read_version}, sort_keys=True)
+    name = yr+'-'+ftype
+    if columns is not None:
+        # projections get their own entries so they don't evict the full file
+        name += '-' + hashlib.sha1(variant.encode('utf-8')).hexdigest()[:8]
+    paths = list(dict.fromkeys(path for path, member in sources))
+    return oe_bls_cex_cache_frame(name, paths, build, cachedir, variant)
+
+
+def oe_bls_cex_pumd_hg_source(yr, pumddir):
+    """
+    Returns the (path, member) source of a year's Integrated HG stub file.
+    """
+    # The stub file is read from the stubs folder if it was extracted, otherwise from stubs.zip
+    name = 'CE-HG-Integ-'+yr+'.txt'
+    source = (os.path.join(pumddir, 'stubs', name), None)
+    if not os.path.exists(source[0]):
+        with zipfile.ZipFile(os.path.join(pumddir, 'stubs.zip')) as zf:
+            source = (os.path.join(pumddir, 'stubs.zip'), [m for m in zf.namelist() if m.split('/')[-1] == name][0])
+    return source
+
+
+def oe_bls_cex_pumd_read_hg(yr, pumddir, cachedir=None):
+    """
+    Reads the Integrated Hierarchical Grouping stub file of a year.
+
+    :return a dataframe with linenum, level, title, ucc, survey, factor, group
+    """
+    source = oe_bls_cex_pumd_hg_source(yr, pumddir)
+
+    def build():
+        hgdtypes = {"linenum":int, "level":str, "title":str, "ucc":str, "survey":str, "factor":str, "group":str}
+        with oe_bls_cex_pumd_open_source(source) as f:
+            h = pd.read_fwf(f, index_col=False,
+            names = ["linenum", "level",  "title",  "ucc",     "survey",  "factor", "group"],
+            colspecs = [(0, 3),  (3, 6),  (6, 69),  (69, 75),  (82, 85),  (85, 88), (88,95)],
+            dtype=hgdtypes)    
+        # Rows with linenum == 2 are just title text that wrapped from the previous row.
+        wrapped = (h.linenum.shift(-1) == 2).to_numpy()
+        h.loc[wrapped, 'title'] = h.title[wrapped] + ' ' + h.title.shift(-1)[wrapped]
+        return h[h.linenum == 1]
+
+    return oe_bls_cex_cache_frame('hg-'+yr, [source[0]], build, cachedir, source[1] or '')
+
+
+def oe_bls_cex_pumd_read_dictionary(pumddir, cachedir=None):
+    """
+    Reads the Variables and Codes sheets of the PUMD dictionary workbook.
+
+    :return vardict, codedict
+    """
+    path = os.path.join(pumddir, 'ce_pumd_interview_diary_dictionary.xlsx')
+    sheets = {}
+
+    def build(kind):
+        def read():
+            # The sheet names can varyin capitalization and include spaces
+            if "xl" not in sheets:
+                sheets["xl"] = pd.ExcelFile(path)
+            xl = sheets["xl"]
+            sheet = [c for c in xl.sheet_names if kind in c.lower()][0]
+            return xl.parse(sheet_name = sheet)
+        return read
+
+    vardict = oe_bls_cex_cache_frame('vardict', [path], build('vari'), cachedir)
+    codedict = oe_bls_cex_cache_frame('codedict', [path], build('code'), cachedir)
+    return vardict, codedict
+
+
+class PumdYear(MutableMapping):
+    """
+    The file types of one PUMD year, read the first time each is accessed.
+    Frames can also be assigned, as with the plain dictionary.
+    """
+
+    def __init__(self, store, year):
+        self.store = store
+        self.year = year
+        self.frames = {}
+
+    def __getitem__(self, ftype):
+        if ftype not in self.frames:
+            if ftype not in oe_bls_cex_pumd_filetypes:
+                raise KeyError(ftype)
+            self.frames[ftype] = self.store.read(self.year, ftype)
+        return self.frames[ftype]
+
+    def __setitem__(self, ftype, df):
+        self.frames[ftype] = df
+
+    def __delitem__(self, ftype):
+        del self.frames[ftype]
+
+    def __iter__(self):
+        return iter(dict.fromkeys(oe_bls_cex_pumd_filetypes + list(self.frames)))
+
+    def __len__(self):
+        return len(dict.fromkeys(oe_bls_cex_pumd_filetypes + list(self.frames)))
+
+    def loaded(self):
+        """Returns the file types that have been read so far"""
+        return list(self.frames)
+
+
+class PumdStore(Mapping):
+    """
+    A lazy replacement for the pumd dictionary of oe_bls_cex_pumd_open_files.
+    pumd[year][filetype] reads a file type the first time it is accessed, and
+    keeps it for later access.
+
+    :param  years:     a list of 4 digit year strings
+    :param  pumddir:   the folder with the downloaded PUMD files
+    :param  cachedir:  an optional folder for the columnar cache
+    :param  vardict:   the Variable Dictionary, needed to read typed columns
+    :param  codedict:  the Code Dictionary, needed to read typed columns
+    :param  typed:     when True, columns are parsed with dictionary derived dtypes
+    :param  columns:   optionally, a dictionary of {filetype: list of columns} to read
+    :param  meta:      optionally, a dictionary of {year: PumdMeta} whose precompiled
+                       dtypes are used instead of the dictionaries
+    :param  metrics:   optionally, a PipelineMetrics recording each read
+    """
+
+    def __init__(self, years, pumddir='./pumd/', cachedir=None, vardict=None, codedict=None,
+                 typed=False, columns=None, meta=None, metrics=None):
+        self.pumddir = pumddir
+        self.cachedir = cachedir
+        self.vardict = vardict
+        self.codedict = codedict
+        self.typed = typed
+        self.columns = columns if columns is not None else {}
+        self.meta = meta if meta is not None else {}
+        self.metrics = metrics
+        self.years = {yr: PumdYear(self, yr) for yr in years}
+
+    def __getitem__(self, year):
+        return self.years[year]
+
+    def __iter__(self):
+        return iter(self.years)
+
+    def __len__(self):
+        return len(self.years)
+
+    def dtypes(self, year, ftype):
+        """
+        :return the dtypes a file type is read with, or None when not typed
+        """
+        if not self.typed:
+            return None
+        if year in self.meta:
+            return self.meta[year].dtypes[ftype]
+        return oe_bls_cex_pumd_dtypes(self.vardict, self.codedict, ftype)
+
+    def read(self, year, ftype):
+        log.info("Reading %s %s", year, ftype)
+        dtypes = self.dtypes(year, ftype)
+        return oe_bls_cex_pumd_read_filetype(year, ftype, self.pumddir, self.cachedir, dtypes,
+                                             self.columns.get(ftype), self.metrics)
+
+
+def oe_bls_cex_pumd_open_files(years, pumddir = './pumd/', cachedir = None, typed = False,
+                               lazy = False, columns = None, workers = 1, metrics = None):
     """
     This function reads the PUMD data files of the dataset into python data structures. 
 
         
     :param  years: a list of 4 digit years that are strings     ['2018','2019','2020'] 
-    :param  UCCs: a list of UCCs, six digit as strings     ['123456','234567','345678']
+    :param  pumddir: a string with the path of the downloaded files
+    :param  cachedir: an optional folder where parsed files are kept as Parquet, 
+                      refreshed whenever a source file changes
+    :param  typed: when True, columns are parsed with dtypes derived from the 
+                   Variable Dictionary instead of as strings
+    :param  lazy: when True, pumdfiles is a PumdStore that reads each file type 
+                  on first access instead of reading them all now
+    :param  columns: optionally, a dictionary of {filetype: list of columns} to read
+    :param  workers: the number of processes parsing files in parallel, when not lazy
+    :param  metrics: optionally, a PipelineMetrics recording the open_files stage, and
+                     each read when not parallel
 
     pumdfiles: a dictionary, by year, with the file based dataframes
     hg: the Hierarchical Grouping table with linenum, level, title, survey, factor.
@@ -92,67 +624,256 @@ def oe_bls_cex_pumd_open_files(years, pumddir = './pumd/'):
     :return  pumdfiles, hg, vardict, codedict
     """
     
-    filetypes = ['dtbd','dtid','expd','fmld','memd','fmli','itbi','itii','memi','mtbi','ntax']
+    with oe_bls_cex_metrics_stage(metrics, 'open_files') as stage:
+        # The dictionary comes first since it describes the data file columns
+        log.info('Reading the Dictionary')
+        vardict, codedict = oe_bls_cex_pumd_read_dictionary(pumddir, cachedir)
 
-    filereads = {}
-    for t in filetypes:
-        filereads[t] = []
-        
-    pumd = {}
-    
-    for yr in years:
-        pumd[yr] = {}
-        for fn in ('diary','intrvw'):
-            print("Reading",yr,fn)
-            # Sometimes the intrv folder is in another subdir:  intrvw17/intrvw17/*.csv eg 
-            if ((fn == 'intrvw') & (os.path.exists(pumddir+fn+yr[-2:]+ "\\"+fn+yr[-2:]+"\\"))):
-                folder = fn+yr[-2:]+ "\\"+fn+yr[-2:]+"\\"
-            else:
-                folder = fn+yr[-2:]+ "\\"
-            for f in os.listdir(pumddir+folder):
-                ftype = f[0:4]
-                if ftype in filetypes:
-                    fdf = pd.read_csv(pumddir+folder+f, dtype=object)
-                    fdf.columns = [c.upper() for c in fdf.columns]
-                    fdf["filename"] = f
-                    fdf["year"] = yr
-                    filereads[ftype].append(fdf)
-
-        for t in filetypes:
-            pumd[yr][t] = pd.concat(filereads[t])   
-    
-    print('Reading the Hierarchical Groupings')
-    # I'll use the Integrated HG.  Its mostly a superset of Interview & Diary HG less a dozen each
-    hg = {}
-    hgdtypes = {"linenum":int, "level":str, "title":str, "ucc":str, "survey":str, "factor":str, "group":str}
-    for yr in years:
-        h = pd.read_fwf(pumddir+'stubs\\CE-HG-Integ-'+yr+'.txt', index_col=False,
-        names = ["linenum", "level",  "title",  "ucc",     "survey",  "factor", "group"],
-        colspecs = [(0, 3),  (3, 6),  (6, 69),  (69, 75),  (82, 85),  (85, 88), (88,95)],
-        dtype=hgdtypes)    
-        # Rows with linenum == 2 are just title text that wrapped from the previous row.
-        for i,r in h.iterrows():
-            if r.linenum == 2:
-                h.at[i-1,'title'] = h.at[i-1,'title']+' '+r.title
-        hg[yr] = h[h.linenum == 1]
-     
-    print('Reading the Dictionary')
-    # The sheet names can varyin capitalization and include spaces
-    xl = pd.ExcelFile(pumddir + 'ce_pumd_interview_diary_dictionary.xlsx')
-    varsheet =  [c for c in xl.sheet_names if 'vari' in c.lower()][0]
-    codesheet = [c for c in xl.sheet_names if 'code' in c.lower()][0]
-
-    vardict =   pd.read_excel(pumddir + 'ce_pumd_interview_diary_dictionary.xlsx',
-                              sheet_name = varsheet)
-    codedict =  pd.read_excel(pumddir + 'ce_pumd_interview_diary_dictionary.xlsx',
-                              sheet_name = codesheet)
+        pumd = PumdStore(years, pumddir, cachedir, vardict, codedict, typed, columns, metrics=metrics)
+        if lazy:
+            pass
+        elif workers > 1:
+            # Each year/filetype is parsed in a worker, and the results are placed
+            # in the same order as the sequential read
+            tasks = [(yr, t) for yr in years for t in oe_bls_cex_pumd_filetypes]
+            log.info("Reading %d year/filetypes with %d workers", len(tasks), workers)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(oe_bls_cex_pumd_read_filetype, yr, t, pumddir, cachedir,
+                                       oe_bls_cex_pumd_dtypes(vardict, codedict, t) if typed else None,
+                                       pumd.columns.get(t))
+                           for yr, t in tasks]
+                frames = [f.result() for f in futures]
+            pumd = {yr: {} for yr in years}
+            for (yr, t), df in zip(tasks, frames):
+                pumd[yr][t] = df
+        else:
+            pumd = {yr: dict(pumd[yr]) for yr in years}
+        if not lazy:
+            stage.rows_out = sum(len(df) for yr in years for df in pumd[yr].values())
+
+        log.info('Reading the Hierarchical Groupings')
+        # I'll use the Integrated HG.  Its mostly a superset of Interview & Diary HG less a dozen each
+        hg = {}
+        for yr in years:
+            hg[yr] = oe_bls_cex_pumd_read_hg(yr, pumddir, cachedir)
 
     # filter the vardict sheet to only those where 
     #     you year of interest is > First Year > First Quart and < Last Year <Last Quarter
     
     return  pumd, hg, vardict, codedict
 
-def oe_bls_cex_pumd_interpret_data(pumd, vardict, year, sumrules):
+
+# column name lists for the 45 replicate weights
+oe_bls_cex_pumd_wtrep = [("WTREP"+str(i+1).zfill(2)) for i in range(44)]+["FINLWT21"] ## WTREP01-WTREP44 and FINL
+oe_bls_cex_pumd_repwt = [("REPWT"+str(i+1)) for i in range(45)]  # REPWT1-REPWT45
+oe_bls_cex_pumd_rcost = [("RCOST"+str(i+1)) for i in range(45)]  # RCOST1-RCOST45
+
+
+def oe_bls_cex_pumd_mo_scope(fmli, year):
+    """
+    Returns the months of an interview's reference period that fall in the
+    requested year.  Interviews in Jan-Mar of the year cover (month-1) months
+    of it, those in Jan-Mar of the following year cover (4-month) and all
+    others cover 3.
+
+    :param  fmli:  the FMLI dataframe with QINTRVMO and QINTRVYR columns
+    :param  year:  a 4 digit year string
+
+    :return an integer array of months in scope
+    """
+    month = pd.to_numeric(fmli["QINTRVMO"], errors='coerce').to_numpy()
+    intrvyr = pd.to_numeric(fmli["QINTRVYR"], errors='coerce').to_numpy()
+    q1 = np.isin(month, [1, 2, 3])
+    scope = np.full(len(fmli), 3, dtype=np.int64)
+    thisyear = q1 & (intrvyr == int(year))
+    nextyear = q1 & (intrvyr == int(year) + 1)
+    scope[thisyear] = month[thisyear] - 1
+    scope[nextyear] = 4 - month[nextyear]
+    return scope
+
+
+def oe_bls_cex_pumd_replicate_weights(df, mo_scope):
+    """
+    Parses the 45 WTREP columns into one float64 (rows x 45) array, with '.'
+    and other missing values as 0, and adds REPWT1-REPWT45 as the weights
+    scaled by the months in scope.  The df is updated in place.
+
+    :param  df:        an FMLI or FMLD dataframe
+    :param  mo_scope:  an array of months in scope, one per row
+
+    :return the (rows x 45) REPWT array
+    """
+    weights = df[oe_bls_cex_pumd_wtrep].apply(pd.to_numeric, errors='coerce')
+    weights = weights.to_numpy(dtype=np.float64, na_value=0.0)
+    repwt = weights * (np.asarray(mo_scope, dtype=np.float64)[:, None] / 12)
+    df[oe_bls_cex_pumd_wtrep] = pd.DataFrame(weights, index=df.index, columns=oe_bls_cex_pumd_wtrep)
+    df[oe_bls_cex_pumd_repwt] = pd.DataFrame(repwt, index=df.index, columns=oe_bls_cex_pumd_repwt)
+    return repwt
+
+
+# The member file columns used by the roll up.  SALARYX is the Interview's wage
+# income and WAGEX the Diary's.  EARNER 1 is an earner and SEX 2 is female.
+oe_bls_cex_pumd_membercols = ['NEWID','AGE','SEX','EARNER','SALARYX','WAGEX']
+
+# The per CU features and how each is aggregated from the member rows
+oe_bls_cex_pumd_memberfeatures = {"MEM_COUNT":    ("member",   "sum"),
+                                  "MEM_EARNERS":  ("earner",   "sum"),
+                                  "MEM_CHILDREN": ("child",    "sum"),
+                                  "MEM_SENIORS":  ("senior",   "sum"),
+                                  "MEM_FEMALE":   ("female",   "sum"),
+                                  "MEM_AGE_MIN":  ("AGE",      "min"),
+                                  "MEM_AGE_MAX":  ("AGE",      "max"),
+                                  "MEM_AGE_MEAN": ("AGE",      "mean"),
+                                  "MEM_WAGES":    ("wages",    "sum")}     # the only sum that isn't a count
+
+
+def _member_values(members, column):
+    # A member column as floats, NaN when the file doesn't have it.  Coded columns
+    # are categoricals of strings when typed.
+    if column not in members.columns:
+        return np.full(len(members), np.nan)
+    values = members[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Only the categories are parsed, then taken by code
+        categories = pd.to_numeric(pd.Series(values.cat.categories.astype(str)), errors='coerce').to_numpy(np.float64)
+        codes = values.cat.codes.to_numpy()
+        return np.where(codes >= 0, np.append(categories, np.nan)[codes], np.nan)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def oe_bls_cex_pumd_members(members, newids):
+    """
+    Rolls the member rows of MEMI and/or MEMD up to one row of features per CU:
+    the number of members, earners, children under 18, seniors 65 and over and
+    women, the youngest, oldest and mean age, and the wages of all members.
+    Each NEWID is coded as its position in newids and the rows are aggregated
+    by a single groupby on those integers, so the result is sized by the CUs.
+
+    :param  members:  a dataframe of member rows with NEWID, and AGE, SEX, EARNER,
+                      SALARYX or WAGEX where available
+    :param  newids:   the NEWIDs of the CUs, in the order of the rows returned
+
+    :return a dataframe of oe_bls_cex_pumd_memberfeatures with a row per newid.  CUs
+            without members have counts of 0 and NaN ages.
+    """
+    if "NEWID" in members.columns:
+        newids, memberids = _join_keys(newids, members["NEWID"])
+        cu = pd.Index(newids).get_indexer(memberids)
+    else:
+        cu = np.full(len(members), -1)
+    keep = cu >= 0
+    age = _member_values(members, "AGE")[keep]
+    wages = np.nansum([_member_values(members, c)[keep] for c in ("SALARYX", "WAGEX")], axis=0)
+    rows = pd.DataFrame({"cu":     cu[keep],
+                         "member": np.ones(int(keep.sum()), dtype=np.int32),
+                         "earner": (_member_values(members, "EARNER")[keep] == 1).astype(np.int32),
+                         "child":  (age < 18).astype(np.int32),
+                         "senior": (age >= 65).astype(np.int32),
+                         "female": (_member_values(members, "SEX")[keep] == 2).astype(np.int32),
+                         "AGE":    age,
+                         "wages":  wages})
+    features = rows.groupby("cu", sort=False).agg(**oe_bls_cex_pumd_memberfeatures)
+    features = features.reindex(np.arange(len(newids)))
+    counts = [name for name, (column, how) in oe_bls_cex_pumd_memberfeatures.items() if column != "AGE"]
+    features[counts] = features[counts].fillna(0)
+    features[counts[:-1]] = features[counts[:-1]].astype(np.int32)
+    features.index = pd.Index(newids, name="NEWID")
+    return features
+
+
+def oe_bls_cex_pumd_attach_members(family, memi=None, memd=None, year=None, metrics=None):
+    """
+    Adds the member features of oe_bls_cex_pumd_members to family, with
+    MEM_HAS_EARNER flagging CUs with an earner.  The features are computed in
+    family's row order and assigned as columns, so family is not merged or copied.
+
+    :param  family:  the family dataframe, one row per NEWID
+    :param  memi:    optionally, the Interview member file
+    :param  memd:    optionally, the Diary member file
+    :param  metrics: optionally, a PipelineMetrics recording the members stage
+
+    :return family
+    """
+    files = [m[[c for c in oe_bls_cex_pumd_membercols if c in m.columns]] for m in (memi, memd) if m is not None]
+    members = pd.concat(files, axis=0, ignore_index=True) if files else pd.DataFrame()
+    with oe_bls_cex_metrics_stage(metrics, 'members', year, len(members)) as stage:
+        features = oe_bls_cex_pumd_members(members, family["NEWID"])
+        for column in features.columns:
+            family[column] = features[column].to_numpy()
+        family["MEM_HAS_EARNER"] = (features["MEM_EARNERS"].to_numpy() > 0).astype(np.int8)
+        stage.rows_out = len(features)
+    return family
+
+
+def oe_bls_cex_pumd_family(fmli, fmld, vardict, year, flags=None, metrics=None, memi=None, memd=None):
+    """
+    Adds the months in scope, source and replicate weights to the Interview
+    and Diary family files, applies their flags and stacks their shared columns.
+    When member files are given, their per CU features are added to family.
+
+    :param  flags:  optionally, the {FILE: {variable: flag column}} of a PumdMeta
+    :param  metrics: optionally, a PipelineMetrics recording the process_flags and members stages
+    :param  memi:   optionally, the MEMI file, see oe_bls_cex_pumd_attach_members
+    :param  memd:   optionally, the MEMD file
+
+    :return family, fmli, fmld
+    """
+
+    # Process Family
+
+    fmli['mo_scope'] = oe_bls_cex_pumd_mo_scope(fmli, year)
+    fmli["source"] = 'I'
+    oe_bls_cex_pumd_replicate_weights(fmli, fmli['mo_scope'].to_numpy())
+
+    fmld["source"] = "D"
+    fmld["mo_scope"] = 3
+    oe_bls_cex_pumd_replicate_weights(fmld, fmld['mo_scope'].to_numpy())
+
+    fmli = fmli.reset_index()
+    fmld = fmld.reset_index()
+    
+    flags = {} if flags is None else flags
+    oe_bls_cex_pumd_process_flags(fmli,"FMLI",vardict,flags.get("FMLI"),metrics)
+    oe_bls_cex_pumd_process_flags(fmld,"FMLD",vardict,flags.get("FMLD"),metrics)
+
+    fmlcols = ([c for c in fmli.columns if c in fmld.columns]) # 272 columns
+    family = pd.concat([fmli[fmlcols],fmld[fmlcols]], axis=0)
+    if (memi is not None) or (memd is not None):
+        oe_bls_cex_pumd_attach_members(family, memi, memd, year, metrics)
+    return family, fmli, fmld
+
+
+# The expend columns, and those of MTBI and EXPD needed to build them
+oe_bls_cex_pumd_expcols = ['NEWID','source','UCC','COST'] #,'REF_YR'
+oe_bls_cex_pumd_mtbicols = ['NEWID','UCC','COST','REF_YR','PUBFLAG']
+oe_bls_cex_pumd_expdcols = ['NEWID','UCC','COST','PUB_FLAG']
+
+
+def oe_bls_cex_pumd_filter_mtbi(mtbi, year):
+    """
+    Keeps the Interview expenditures of the reference year that are flagged for publication.
+    """
+    mtbi["source"] = "I"
+    return mtbi[(pd.to_numeric(mtbi["REF_YR"], errors='coerce') == int(year)) &
+                (pd.to_numeric(mtbi["PUBFLAG"], errors='coerce') == 2)]
+
+
+def oe_bls_cex_pumd_filter_expd(expd):
+    """
+    Scales the two week Diary costs to a quarter (x 13) and keeps the expenditures 
+    flagged for publication.
+    """
+    expd["source"] = "D"
+    
+    expd["COST"] = pd.to_numeric(expd["COST"], errors='coerce')
+    expd["COST"] = expd["COST"].astype(float).fillna(0) * 13
+    return expd[pd.to_numeric(expd["PUB_FLAG"], errors='coerce') == 2]
+
+
+def oe_bls_cex_pumd_interpret_data(pumd, vardict, year, sumrules, join='wide', flags=None, metrics=None,
+                                   members=False, keys=None, summarize=False):
     """
     This function applies adjustments, logical rules and corrections to this source
     are applied by the related oe_bls_cex_pumd_read function.to PUMD data structures. 
@@ -165,6 +886,18 @@ def oe_bls_cex_pumd_interpret_data(pumd, vardict, year, sumrules):
     vardict: provides a dictionary of the variables (not UCCs) in the PUMD
     sumrules: a dataframe of each summary variable name, summary level and list of children 
             columns to sum
+    join: 'wide' merges family onto every expenditure row with RCOST1-RCOST45, 
+          'lean' returns a PumdPubfile that computes weighted costs on demand
+    flags: optionally, the precompiled flag pairs of a PumdMeta
+    metrics: optionally, a PipelineMetrics recording the interpret_data stage, rows in
+             being the family and expenditure rows and rows out the CUs
+    members: when True, the MEMI and MEMD member features are added to family,
+             see oe_bls_cex_pumd_attach_members.  Otherwise the member files aren't
+             read, so a lazy pumd never loads them.
+    keys:    optionally, the encoders from oe_bls_cex_keys_pipeline, by default those
+             of the process.  NEWID and UCC are joined and summed as their codes.
+    summarize: when True, the costs by CU are also computed and returned last, so
+               the 7 values returned otherwise are unchanged
 
     The processing logic replicates what the BLS' own SAS (& R) program does!
     See:    https://www.bls.gov/cex/pumd-getting-started-guide.htm
@@ -178,9 +911,12 @@ def oe_bls_cex_pumd_interpret_data(pumd, vardict, year, sumrules):
     :return family:  a dataframe keyed by NEWID
     :return expend:  a dataframe keyed by CU & UCC 
     :return pubfile: a join between family, expend 
+    :return fmli, fmld, mtbi, expd:  the year's files as processed
+    :return costs:   with summarize=True, a dataframe keyed by NEWID with a column for
+                     each UCC and HG summary variable, from oe_bls_cex_pumd_summarize
     """
 
-    print("Processing PUMD for", year)
+    log.info("Processing PUMD for %s", year)
 
     # Get family dataframes for Interview and Diary
     fmli = pumd[year]['fmli']
@@ -188,168 +924,709 @@ def oe_bls_cex_pumd_interpret_data(pumd, vardict, year, sumrules):
     # Get member level dataframes
     mtbi = pumd[year]['mtbi']
     expd = pumd[year]['expd']
+    memi = pumd[year].get('memi') if members else None
+    memd = pumd[year].get('memd') if members else None
+    keys = oe_bls_cex_keys_pipeline(save=False) if keys is None else keys
 
-    # column name lists
-    wtrep = [("WTREP"+str(i+1).zfill(2)) for i in range(44)]+["FINLWT21"] ## WTREP01-REPWT444 and FINL
-    repwt = [("REPWT"+str(i+1)) for i in range(45)]  # REPWT1-REPWT45
-    rcost = [("RCOST"+str(i+1)) for i in range(45)]  # RCOST1-RCOST45
+    rows_in = len(fmli) + len(fmld) + len(mtbi) + len(expd)
+    with oe_bls_cex_metrics_stage(metrics, 'interpret_data', year, rows_in) as stage:
+        # The keys are coded once here, on copies so the files in pumd keep their strings
+        fmli, fmld, mtbi, expd = [oe_bls_cex_pumd_encode(df, keys) for df in (fmli, fmld, mtbi, expd)]
+        memi, memd = [None if df is None else oe_bls_cex_pumd_encode(df, keys) for df in (memi, memd)]
+        family, fmli, fmld = oe_bls_cex_pumd_family(fmli, fmld, vardict, year, flags, metrics, memi, memd)
 
-    # Process Family
+        mtbi = oe_bls_cex_pumd_filter_mtbi(mtbi, year)
+        expd = oe_bls_cex_pumd_filter_expd(expd)
+        expend = pd.concat([mtbi[oe_bls_cex_pumd_expcols],expd[oe_bls_cex_pumd_expcols]], axis=0)
 
-    def mo_scope(row):
-        if   (row["QINTRVMO"] in ['01','02','03']) & (row["QINTRVYR"]==year):
-            return (int(row["QINTRVMO"]) - 1)
-        elif (row["QINTRVMO"] in ['01','02','03']) & (row["QINTRVYR"]==str(int(year)+1)):
-            return (4 - int(row["QINTRVMO"]))
+        if join == 'lean':
+            pubfile = PumdPubfile(family, expend).decode(keys)
         else:
-            return 3
-
-    fmli['mo_scope'] = fmli.apply(mo_scope, axis=1)
-    fmli["source"] = 'I'
-    for i in range(45):
-        fmli[wtrep[i]] = fmli[wtrep[i]].replace('.',np.nan)
-        fmli[wtrep[i]] = fmli[wtrep[i]].astype(float).fillna(0)
-        fmli[repwt[i]] = (fmli[wtrep[i]] * fmli["mo_scope"]) / 12
-
-    fmld["source"] = "D"
-    fmld["mo_scope"] = 3
-    for i in range(45):
-        fmld[wtrep[i]] = fmld[wtrep[i]].replace('.',np.nan)
-        fmld[wtrep[i]] = fmld[wtrep[i]].astype(float).fillna(0)    
-        fmld[repwt[i]] = (fmld[wtrep[i]] * fmld["mo_scope"]) / 12
+            pubfile = oe_bls_cex_pumd_decode(oe_bls_cex_pumd_pubfile(family, expend), keys)
 
-    fmli = fmli.reset_index()
-    fmld = fmld.reset_index()
-    
-    oe_bls_cex_pumd_process_flags(fmli,"FMLI",vardict)
-    oe_bls_cex_pumd_process_flags(fmld,"FMLD",vardict)
+        # Summarize each CU's costs by UCC and roll them up the HG
+        if summarize:
+            costs = oe_bls_cex_pumd_summarize(expend, sumrules, newids=family["NEWID"], keys=keys)
+        stage.rows_out = len(family)
 
-    fmlcols = ([c for c in fmli.columns if c in fmld.columns]) # 272 columns
-    family = pd.concat([fmli[fmlcols],fmld[fmlcols]], axis=0)
-    
-    
-    # Process Expend
+        family, expend, fmli, fmld, mtbi, expd = [oe_bls_cex_pumd_decode(df, keys)
+                                                  for df in (family, expend, fmli, fmld, mtbi, expd)]
 
-    mtbi["source"] = "I"
-    mtbi = mtbi[(mtbi["REF_YR"] == year) & (mtbi["PUBFLAG"] == "2")]
+    if summarize:
+        return pubfile, family, expend, fmli, fmld, mtbi, expd, costs
+    return pubfile, family, expend, fmli, fmld, mtbi, expd
 
-    expd["source"] = "D"
-    
-    expd["COST"] = pd.to_numeric(expd["COST"], errors='coerce')
-    expd["COST"] = expd["COST"].astype(float).fillna(0) * 13
-    expd = expd[expd["PUB_FLAG"] == "2"]
 
-    expcols =['NEWID','source','UCC','COST'] #,'REF_YR'
-    expend = pd.concat([mtbi[expcols],expd[expcols]], axis=0)
+def oe_bls_cex_pumd_pubfile(family, expend):
+    """
+    Merges family onto every expenditure row and adds RCOST1-RCOST45, the cost
+    under each of the 45 weights.
 
+    :return the wide pubfile dataframe
+    """
     pubfile = pd.merge(family, expend, on='NEWID', how='inner')
     pubfile["COST"] = pubfile["COST"].astype(float).fillna(0)
-    for i in range(45):
-        pubfile[rcost[i]] = pubfile[wtrep[i]] * pubfile["COST"]
-        
-    #
-    # TBD: summarize the pubfile, and apply the sumrules
-    #
-    
-    # 1. Start with a df that has CUID/NEWID, COST and UCC columns
-    # 2. Pivot this df so there's a column for each UCC value
-        # costs = df.pivot(index='NEWID', columns='UCC', values='COST')
-    # 3. Ensure that all the expected UCC columns are present
-    #   # for all the UCC variables, if the cost df is missing that var, costs[missingUCC] = 0
-    # 4. March from the lowest level upward
-        # for level in [9,8,7,6,5,4,3,2]:
-    #   costs[sumvar] = costs[sumrulescolumns].sum(axis=1)
-        
-    return pubfile, family, expend, fmli, fmld, mtbi, expd
+    pubfile[oe_bls_cex_pumd_rcost] = pd.DataFrame(
+        pubfile[oe_bls_cex_pumd_wtrep].to_numpy(dtype=np.float64) * pubfile["COST"].to_numpy()[:, None],
+        index=pubfile.index, columns=oe_bls_cex_pumd_rcost)
+    return pubfile
+
+
+class PumdPubfile:
+    """
+    The family/expend join kept as two tables instead of one wide pubfile.
+    family is a dimension table with one row per CU, and expend a narrow fact
+    table whose cu column is the integer position of its NEWID in family.
+    Weighted costs are computed from the (CUs x 45) weight matrix when asked.
+
+    :param  family:  the family dataframe, one row per NEWID
+    :param  expend:  the expend dataframe with NEWID, source, UCC and COST
+    """
+
+    def __init__(self, family, expend):
+        self.family = family
+        newids, expendids = _join_keys(family["NEWID"], expend["NEWID"])
+        codes = pd.Index(newids).get_indexer(expendids)
+        # Like the inner merge, expenditures without a family row are dropped
+        keep = codes >= 0
+        self.expend = expend[keep].copy()
+        self.expend["cu"] = codes[keep].astype(np.int32)
+        self.expend["COST"] = pd.to_numeric(self.expend["COST"], errors='coerce').fillna(0).astype(np.float64)
+        self.weights = family[oe_bls_cex_pumd_wtrep].to_numpy(dtype=np.float64)
+
+    def __len__(self):
+        return len(self.expend)
+
+    def decode(self, keys):
+        """
+        Decodes the NEWID and UCC codes of family and expend, see oe_bls_cex_pumd_decode.
+
+        :return self
+        """
+        self.family = oe_bls_cex_pumd_decode(self.family, keys)
+        self.expend = oe_bls_cex_pumd_decode(self.expend, keys)
+        return self
 
+    def rcost(self, i=None):
+        """
+        Returns the weighted costs of every expenditure row: a (rows x 45) array,
+        or with i, the array of RCOST<i> (1 to 45).
+        """
+        cu = self.expend["cu"].to_numpy()
+        cost = self.expend["COST"].to_numpy()
+        if i is None:
+            return self.weights[cu] * cost[:, None]
+        return self.weights[cu, i-1] * cost
 
-def oe_bls_cex_pumd_flag_NAs(row,flagged,flagcol):
+    def sum(self, by):
+        """
+        Sums RCOST1-RCOST45 by columns of expend (UCC eg) and/or family.  Costs are
+        first summed per group and CU, then multiplied by each CU's weights, so no
+        (rows x 45) array is built.
+
+        :param  by:  a list of column names
+        :return a dataframe indexed by the by columns with RCOST1-RCOST45
+        """
+        by = list(by)
+        keys = pd.DataFrame({c: (self.expend[c] if c in self.expend.columns
+                                 else self.family[c].to_numpy()[self.expend["cu"].to_numpy()])
+                             for c in by}, index=self.expend.index)
+        groupcodes, groups = pd.MultiIndex.from_frame(keys.astype(object)).factorize()
+        groupcu = sparse.csr_matrix((self.expend["COST"].to_numpy(), (groupcodes, self.expend["cu"].to_numpy())),
+                                    shape=(len(groups), len(self.family)))
+        totals = groupcu @ self.weights
+        groups = pd.MultiIndex.from_tuples(list(groups), names=by) if len(by) > 1 else pd.Index([g[0] for g in groups], name=by[0])
+        return pd.DataFrame(totals, index=groups, columns=oe_bls_cex_pumd_rcost)
+
+    def to_frame(self, columns=None):
+        """
+        Returns the wide pubfile, as built by the 'wide' join.
+
+        :param  columns:  optionally, the family columns to include besides NEWID
+        """
+        family = self.family if columns is None else self.family[list(dict.fromkeys(['NEWID'] + list(columns)))]
+        expend = self.expend.drop(columns=["cu"])
+        if columns is not None:
+            # the RCOST columns need the weights even when they aren't requested
+            missing = [c for c in oe_bls_cex_pumd_wtrep if c not in family.columns]
+            family = pd.concat([family, self.family[missing]], axis=1)
+            pubfile = oe_bls_cex_pumd_pubfile(family, expend)
+            return pubfile.drop(columns=missing)
+        return oe_bls_cex_pumd_pubfile(family, expend)
+
+
+def oe_bls_cex_pumd_compile_rules(sumrules, keys=None):
+    """
+    Compiles the HG summarization rules into a sparse (UCC x summary variable)
+    matrix holding a 1 wherever a UCC is a descendant of the summary variable, 
+    at any depth.  Rolling up costs is then one sparse product instead of summing
+    level by level.
+
+    :param  sumrules: the rules dataframe from oe_bls_cex_pumd_interpret_meta, with
+                      name, level and rule (the list of children) columns
+    :param  keys:     optionally, the encoders from oe_bls_cex_keys_pipeline, which
+                      make uccs an int32 array of UCC codes
+
+    :return uccs:        the list of leaf UCCs, the matrix rows
+    :return aggregates:  the list of summary variable names, the matrix columns
+    :return matrix:      a scipy.sparse csr matrix of shape (len(uccs), len(aggregates))
+    """
+    children = dict(zip(sumrules["name"], sumrules["rule"]))
+    levels = dict(zip(sumrules["name"], sumrules["level"]))
+    aggregates = list(children.keys())
+    uccs = list(dict.fromkeys(c for name in aggregates for c in children[name] if c not in children))
+    uccindex = {u: i for i, u in enumerate(uccs)}
+
+    # Deepest rules first, so every child rule's leaves are known before its parent's
+    leaves = {}
+    for name in sorted(aggregates, key=lambda n: -levels[n]):
+        found = set()
+        for c in children[name]:
+            if c in children:
+                found |= leaves.get(c, set())
+            else:
+                found.add(uccindex[c])
+        leaves[name] = found
+
+    rows = np.fromiter((u for name in aggregates for u in leaves[name]), dtype=np.int64)
+    cols = np.repeat(np.arange(len(aggregates)), [len(leaves[name]) for name in aggregates])
+    matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(uccs), len(aggregates)))
+    if keys is not None:
+        uccs = keys["UCC"].encode(uccs)
+    return uccs, aggregates, matrix
+
+
+class PumdAccumulator:
+    """
+    Sums expenditure costs by CU and UCC into a sparse matrix, one dataframe of
+    expenditures at a time.  Its size depends on the number of CU and UCC pairs,
+    not on the number of expenditure rows added.  The matrix columns are int32
+    UCC codes, UCCs given as strings being coded by a private encoder, and are
+    decoded only by costs and rcost.  Expenditures without a UCC are dropped.
+
+    :param  newids:    the NEWIDs of the rows.  Expenditures of other NEWIDs are
+                       dropped, as with the inner join of the pubfile.
+    :param  sumrules:  the rules dataframe from oe_bls_cex_pumd_interpret_meta, 
+                       its compiled form from oe_bls_cex_pumd_compile_rules, or None
+    :param  keys:      optionally, the encoders of coded NEWIDs and UCCs, which are
+                       decoded in the costs and rcost returned
+    """
+
+    def __init__(self, newids, sumrules=None, keys=None):
+        self.keys = keys
+        self.ucckeys = KeyEncoder("UCC") if keys is None else keys["UCC"]
+        if sumrules is None:
+            self.compiled = ([], [], sparse.csr_matrix((0, 0)))
+        elif isinstance(sumrules, tuple):
+            self.compiled = sumrules
+        else:
+            self.compiled = oe_bls_cex_pumd_compile_rules(sumrules, keys)
+        self.newids = pd.Index(pd.unique(self._ids(newids)), name="NEWID")
+        # The HG UCCs come first, then any others in the order they are found.
+        # columns holds the UCC code of each column, and position the column of each code.
+        # Rules compiled with keys hold UCC codes, otherwise the HG's UCC strings
+        uccs = self.compiled[0]
+        self.columns = uccs if isinstance(uccs, np.ndarray) and (uccs.dtype == np.int32) else self.ucckeys.encode(uccs)
+        self.position = np.full(max(len(self.ucckeys), 1), -1, dtype=np.int64)
+        self.position[self.columns] = np.arange(len(self.columns))
+        self.matrix = sparse.csr_matrix((len(self.newids), len(self.columns)))
+        self.rows = 0
+
+    def _ids(self, newids):
+        # With keys, NEWIDs come coded, otherwise they are compared as strings
+        return np.asarray(newids).astype(np.int32) if self.keys is not None else np.asarray(newids).astype(str)
+
+    def _codes(self, uccs):
+        # With keys, UCCs come coded by oe_bls_cex_pumd_encode, otherwise they are raw
+        # keys of any dtype, coded as their strings by the private encoder
+        if self.keys is not None:
+            return np.asarray(uccs).astype(np.int32)
+        return self.ucckeys.encode(uccs)
+
+    def add(self, expend):
+        """
+        Adds a dataframe with NEWID, UCC and COST columns.
+        """
+        codes = self._codes(expend["UCC"])
+        if len(self.position) < len(self.ucckeys):
+            self.position = np.concatenate([self.position, np.full(len(self.ucckeys) - len(self.position), -1)])
+        # Codes seen for the first time get the next columns
+        found = pd.unique(codes[codes >= 0])
+        new = found[self.position[found] < 0]
+        self.position[new] = np.arange(len(self.columns), len(self.columns) + len(new))
+        self.columns = np.concatenate([self.columns, new])
+        colcodes = self.position[np.where(codes >= 0, codes, 0)]
+        rowcodes = self.newids.get_indexer(self._ids(expend["NEWID"]))
+        keep = (rowcodes >= 0) & (codes >= 0)
+        cost = pd.to_numeric(expend["COST"], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+
+        # duplicate (NEWID, UCC) pairs are summed as the matrix is built
+        shape = (len(self.newids), len(self.columns))
+        chunk = sparse.csr_matrix((cost[keep], (rowcodes[keep], colcodes[keep])), shape=shape)
+        self.matrix.resize(shape)
+        self.matrix = self.matrix + chunk
+        self.rows += len(expend)
+        return self
+
+    def costs(self, sparse_output=False):
+        """
+        Returns the costs by CU with the UCC columns followed by the summary variable
+        columns, as described for oe_bls_cex_pumd_summarize.
+        """
+        uccs, aggregates, matrix = self.compiled
+        rolled = self.matrix[:, :len(uccs)] @ matrix
+        costs = sparse.hstack([self.matrix, rolled], format='csr')
+        columns = pd.Index(list(self._uccs()) + list(aggregates))
+        newids = self._newids()
+        if sparse_output:
+            costs = costs.tocsc()
+            return pd.DataFrame({col: pd.arrays.SparseArray(costs[:, j].toarray().ravel(), fill_value=0.0)
+                                 for j, col in enumerate(columns)}, index=newids)
+        return pd.DataFrame(costs.toarray(), index=newids, columns=columns)
+
+    def _uccs(self):
+        # The UCCs of the columns as strings
+        return self.ucckeys.decode(self.columns)
+
+    def _newids(self):
+        # The NEWIDs of the rows as strings
+        if self.keys is None:
+            return self.newids
+        return pd.Index(self.keys["NEWID"].decode(self.newids.to_numpy()), dtype='str', name="NEWID")
+
+    def rcost(self, family):
+        """
+        Returns RCOST1-RCOST45 summed by UCC, the costs weighted by each CU's 45 weights.
+
+        :param  family:  a dataframe with NEWID and WTREP01-WTREP44, FINLWT21
+        """
+        positions = pd.Index(self._ids(family["NEWID"])).get_indexer(self.newids)
+        weights = np.zeros((len(self.newids), 45))
+        found = positions >= 0
+        weights[found] = family[oe_bls_cex_pumd_wtrep].to_numpy(dtype=np.float64)[positions[found]]
+        totals = self.matrix.T @ weights
+        return pd.DataFrame(totals, index=pd.Index(self._uccs(), name="UCC"), columns=oe_bls_cex_pumd_rcost)
+
+
+def oe_bls_cex_pumd_summarize(expend, sumrules, newids=None, sparse_output=False, keys=None):
+    """
+    Pivots expenditures to one row per CU and one column per UCC, then adds a
+    column for every HG summary variable.
+
+    :param  expend:         a dataframe with NEWID, UCC and COST columns
+    :param  sumrules:       the rules dataframe from oe_bls_cex_pumd_interpret_meta, 
+                            or its compiled form from oe_bls_cex_pumd_compile_rules
+    :param  newids:         optionally, the NEWIDs of the rows, so CUs without 
+                            expenditures are included
+    :param  sparse_output:  when True, the columns are pandas sparse arrays
+    :param  keys:           optionally, the encoders when NEWID and UCC are coded
+
+    :return a dataframe indexed by NEWID with the UCC columns followed by the summary 
+            variable columns.  UCCs found in expend but not in the HG are kept, after
+            the HG UCCs, and do not roll up.
+    """
+    if newids is None:
+        newids = expend["NEWID"]
+    return PumdAccumulator(newids, sumrules, keys).add(expend).costs(sparse_output)
+
+
+def oe_bls_cex_pumd_interpret_stream(pumd, vardict, year, sumrules, chunksize=100000, flags=None, metrics=None,
+                                     members=False, keys=None):
+    """
+    A streaming version of oe_bls_cex_pumd_interpret_data.  The family files are
+    read whole, but MTBI and EXPD are read in chunks of chunksize rows that are 
+    filtered, scaled and added to a PumdAccumulator, so memory is bounded by the
+    chunk size and the number of CU and UCC pairs rather than by the year's size.
+
+    :param  pumd:       a PumdStore, from oe_bls_cex_pumd_open_files(lazy=True)
+    :param  vardict:    the Variable Dictionary
+    :param  year:       a 4 digit year string
+    :param  sumrules:   the rules dataframe from oe_bls_cex_pumd_interpret_meta
+    :param  chunksize:  the number of MTBI or EXPD rows read at a time
+    :param  flags:      optionally, the precompiled flag pairs of a PumdMeta
+    :param  metrics:    optionally, a PipelineMetrics recording the interpret_stream stage
+    :param  members:    when True, the member features are added to family, otherwise
+                        the member files aren't read
+    :param  keys:       optionally, the encoders of NEWID and UCC, see oe_bls_cex_pumd_interpret_data
+
+    :return family:  as from oe_bls_cex_pumd_interpret_data
+    :return costs:   as from oe_bls_cex_pumd_interpret_data
+    :return rcost:   RCOST1-RCOST45 summed by UCC, as from the pubfile
+    """
+
+    log.info("Streaming PUMD for %s", year)
+
+    memi = pumd[year].get('memi') if members else None
+    memd = pumd[year].get('memd') if members else None
+    keys = oe_bls_cex_keys_pipeline(save=False) if keys is None else keys
+    fmli, fmld = [oe_bls_cex_pumd_encode(pumd[year][ftype], keys) for ftype in ('fmli', 'fmld')]
+    memi, memd = [None if df is None else oe_bls_cex_pumd_encode(df, keys) for df in (memi, memd)]
+    family, fmli, fmld = oe_bls_cex_pumd_family(fmli, fmld, vardict, year, flags, metrics, memi, memd)
+    with oe_bls_cex_metrics_stage(metrics, 'interpret_stream', year, 0) as stage:
+        accumulator = PumdAccumulator(family["NEWID"], sumrules, keys)
+
+        for ftype, columns in (('mtbi', oe_bls_cex_pumd_mtbicols), ('expd', oe_bls_cex_pumd_expdcols)):
+            dtypes = pumd.dtypes(year, ftype)
+            stage.bytes_read += sum(oe_bls_cex_pumd_source_size(source)
+                                    for source in oe_bls_cex_pumd_sources(year, ftype, pumd.pumddir))
+            for chunk in oe_bls_cex_pumd_iter_csv(year, ftype, pumd.pumddir, dtypes, columns, chunksize):
+                stage.rows_in += len(chunk)
+                if ftype == 'mtbi':
+                    chunk = oe_bls_cex_pumd_filter_mtbi(chunk, year)
+                else:
+                    chunk = oe_bls_cex_pumd_filter_expd(chunk)
+                accumulator.add(oe_bls_cex_pumd_encode(chunk[oe_bls_cex_pumd_expcols], keys))
+        costs = accumulator.costs()
+        stage.rows_out = len(costs)
+        rcost = accumulator.rcost(family)
+
+    return oe_bls_cex_pumd_decode(family, keys), costs, rcost
+
+
+# Flag codes and the value a flagged variable takes when its flag holds that code.
+# A: valid blank, B: invalid blank, C: don't know/refused.  Top/bottom coding rules
+# (T flags) can be added here as code -> replacement value.
+oe_bls_cex_pumd_flag_rules = {"A": np.nan, "B": np.nan, "C": np.nan}
+
+
+def oe_bls_cex_pumd_flag_pairs(vd, filename, columns=None):
+    """
+    Returns a dictionary of {variable: flag column} for a PUMD file type,
+    limited to the pairs where both columns are present.
+
+    :param  vd:        the PUMD Variable Dictionary
+    :param  filename:  the upper case file type, "FMLI" eg
+    :param  columns:   the columns of the dataframe the flags will be applied to,
+                       or None for every pair of the file type
+    """
+    candidates = vd.loc[vd["Flag name"].notna() & (vd["File"].astype(str).str.upper() == filename),
+                        ["Variable Name","Flag name"]].drop_duplicates()
+    pairs = dict(zip(candidates["Variable Name"], candidates["Flag name"]))
+    if columns is None:
+        return pairs
+    columns = set(columns)
+    return {v: f for v, f in pairs.items() if (v in columns) & (f in columns)}
+
+
+def oe_bls_cex_pumd_flag_NAs(df, flags, rules=None):
     """
     Process flag fields ensuring A,B,C are NAs
     Called by the oe_bls_cex_pumd_process_flags
-    Initially this is a simple rule, but this function provides a placeholder
-    for more complex use of the PUMD Variable Dictionary 
+
+    All flag columns are tested in one batched pass: the flag block is turned into
+    a single (rows x flags) array and each rule code becomes a boolean mask over it.
+
+    :param  df:     the dataframe holding the variables and their flag columns
+    :param  flags:  a dictionary of {variable: flag column}
+    :param  rules:  a dictionary of {flag code: replacement value}, defaults to
+                    oe_bls_cex_pumd_flag_rules
+
+    :return a dataframe of the cleaned variables, same index as df
     """
-    if row[flagcol] in ["A","B","C"]:
-        return np.NaN
-    else:
-        return row[flagged]
-    return None
+    if rules is None:
+        rules = oe_bls_cex_pumd_flag_rules
+    variables = list(flags.keys())
+    flagvalues = df[list(flags.values())].astype(object).to_numpy()
+    cleaned = {}
+    for code, replacement in rules.items():
+        mask = (flagvalues == code)
+        if not mask.any():
+            continue
+        for j, col in enumerate(variables):
+            if mask[:, j].any():
+                base = cleaned.get(col, df[col])
+                cleaned[col] = base.mask(mask[:, j], replacement)
+    return pd.DataFrame({col: cleaned.get(col, df[col]) for col in variables}, index=df.index)
 
 
-def oe_bls_cex_pumd_process_flags(df,filename,vd):
+def oe_bls_cex_pumd_process_flags(df,filename,vd,flags=None,metrics=None):
     """
     PUMD variables may be accompanied by a sister flag column that indicates
     how missing and top/bottom coded values should be handled.
     This function applies flag rules to a dataframe then drops the flag columns.
+
+    :param  flags:  optionally, a precomputed {variable: flag column} dictionary, like
+                    PumdMeta.flags[filename].  Pairs missing from df are skipped.
+    :param  metrics: optionally, a PipelineMetrics recording a process_flags_<filename> stage
     """
-    print("Processing flags for",filename)
-    flags = {}
-    flag_candidates = vd[["Variable Name","Flag name"]][~vd["Flag name"].isna()][vd["File"] == filename].drop_duplicates()
-    for i,r in flag_candidates.iterrows():
-        if (r["Variable Name"] in df.columns) & (r["Flag name"] in df.columns):
-            flags[r["Variable Name"]] = r["Flag name"]
-    for col in flags.keys():
-        print("    ",col,"flagged by",flags[col])
-        df[col[:-1]] = df.apply(lambda row: oe_bls_cex_pumd_flag_NAs(row,col,flags[col]), axis=1)
-    df.drop([c for c in flags.values()], axis=1, inplace=True)
+    log.info("Processing flags for %s", filename)
+    year = str(df["year"].iloc[0]) if ("year" in df.columns) and (len(df) > 0) else None
+    with oe_bls_cex_metrics_stage(metrics, 'process_flags_'+filename, year, len(df)) as stage:
+        if flags is None:
+            flags = oe_bls_cex_pumd_flag_pairs(vd, filename, df.columns)
+        else:
+            flags = {v: f for v, f in flags.items() if (v in df.columns) & (f in df.columns)}
+        for col in flags.keys():
+            log.debug("    %s flagged by %s", col, flags[col])
+        if len(flags) > 0:
+            cleaned = oe_bls_cex_pumd_flag_NAs(df, flags)
+            # the cleaned values are stored without the variable's last character, as before
+            cleaned.columns = [col[:-1] for col in cleaned.columns]
+            for col in cleaned.columns:
+                df[col] = cleaned[col]
+        df.drop([c for c in flags.values()], axis=1, inplace=True)
+        stage.rows_out = len(df)
     return df
 
 
-def oe_bls_cex_pumd_interpret_meta(hg,vd,cd,year):
+# Compiled rules by a hash of the HG rows, so each HG year is compiled once per session
+oe_bls_cex_pumd_hg_compiled = {}
 
-    print("Narrowing metadata to", year)
-    
-    # Interpret the Hierarchical Grouping
-    h = hg[year]
-    
-    # Generate the summarization rules from HG
-    h["level"] = h["level"].astype(int)
+
+def oe_bls_cex_pumd_hg_rules(h):
+    """
+    Compiles a year's Hierarchical Grouping into the summarization rules.  Each
+    row's parent is the closest preceding row one level up, which is found for
+    all rows of a level at once with a forward fill.
+
+    :param  h:  a year of the HG from oe_bls_cex_pumd_read_hg
+    :return a dataframe of each summary variable name, level and list of children,
+            deepest levels first
+    """
+    level = h["level"].astype(int).to_numpy()
+    ucc = h["ucc"].to_numpy()
+    key = hashlib.sha1(np.ascontiguousarray(level).tobytes() + "|".join(map(str, ucc)).encode('utf-8')).hexdigest()
+    if key in oe_bls_cex_pumd_hg_compiled:
+        return oe_bls_cex_pumd_hg_compiled[key].copy()
+
+    position = np.arange(len(h))
+    parent = np.full(len(h), -1)
+    for k in range(1, 9):
+        anchor = pd.Series(np.where(level == k, position, np.nan)).ffill().to_numpy()
+        child = (level == k+1) & ~np.isnan(anchor)
+        parent[child] = anchor[child].astype(int)
+
+    haschild = parent >= 0
+    children = pd.Series(ucc[haschild]).groupby(parent[haschild], sort=False).agg(list)
+
+    # Rules are listed deepest first.  A name used by several rows keeps the
+    # children of the last of them, in that order.
     sumdict = {}
     sumrules = {}
-    for level in [9,8,7,6,5,4,3,2]:
-        for i,g in h[h.level.isin([level, level-1])].iterrows():        
-            if g.level == level-1:
-                rule = g.ucc
-                sumdict[rule] = level-1
-                sumrules[rule] = []
-            else:
-                sumrules[rule].append(g.ucc)
+    rows = position[(level >= 1) & (level <= 8)]
+    for i in rows[np.argsort(-level[rows], kind='stable')]:
+        sumdict[ucc[i]] = level[i]
+        sumrules[ucc[i]] = children.get(i, [])
+    names = [n for n in sumdict if len(sumrules[n]) > 0]
+
+    r = pd.DataFrame.from_dict({'name':  names,
+                                'level': [sumdict[n] for n in names],
+                                'rule':  [sumrules[n] for n in names]})
+    oe_bls_cex_pumd_hg_compiled[key] = r
+    return r.copy()
+
+
+def oe_bls_cex_pumd_in_year(d, year):
+    """
+    Selects the dictionary rows in effect in a year.  A missing Last year means
+    the row is still in effect, so the selection doesn't depend on today's date.
+    """
+    return d[(int(year) >= d["First year"]) & (d["Last year"].isna() | (int(year) <= d["Last year"]))]
+
+
+class PumdMeta:
+    """
+    The compiled metadata of a year, built once by oe_bls_cex_pumd_compile_meta
+    and stored by oe_bls_cex_pumd_load_meta so later runs skip the work.
+
+    :attr  year:      the 4 digit year string
+    :attr  hg:        the year's Hierarchical Grouping
+    :attr  sumrules:  the summarization rules from oe_bls_cex_pumd_hg_rules
+    :attr  vardict:   the Variable Dictionary rows in effect in the year
+    :attr  codedict:  the Code Dictionary rows in effect in the year
+    :attr  flags:     {FILE: {variable: flag column}}, by upper case file type
+    :attr  dtypes:    {filetype: {column: dtype}}, from oe_bls_cex_pumd_dtypes
+    :attr  codes:     {(FILE, variable): (sorted code values, descriptions)} as arrays
+    """
+
+    def __init__(self, year, hg, sumrules, vardict, codedict):
+        self.year = year
+        self.hg = hg
+        self.sumrules = sumrules
+        self.vardict = vardict
+        self.codedict = codedict
+        self.flags = {filename: oe_bls_cex_pumd_flag_pairs(vardict, filename)
+                      for filename in vardict["File"].dropna().astype(str).str.upper().unique()}
+        self.dtypes = {t: oe_bls_cex_pumd_dtypes(vardict, codedict, t) for t in oe_bls_cex_pumd_filetypes}
+        self.codes = {}
+        if "Code value" in codedict.columns:
+            described = "Code description" in codedict.columns
+            c = codedict.assign(key=codedict["Code value"].astype(str),
+                                label=codedict["Code description"].astype(str) if described else "")
+            c = c.drop_duplicates(["File","Variable","key"], keep='last').sort_values("key", kind='stable')
+            for (f, var), group in c.groupby([c["File"].astype(str).str.upper(), c["Variable"].astype(str)], sort=False):
+                self.codes[(f, var)] = (group["key"].to_numpy(dtype=str), group["label"].to_numpy(dtype=object))
 
-    emptyrules = [r for r in sumrules.keys() if len(sumrules[r]) == 0]
-    for rule in emptyrules:
-        sumrules.pop(rule)
-        sumdict.pop(rule)
+    def decode(self, filename, variable, values):
+        """
+        Looks up the descriptions of coded values by binary search.
+
+        :param  filename:  the upper case file type, "FMLI" eg
+        :param  variable:  the coded variable
+        :param  values:    an array or series of code values
+        :return an array of descriptions, None where a value isn't a code
+        """
+        keys, labels = self.codes[(filename, variable)]
+        values = pd.Series(values).astype(str).to_numpy(dtype=str)
+        if len(keys) == 0:
+            return np.full(len(values), None, dtype=object)
+        position = np.searchsorted(keys, values).clip(0, len(keys) - 1)
+        return np.where(keys[position] == values, labels[position], None)
+
+
+def oe_bls_cex_pumd_compile_meta(h, vd, cd, year):
+    """
+    Compiles a year's metadata from its HG and the full dictionaries.
+
+    :param  h:     the year's HG from oe_bls_cex_pumd_read_hg
+    :param  vd:    the Variable Dictionary
+    :param  cd:    the Code Dictionary
+    :param  year:  a 4 digit year string
+
+    :return a PumdMeta
+    """
+    h = h.copy()
+    h["level"] = h["level"].astype(int)
+    r = oe_bls_cex_pumd_hg_rules(h)
 
     # Test the rules
-    for rule in sumrules.keys():
-        if (len(sumrules[rule]) > 0) & (rule.isnumeric()):
-            print('invalid rule',rule,': members but numeric')
-        if (len(sumrules[rule]) == 0) & (not rule.isnumeric()):
-            print('invalid rule',rule,': no members but not numeric')
-    # the rule level is needed so they can be applied bottom up
-    r = pd.DataFrame.from_dict({'name':  list(sumdict.keys()),
-                                'level': [sumdict[r] for r in sumdict.keys()],
-                                'rule':  [sumrules[r] for r in sumdict.keys()]})    
-    
-    # Interpret the Var Dictionary
-    vd["Last year"] = vd["Last year"].fillna(datetime.now().year)
-    v = vd[(int(year) >= vd["First year"] ) & (int(year) <= vd["Last year"] )]
-    
-    # Interpret the Code Dictionary
-    cd["Last year"] = cd["Last year"].fillna(datetime.now().year)
-    c = cd[(int(year) >= cd["First year"] ) & (int(year) <= cd["Last year"] )]
-    
-    return h,r,v,c
+    for rule, members in zip(r["name"], r["rule"]):
+        if (len(members) > 0) & (rule.isnumeric()):
+            log.warning('invalid rule %s: members but numeric', rule)
+
+    return PumdMeta(year, h, r, oe_bls_cex_pumd_in_year(vd, year), oe_bls_cex_pumd_in_year(cd, year))
 
 
-def oe_bls_cex_pumd_write(df, year):
+# Changing this invalidates the stored metadata, for when PumdMeta changes
+oe_bls_cex_pumd_meta_version = '1'
+
+# Loaded metadata by year and source signature, so each year is loaded once per session
+oe_bls_cex_pumd_meta_loaded = {}
+
+
+def oe_bls_cex_pumd_load_meta(year, pumddir = './pumd/', cachedir = None, metrics = None):
     """
-    This function writes a final dataframe to file.
+    Returns a year's compiled metadata.  With a cachedir it is compiled once,
+    stored as a pickle and reloaded until the dictionary or HG change.
+
+    :return a PumdMeta
+    """
+    dictionary = os.path.join(pumddir, 'ce_pumd_interview_diary_dictionary.xlsx')
+    hgsource = oe_bls_cex_pumd_hg_source(year, pumddir)
+    sources = [dictionary, hgsource[0]]
+    variant = oe_bls_cex_pumd_meta_version + '|' + (hgsource[1] or '')
+    key = oe_bls_cex_cache_key(sources, variant)
+
+    def build():
+        log.info("Compiling metadata for %s", year)
+        vardict, codedict = oe_bls_cex_pumd_read_dictionary(pumddir, cachedir)
+        return oe_bls_cex_pumd_compile_meta(oe_bls_cex_pumd_read_hg(year, pumddir, cachedir), vardict, codedict, year)
+
+    with oe_bls_cex_metrics_stage(metrics, 'interpret_meta', year):
+        if key not in oe_bls_cex_pumd_meta_loaded:
+            oe_bls_cex_pumd_meta_loaded[key] = oe_bls_cex_cache_object('meta-'+year, sources, build, cachedir, variant)
+    return oe_bls_cex_pumd_meta_loaded[key]
+
+
+def oe_bls_cex_pumd_interpret_meta(hg,vd,cd,year,metrics=None):
+    """
+    Narrows the metadata to a year.  See oe_bls_cex_pumd_load_meta for the
+    stored version.
+
+    :return h, sumrules, v, c: the year's HG, summarization rules, Variable and Code Dictionary rows
     """
-    print("Writing to "+year+" blockgroupspending file")
-    df.to_csv(year+'blockgroupspending.csv', index=False)
-    return None
+
+    log.info("Narrowing metadata to %s", year)
+    with oe_bls_cex_metrics_stage(metrics, 'interpret_meta', year, len(vd) + len(cd)) as stage:
+        meta = oe_bls_cex_pumd_compile_meta(hg[year], vd, cd, year)
+        stage.rows_out = len(meta.vardict) + len(meta.codedict)
+    return meta.hg, meta.sumrules, meta.vardict, meta.codedict
+
+
+def oe_bls_cex_pumd_process_year(year, pumddir = './pumd/', cachedir = None, typed = True, metrics = None,
+                                 save_keys = True):
+    """
+    Opens and interprets a single year, reading only the file types it uses.
+    This is the unit of work for oe_bls_cex_pumd_process_years.
+
+    :param  metrics:    optionally, a PipelineMetrics recording the year's stages
+    :param  save_keys:  when True, the NEWID and UCC codes are stored in the cachedir,
+                        see oe_bls_cex_keys.  Worker processes don't store them.
+
+    :return sumrules, family, costs
+    """
+    # The year's metadata is compiled once and reloaded from the cache on later runs
+    meta = oe_bls_cex_pumd_load_meta(year, pumddir, cachedir, metrics)
+    pumd = PumdStore([year], pumddir, cachedir, typed = typed, meta = {year: meta}, metrics = metrics)
+    keys = oe_bls_cex_keys_pipeline(cachedir, meta.hg, save = save_keys)
+    pubfile, family, expend, fmli, fmld, mtbi, expd, costs = \
+        oe_bls_cex_pumd_interpret_data(pumd, meta.vardict, year, meta.sumrules, flags = meta.flags, metrics = metrics,
+                                       members = True, keys = keys, summarize = True)
+    if save_keys:
+        for encoder in keys.values():
+            encoder.save()
+    return meta.sumrules, family, costs
+
+
+def _process_year_measured(year, pumddir, cachedir, typed, trace_memory):
+    # A worker process records into its own metrics, returned with the result
+    metrics = PipelineMetrics(trace_memory)
+    return oe_bls_cex_pumd_process_year(year, pumddir, cachedir, typed, metrics, save_keys=False), metrics.records
+
+
+def oe_bls_cex_pumd_process_years(years, pumddir = './pumd/', cachedir = None, typed = True, workers = 1,
+                                  metrics = None):
+    """
+    Runs oe_bls_cex_pumd_process_year for each year, across a pool of worker
+    processes when workers > 1.  Results are returned in the order of years
+    regardless of which worker finishes first.
+
+    :param  years:    a list of 4 digit years that are strings     ['2018','2019','2020'] 
+    :param  workers:  the number of worker processes
+    :param  metrics:  optionally, a PipelineMetrics collecting the stages of every year,
+                      the workers' included
+
+    :return a dictionary of {year: (sumrules, family, costs)}
+    """
+    if workers <= 1:
+        return {yr: oe_bls_cex_pumd_process_year(yr, pumddir, cachedir, typed, metrics) for yr in years}
+    if cachedir is not None:
+        # The dictionary is cached once here, so the workers only read it
+        oe_bls_cex_pumd_read_dictionary(pumddir, cachedir)
+        # The UCCs of every year are coded and stored before the workers start, so they all share the codes
+        for yr in years:
+            oe_bls_cex_keys_pipeline(cachedir, oe_bls_cex_pumd_read_hg(yr, pumddir, cachedir))
+    if metrics is None:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {yr: pool.submit(oe_bls_cex_pumd_process_year, yr, pumddir, cachedir, typed, None, False)
+                       for yr in years}
+            return {yr: futures[yr].result() for yr in years}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {yr: pool.submit(_process_year_measured, yr, pumddir, cachedir, typed, metrics.trace_memory)
+                   for yr in years}
+        results = {}
+        for yr in years:
+            results[yr], records = futures[yr].result()
+            metrics.extend(records)
+        return results
+
+
+def oe_bls_cex_pumd_write(df, year, outdir = '.', name = 'blockgroupspending', format = 'parquet',
+                          partition_cols = None, compression = 'snappy', metrics = None):
+    """
+    This function writes a final dataframe to outdir, as a Parquet dataset partitioned
+    by year and source or as <year><name>.csv.  See oe_bls_cex_output_write.
+
+    :param  partition_cols:  the Parquet partition columns under the year, ['source'] by default
+    :param  metrics:  optionally, a PipelineMetrics recording a write_<name> stage
+
+    :return the path written
+    """
+    partition_cols = ['source'] if partition_cols is None else partition_cols
+    with oe_bls_cex_metrics_stage(metrics, 'write_'+name, year, len(df)) as stage:
+        path = oe_bls_cex_output_write(df, year, outdir, name, format, partition_cols, compression)
+        stage.rows_out = len(df)
+    return path
 
 
 if __name__ == "__main__":
@@ -357,18 +1634,24 @@ if __name__ == "__main__":
     # Capitalized variables are globals or multi-year storage
     # Lowercase variables are those for a given working year
     
+    from oe_bls_cex_build import oe_bls_cex_build_pumd
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
     CEXURL = 'https://www.bls.gov/cex/'
     PUMDDIR = "D:\\Open Environments\\data\\bls\\cex\\pumd\\"
+    CACHEDIR = os.path.join(PUMDDIR, "cache")
+    OUTDIR = os.path.join(PUMDDIR, "output")
     YEARS = ['2018'] #['2016','2017','2018','2019','2020']
+    WORKERS = 1  # more than 1 processes the years in parallel
     
-    oe_bls_cex_pumd_download(YEARS, pumddir = PUMDDIR, cexurl=CEXURL)
+    METRICS = PipelineMetrics()
     
-    PUMD, HG, VARDICT, CODEDICT = oe_bls_cex_pumd_open_files(YEARS, pumddir = PUMDDIR)
+    oe_bls_cex_pumd_download(YEARS, pumddir = PUMDDIR, cexurl=CEXURL, metrics = METRICS)
     
-    for yr in YEARS: 
-        hg, sumrules, vardict, codedict    = oe_bls_cex_pumd_interpret_meta(HG,VARDICT,CODEDICT,yr)
-        pubfile, family, expend, fmli, fmld, mtbi, expd  = \
-            oe_bls_cex_pumd_interpret_data(PUMD,VARDICT,yr,sumrules)
-        oe_bls_cex_pumd_write(family,yr)
+    # Only the years whose source files, dictionary or HG changed since the last run are rebuilt
+    oe_bls_cex_build_pumd(YEARS, pumddir = PUMDDIR, outdir = OUTDIR, cachedir = CACHEDIR, workers = WORKERS,
+                          metrics = METRICS, report = os.path.join(OUTDIR, "run.json"))
+    print(METRICS.summary())
 
     print("Done")
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local first reference data.  The curated CSVs that ship with this package are
+read from the package folder once per process, and the BLS tables fetched from
+the web are kept in a reference folder on disk, so repeated calls are in memory
+lookups and batch runs need no network once the folder is filled.
+
+    oe_bls_cex_reference_csv          - a packaged CSV, CEXVariables.csv eg
+    oe_bls_cex_reference_cexvariables - the map from report titles to CEX variable names
+    oe_bls_cex_reference_msacodes     - the map from MSA names to BLS CPI area codes
+    oe_bls_cex_reference_crosswalk    - the CPI areas' state and county definitions
+    oe_bls_cex_reference_fetch        - the local path of a remote file, downloaded on first use
+    oe_bls_cex_reference_table        - a remote BLS report sheet, read through the local copy
+    oe_bls_cex_reference_counties     - the Census county names and FIPS codes, read through the local copy
+
+A refresh downloads a remote file again, replacing the local copy.  The folder
+can be filled on a connected machine and copied to one without network access.
+"""
+
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+import pandas as pd
+from oe_bls_cex_download import oe_bls_cex_download_file
+from oe_bls_cex_tables import oe_bls_cex_tables_read
+
+oe_bls_cex_reference_packagedir = os.path.dirname(os.path.abspath(__file__))
+
+# The Census list of counties with their state and county FIPS codes
+oe_bls_cex_reference_countyurl = 'https://www2.census.gov/geo/docs/reference/codes/files/national_county.txt'
+
+# Parsed remote tables by path, modification time and read options
+oe_bls_cex_reference_tables = {}
+
+
+@lru_cache(maxsize=None)
+def _packaged(name, dtype):
+    # The packaged CSVs are saved from Excel with a byte order mark
+    return pd.read_csv(os.path.join(oe_bls_cex_reference_packagedir, name), encoding='utf-8-sig', dtype=dtype)
+
+
+def oe_bls_cex_reference_csv(name, dtype=None):
+    """
+    :param  name:   the file name of a CSV in the package folder, "MSACodes.csv" eg
+    :param  dtype:  optionally, a single dtype for every column, str eg
+    :return a copy of the table, read from disk on the first call only
+    """
+    return _packaged(name, dtype).copy()
+
+
+def oe_bls_cex_reference_cexvariables():
+    """
+    :return CEXVariables.csv, with HGLevel, ReportTitle, Var and Notes
+    """
+    return oe_bls_cex_reference_csv("CEXVariables.csv")
+
+
+def oe_bls_cex_reference_msacodes():
+    """
+    :return MSACodes.csv, with CPI Area, OMB MSA 1, Short and Long
+    """
+    return oe_bls_cex_reference_csv("MSACodes.csv")
+
+
+def oe_bls_cex_reference_crosswalk():
+    """
+    :return PSUCountyCrosswalk.csv, with MSA Code, MSA Name, MSA Definition (State and County)
+            and MSA Population.  An area's states after the first are on continuation
+            rows without a code.
+    """
+    return oe_bls_cex_reference_csv("PSUCountyCrosswalk.csv", dtype=str)
+
+
+def oe_bls_cex_reference_fetch(url, refdir='./reference/', refresh=False):
+    """
+    Returns the local copy of a remote file, downloading it only when it is
+    missing or a refresh is requested.
+
+    :param  url:      the URL of the file
+    :param  refdir:   the reference folder
+    :param  refresh:  when True, the file is downloaded again
+
+    :return the local path
+    """
+    path = os.path.join(refdir, url.rstrip('/').split('/')[-1])
+    if not os.path.exists(path):
+        return oe_bls_cex_download_file(url, refdir)
+    if not refresh:
+        return path
+    # The new copy is downloaded beside the old one and replaces it only once
+    # complete, so a failed refresh keeps the old copy
+    tmpdir = tempfile.mkdtemp(prefix='.refresh', dir=refdir)
+    try:
+        os.replace(oe_bls_cex_download_file(url, tmpdir), path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return path
+
+
+def oe_bls_cex_reference_table(url, refdir='./reference/', refresh=False, skiprows=2, dtype=None):
+    """
+    Reads a BLS report sheet through its local copy.  The parsed sheet is kept
+    in memory until the local file changes.
+
+    :param  url:      the URL of the .xlsx report
+    :param  refdir:   the reference folder
+    :param  refresh:  when True, the report is downloaded again
+    :param  skiprows: the number of title rows above the column headers
+    :param  dtype:    optionally, the dtype passed to read_excel
+
+    :return a copy of the sheet, from oe_bls_cex_tables_read
+    """
+    path = oe_bls_cex_reference_fetch(url, refdir, refresh)
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns, skiprows, str(dtype))
+    if key not in oe_bls_cex_reference_tables:
+        oe_bls_cex_reference_tables[key] = oe_bls_cex_tables_read(path, skiprows, dtype)
+    return oe_bls_cex_reference_tables[key].copy()
+
+
+def oe_bls_cex_reference_counties(refdir='./reference/', refresh=False, url=oe_bls_cex_reference_countyurl):
+    """
+    Reads the Census county list through its local copy, kept in memory until
+    the local file changes.
+
+    :param  refdir:   the reference folder
+    :param  refresh:  when True, the list is downloaded again
+    :param  url:      the URL of the headerless STATE,STATEFP,COUNTYFP,COUNTYNAME,CLASSFP file
+
+    :return a copy of the list, all columns strings
+    """
+    path = oe_bls_cex_reference_fetch(url, refdir, refresh)
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns, 'counties')
+    if key not in oe_bls_cex_reference_tables:
+        # The file is Latin-1, "Doña Ana County" eg
+        oe_bls_cex_reference_tables[key] = pd.read_csv(path, header=None, dtype=str, encoding='latin-1',
+                                                       names=["STATE", "STATEFP", "COUNTYFP", "COUNTYNAME", "CLASSFP"])
+    return oe_bls_cex_reference_tables[key].copy()
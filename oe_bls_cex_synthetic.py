@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic PUMD files for benchmarks and offline runs.  The generator writes the
+same layout oe_bls_cex_pumd_download leaves in a pumddir, so every reader in
+oe_bls_cex_pumd works on it unchanged:
+
+    diaryYY.zip      diaryYY/fmldYYQ.csv and expdYYQ.csv for the 4 quarters
+    diaryYY.zip      diaryYY/memdYYQ.csv, the Diary members
+    intrvwYY.zip     intrvwYY/fmliYYQ.csv and mtbiYYQ.csv for quarters 1x, 2, 3, 4 and the next year's 1
+    intrvwYY.zip     intrvwYY/memiYYQ.csv, the Interview members
+    stubs.zip        stubs/CE-HG-Integ-YYYY.txt, the fixed width Hierarchical Grouping
+    ce_pumd_interview_diary_dictionary.xlsx   the Variables and Codes sheets
+
+    oe_bls_cex_synthetic_pumd      - writes a synthetic pumddir at a given number of expenditure rows
+    oe_bls_cex_synthetic_hg        - the HG stub file text for a list of UCCs
+
+The values are random but shaped like the real files: 45 replicate weights,
+flagged variables with A/B/C/D/T flag codes, quoted character variables such as
+PSU, UCC and the "01" to "12" QINTRVMO, interview months that straddle the
+year, expenditures with reference years and publication flags, and an HG with
+wrapped titles.  A generated folder records its parameters in synthetic.json
+and is reused when asked for again with the same ones.
+"""
+
+import os
+import io
+import csv
+import json
+import zipfile
+import logging
+import pandas as pd
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Changing this regenerates existing synthetic folders
+oe_bls_cex_synthetic_version = '3'
+
+_wtrep = [("WTREP"+str(i+1).zfill(2)) for i in range(44)] + ["FINLWT21"]
+
+
+def _flagged(nflagged):
+    # Variable and flag column names, following the PUMD's FINCBTAX/FINCBTA_ pattern
+    return [("VAR"+str(i).zfill(3)+"X", "VAR"+str(i).zfill(3)+"_") for i in range(nflagged)]
+
+
+def _family(newids, rng, nflagged, interview, year, quarter):
+    n = len(newids)
+    df = pd.DataFrame({"NEWID": newids})
+    if interview:
+        if quarter == '1x':
+            months, intrvyr = [1, 2, 3], int(year)
+        elif quarter == 'next':
+            months, intrvyr = [1, 2, 3], int(year) + 1
+        else:
+            months, intrvyr = [3*int(quarter)-2, 3*int(quarter)-1, 3*int(quarter)], int(year)
+        # A character variable, "01" to "12"
+        df["QINTRVMO"] = np.char.zfill(rng.choice(months, n).astype(str), 2)
+        df["QINTRVYR"] = intrvyr
+    df["AGE_REF"] = rng.integers(18, 90, n)
+    df["FAM_SIZE"] = rng.integers(1, 8, n)
+    df["REGION"] = rng.choice([1, 2, 3, 4], n)
+    df["PSU"] = rng.choice(["S11A", "S12A", "S23A", "S35E", "S49A", ""], n)
+    for var, flag in _flagged(nflagged):
+        df[flag] = rng.choice(["A", "B", "C", "D", "T"], n, p=[0.1, 0.05, 0.05, 0.75, 0.05])
+        df[var] = np.where(np.isin(df[flag], ["A", "B", "C"]), 0, rng.integers(0, 200000, n))
+    weights = rng.uniform(1000, 40000, (n, len(_wtrep))).round(2)
+    df = pd.concat([df, pd.DataFrame(weights, columns=_wtrep)], axis=1)
+    return df
+
+
+def _expenditures(newids, uccs, rng, n, interview, year):
+    df = pd.DataFrame({"NEWID": rng.choice(newids, n), "UCC": rng.choice(uccs, n),
+                       "COST": rng.gamma(1.5, 60.0 if interview else 8.0, n).round(2)})
+    if interview:
+        df["REF_MO"] = rng.integers(1, 13, n)
+        df["REF_YR"] = rng.choice([int(year) - 1, int(year)], n, p=[0.2, 0.8])
+        df["PUBFLAG"] = rng.choice([1, 2], n, p=[0.1, 0.9])
+        df["GIFT"] = rng.choice([1, 2], n, p=[0.05, 0.95])
+    else:
+        df["ALLOC"] = rng.choice([0, 1, 2], n, p=[0.9, 0.05, 0.05])
+        df["GIFT"] = rng.choice([1, 2], n, p=[0.05, 0.95])
+        df["PUB_FLAG"] = rng.choice([1, 2], n, p=[0.1, 0.9])
+    return df
+
+
+def _members(newids, rng, interview):
+    # 1 to 6 members per CU, the first being the reference person
+    size = rng.integers(1, 7, len(newids))
+    n = int(size.sum())
+    membno = np.arange(n) - np.repeat(np.cumsum(size) - size, size) + 1
+    age = np.where(membno == 1, rng.integers(18, 90, n), rng.integers(0, 90, n))
+    earner = np.where((age >= 16) & (rng.random(n) < 0.6), 1, 2)
+    df = pd.DataFrame({"NEWID": np.repeat(newids, size), "MEMBNO": membno, "AGE": age,
+                       "SEX": rng.choice([1, 2], n), "EARNER": earner})
+    df["SALARYX" if interview else "WAGEX"] = np.where(earner == 1, rng.integers(1000, 150000, n), 0)
+    return df
+
+
+def _write_csv(zf, member, frames):
+    # Each frame is a chunk of the same file, written under one header
+    with zf.open(member, 'w', force_zip64=True) as raw:
+        with io.TextIOWrapper(raw, encoding='utf-8', newline='') as f:
+            for i, df in enumerate(frames):
+                if i == 0:
+                    f.write(",".join(df.columns) + "\n")
+                # As in the real files, the character variables are quoted and the numbers
+                # aren't.  The costs and weights are already rounded to cents.
+                df.to_csv(f, index=False, header=False, quoting=csv.QUOTE_NONNUMERIC)
+
+
+def _split(total, parts):
+    return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+
+def oe_bls_cex_synthetic_hg(uccs, groups=12, seed=0):
+    """
+    Builds an Integrated HG stub file over the UCCs: a total at level 1, groups at
+    level 2, subgroups at level 3 and the UCCs at level 4.  Every fifth group has
+    a title that wraps onto a linenum 2 row.
+
+    :return the text of the stub file
+    """
+    rng = np.random.default_rng(seed)
+
+    def row(linenum, level, title, ucc='', survey='', factor='', group=''):
+        return (str(linenum).ljust(3) + str(level).ljust(3) + title[:63].ljust(63) + ucc.ljust(6) + ''.ljust(7)
+                + survey.ljust(3) + factor.ljust(3) + group.ljust(7)).rstrip()
+
+    # Summary names fit the 6 character ucc column, and aren't numbers so they never clash with a UCC
+    lines = [row(1, 1, 'Average annual expenditures', 'TOTEXP', 'T', '', 'EXPEND')]
+    for g, guccs in enumerate(np.array_split(np.array(uccs), groups)):
+        title = 'Synthetic group ' + str(g)
+        if g % 5 == 0:
+            lines.append(row(1, 2, title + ' with a title long enough that it wraps over to a second', 'GRP'+str(g),
+                             'T', '', 'EXPEND'))
+            lines.append(row(2, '', 'line of the stub file'))
+        else:
+            lines.append(row(1, 2, title, 'GRP'+str(g), 'T', '', 'EXPEND'))
+        for s, succs in enumerate(np.array_split(guccs, 3)):
+            lines.append(row(1, 3, title + ' subgroup ' + str(s), 'S'+str(g)+'X'+str(s), 'T', '', 'EXPEND'))
+            for u in succs:
+                lines.append(row(1, 4, 'Item ' + u, u, str(rng.choice(['I', 'D', 'G'])), '1', 'FOOD'))
+    return "\n".join(lines) + "\n"
+
+
+def oe_bls_cex_synthetic_pumd(pumddir, years = ['2018'], rows = 10000, cus = None, uccs = 200,
+                              nflagged = 20, chunksize = 1000000, seed = 0, force = False):
+    """
+    Writes a synthetic pumddir.
+
+    :param  pumddir:    the folder to write, created if needed
+    :param  years:      a list of 4 digit years that are strings     ['2018','2019']
+    :param  rows:       the number of expenditure rows per year, 2/3 MTBI and 1/3 EXPD.
+                        10,000 to 10,000,000 covers test fixtures to full size years.
+    :param  cus:        the number of interview CUs per year, by default rows / 100 like
+                        the real files.  The diary has half as many.
+    :param  uccs:       the number of UCCs in the HG and the expenditures
+    :param  nflagged:   the number of flagged variables in the family files
+    :param  chunksize:  the number of rows generated at a time, which bounds memory
+    :param  seed:       the random seed, the same parameters always give the same files
+    :param  force:      when True, the files are written even if synthetic.json matches
+
+    :return pumddir
+    """
+    params = {"version": oe_bls_cex_synthetic_version, "years": list(years), "rows": rows, "cus": cus,
+              "uccs": uccs, "nflagged": nflagged, "seed": seed}
+    paramfile = os.path.join(pumddir, 'synthetic.json')
+    if (not force) and os.path.exists(paramfile):
+        with open(paramfile) as f:
+            if json.load(f) == params:
+                log.info("Reusing the synthetic PUMD in %s", pumddir)
+                return pumddir
+    os.makedirs(pumddir, exist_ok=True)
+    if os.path.exists(paramfile):
+        os.remove(paramfile)
+
+    rng = np.random.default_rng(seed)
+    cus = max(rows // 100, 20) if cus is None else cus
+    ucclist = [str(u) for u in rng.choice(np.arange(100000, 999999), uccs, replace=False)]
+    hgs = {}
+
+    for year in years:
+        yy = year[2:]
+        log.info("Writing a synthetic %s with %d expenditure rows", year, rows)
+        interview = {'1x': 1, '2': 2, '3': 3, '4': 4, 'next': 5}
+        with zipfile.ZipFile(os.path.join(pumddir, 'intrvw'+yy+'.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+            for (quarter, q), ncu, nexp in zip(interview.items(), _split(cus, 5), _split(rows * 2 // 3, 5)):
+                name = yy + '1x' if quarter == '1x' else (str(int(yy) + 1).zfill(2) + '1' if quarter == 'next'
+                                                          else yy + quarter)
+                newids = int(yy) * 10000000 + q * 1000000 + np.arange(ncu)
+                _write_csv(zf, 'intrvw'+yy+'/fmli'+name+'.csv', [_family(newids, rng, nflagged, True, year, quarter)])
+                _write_csv(zf, 'intrvw'+yy+'/memi'+name+'.csv', [_members(newids, rng, True)])
+                _write_csv(zf, 'intrvw'+yy+'/mtbi'+name+'.csv',
+                           (_expenditures(newids, ucclist, rng, n, True, year) for n in _split(nexp, -(-nexp // chunksize))))
+        with zipfile.ZipFile(os.path.join(pumddir, 'diary'+yy+'.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+            for q, ncu, nexp in zip(range(1, 5), _split(cus // 2, 4), _split(rows - rows * 2 // 3, 4)):
+                newids = int(yy) * 10000000 + 9000000 + q * 100000 + np.arange(ncu)
+                _write_csv(zf, 'diary'+yy+'/fmld'+yy+str(q)+'.csv', [_family(newids, rng, nflagged, False, year, q)])
+                _write_csv(zf, 'diary'+yy+'/memd'+yy+str(q)+'.csv', [_members(newids, rng, False)])
+                _write_csv(zf, 'diary'+yy+'/expd'+yy+str(q)+'.csv',
+                           (_expenditures(newids, ucclist, rng, n, False, year) for n in _split(nexp, -(-nexp // chunksize))))
+        hgs[year] = oe_bls_cex_synthetic_hg(ucclist, seed=seed)
+
+    with zipfile.ZipFile(os.path.join(pumddir, 'stubs.zip'), 'w', zipfile.ZIP_DEFLATED) as zf:
+        for year, text in hgs.items():
+            zf.writestr('stubs/CE-HG-Integ-'+year+'.txt', text)
+
+    variables = [("FMLI", c) for c in ["NEWID", "QINTRVMO", "QINTRVYR", "AGE_REF", "FAM_SIZE", "REGION", "PSU"] + _wtrep]
+    variables += [("FMLD", c) for c in ["NEWID", "AGE_REF", "FAM_SIZE", "REGION", "PSU"] + _wtrep]
+    variables += [("MTBI", c) for c in ["NEWID", "UCC", "COST", "REF_MO", "REF_YR", "PUBFLAG", "GIFT"]]
+    variables += [("EXPD", c) for c in ["NEWID", "UCC", "COST", "ALLOC", "GIFT", "PUB_FLAG"]]
+    variables += [("MEMI", c) for c in ["NEWID", "MEMBNO", "AGE", "SEX", "EARNER", "SALARYX"]]
+    variables += [("MEMD", c) for c in ["NEWID", "MEMBNO", "AGE", "SEX", "EARNER", "WAGEX"]]
+    vardict = pd.DataFrame(variables, columns=["File", "Variable Name"])
+    vardict["Flag name"] = None
+    flagrows = [(f, var, flag) for f in ("FMLI", "FMLD") for var, flag in _flagged(nflagged)]
+    vardict = pd.concat([vardict, pd.DataFrame(flagrows, columns=["File", "Variable Name", "Flag name"])],
+                        ignore_index=True)
+    vardict["First year"] = 2000
+    vardict["Last year"] = np.nan
+    codes = [("MTBI", "PUBFLAG", 1, "Do not publish"), ("MTBI", "PUBFLAG", 2, "Publish"),
+             ("EXPD", "PUB_FLAG", 1, "Do not publish"), ("EXPD", "PUB_FLAG", 2, "Publish"),
+             ("MTBI", "GIFT", 1, "Gift"), ("MTBI", "GIFT", 2, "Not a gift"),
+             ("EXPD", "GIFT", 1, "Gift"), ("EXPD", "GIFT", 2, "Not a gift")]
+    codes += [(f, "REGION", r, name) for f in ("FMLI", "FMLD")
+              for r, name in enumerate(["Northeast", "Midwest", "South", "West"], 1)]
+    codes += [(f, var, v, name) for f in ("MEMI", "MEMD")
+              for var, values in (("SEX", ["Male", "Female"]), ("EARNER", ["Earner", "Not an earner"]))
+              for v, name in enumerate(values, 1)]
+    codedict = pd.DataFrame(codes, columns=["File", "Variable", "Code value", "Code description"])
+    codedict["First year"] = 2000
+    codedict["Last year"] = np.nan
+    with pd.ExcelWriter(os.path.join(pumddir, 'ce_pumd_interview_diary_dictionary.xlsx')) as xl:
+        vardict.to_excel(xl, sheet_name='Variables', index=False)
+        codedict.to_excel(xl, sheet_name='Codes ', index=False)
+
+    with open(paramfile, 'w') as f:
+        json.dump(params, f)
+    return pumddir
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A parser for the published BLS CEX spreadsheets, shared by the MSA summary
+reports (oe_bls_cex_msa) and the national summary report (oe_bls_cex_totals).
+These sheets carry footnote marks, currency formatting and wrapped column
+headers, and the national report lists each Item's Mean on the row after its
+label.  Every step works on whole columns rather than row by row.
+
+    oe_bls_cex_tables_read           - reads a report sheet and flattens its column headers
+    oe_bls_cex_tables_clean_labels   - removes footnote marks and other text from labels
+    oe_bls_cex_tables_clean_values   - converts all value columns to numbers in one pass
+    oe_bls_cex_tables_means          - pairs each "Mean" row with the label on the row above
+    oe_bls_cex_tables_join           - joins report sheets on their labels with a single concat
+
+"""
+
+import re
+import pandas as pd
+import numpy as np
+
+# Text removed from values before they are converted to numbers
+oe_bls_cex_tables_value_marks = ['$', ',', 'b/ ']
+
+
+def oe_bls_cex_tables_columns(columns):
+    """
+    :return the column names with wrapped header lines joined, "Chicago-\\nNaperville" eg
+    """
+    return [str(c).replace('\n',' ').replace('- ','-') for c in columns]
+
+
+def oe_bls_cex_tables_read(source, skiprows=2, dtype=None):
+    """
+    Reads the first sheet of a BLS report, skipping its title rows.
+
+    :param  source:    a path or URL of the .xlsx file
+    :param  skiprows:  the number of title rows above the column headers
+    :param  dtype:     optionally, the dtype passed to read_excel
+
+    :return a dataframe with flattened column names
+    """
+    df = pd.read_excel(source, skiprows=skiprows, dtype=dtype)
+    df.columns = oe_bls_cex_tables_columns(df.columns)
+    return df
+
+
+def _removal(marks):
+    # One regular expression removing every mark, so each label is scanned once
+    return re.compile('|'.join(re.escape(m) for m in sorted(marks, key=len, reverse=True)))
+
+
+def oe_bls_cex_tables_clean_labels(labels, marks):
+    """
+    :param  labels:  a series of labels
+    :param  marks:   a list of strings to remove, [' a/ ', ':'] eg
+    :return the series with every mark removed.  Values that aren't strings are kept.
+    """
+    return labels.str.replace(_removal(marks), '', regex=True).where(labels.map(type) == str, labels)
+
+
+def oe_bls_cex_tables_clean_values(df, columns=None, marks=None, errors='coerce'):
+    """
+    Converts the value columns of a report to floats.  The columns are stacked
+    into one array, cleaned and parsed together, and split back into columns.
+
+    :param  df:       the report dataframe
+    :param  columns:  the value columns, by default all but the first
+    :param  marks:    the strings removed before parsing, oe_bls_cex_tables_value_marks by default
+    :param  errors:   'coerce' makes values that aren't numbers NaN, 'raise' fails on them
+
+    :return a copy of df with float value columns
+    """
+    columns = list(df.columns[1:]) if columns is None else list(columns)
+    marks = oe_bls_cex_tables_value_marks if marks is None else marks
+    block = pd.Series(df[columns].to_numpy(dtype=object).ravel(order='F'), dtype=object)
+    text = block.map(type) == str
+    block[text] = block[text].str.replace(_removal(marks), '', regex=True).str.strip()
+    values = pd.to_numeric(block, errors=errors).to_numpy(dtype=np.float64)
+    df = df.copy()
+    df[columns] = values.reshape(len(columns), len(df)).T
+    return df
+
+
+def oe_bls_cex_tables_means(df, label='Item', value=None, marker='Mean', totals=None):
+    """
+    Pairs each marker row with the label on the row above it, the layout of the
+    national report where each Item is followed by its "Mean", "Standard error"
+    etc rows.  Rows whose label contains one of totals carry their own value.
+    A label found more than once keeps its first position and its last value.
+
+    :param  df:      the report dataframe
+    :param  label:   the label column
+    :param  value:   the value column, by default the second column
+    :param  marker:  the label of the rows holding the values
+    :param  totals:  optionally, a list of labels that carry their own value
+
+    :return a dataframe of Item and Amount
+    """
+    value = df.columns[1] if value is None else value
+    labels = df[label]
+    item = labels.shift(1).where(labels == marker)
+    for total in ([] if totals is None else totals):
+        item = item.mask(labels.astype(str).str.contains(total, regex=False), total)
+    pairs = pd.DataFrame({"Item": item.to_numpy(), "Amount": df[value].to_numpy()})
+    pairs = pairs[pairs["Item"].notna()]
+    order = pairs["Item"].drop_duplicates(keep='first')
+    last = pairs.drop_duplicates("Item", keep='last').set_index("Item")["Amount"]
+    return pd.DataFrame({"Item": order.to_numpy(), "Amount": last.reindex(order).to_numpy()})
+
+
+def oe_bls_cex_tables_join(frames, on='Item'):
+    """
+    Joins report sheets side by side on their labels, like successive outer
+    merges but in a single concat.  A label repeated within a sheet is matched
+    by its occurrence, the 1st with the 1st and so on, instead of multiplying rows.
+
+    :param  frames:  a list of dataframes sharing the on column
+    :param  on:      the label column
+
+    :return a dataframe of on and every other column of the frames, sorted by on
+    """
+    indexed = []
+    for df in frames:
+        occurrence = df.groupby(on, sort=False, dropna=False).cumcount()
+        indexed.append(df.set_index([df[on].rename(on), occurrence.rename('_occurrence')]).drop(columns=on))
+    joined = pd.concat(indexed, axis=1, join='outer', sort=False)
+    joined = joined.sort_index(level=[0, 1], kind='stable', sort_remaining=False)
+    return joined.reset_index(level=1, drop=True).reset_index()
@@ -1,42 +1,47 @@
-import pandas as pd
-import numpy as np
+from oe_bls_cex_tables import oe_bls_cex_tables_clean_labels, oe_bls_cex_tables_clean_values, oe_bls_cex_tables_means
+from oe_bls_cex_reference import oe_bls_cex_reference_table
 
-def oe_bls_cex_totals(year):
+def oe_bls_cex_totals(year, refdir = './reference/', refresh = False):
     """
     This function downloads the CEX summary report for a given year,
     then interprets to return the mean values for each reported Item.
     The BLS spreadsheet includes footnote marks, appended text and
     number formatting so this function is a set of cleanup rules.
 
+    The report is downloaded once into refdir and read from there on later
+    calls, see oe_bls_cex_reference_table.
+
     :param  year:      a string of the requested year   "2018", eg
+    :param  refdir:    the folder keeping the downloaded reports
+    :param  refresh:   when True, the report is downloaded again
     :return usmeans:   a dataframe with the mean values for each Item
     
     """
 
-    ustotal = pd.read_excel(("https://www.bls.gov/cex/tables/calendar-year/mean/cu-all-detail-"+year+".xlsx"), 
-                            skiprows=2,dtype=object)
+    ustotal = oe_bls_cex_reference_table("https://www.bls.gov/cex/tables/calendar-year/mean/cu-all-detail-"+year+".xlsx",
+                                         refdir, refresh, dtype=object)
+    return oe_bls_cex_totals_parse(ustotal)
 
-    ustotal.columns = [c.replace('\n',' ').replace('- ','-') for c in ustotal.columns]
 
-    replacedict = {'a/ ': '','b/ ':'', ':': '','n.a.':'',
-                    ' []':'',' [D]':'',' [I]':'',
-                   '\$': '', ',': '','a/ ':'','b/ ':''}
+# Footnote marks, notes and formatting removed from the Items of the national report
+oe_bls_cex_totals_label_marks = ['a/ ', 'b/ ', ':', 'n.a.', ' []', ' [D]', ' [I]', '$', ',']
 
-    for r in replacedict.keys():
-        ustotal["Item"] = ustotal["Item"].str.replace(r,replacedict[r],regex=False)
 
-    usdict = {}
-    for i,r in ustotal.iterrows():
-        # The total row labels its own value
-        # but all other Items have a label followed by 3 addl rows for "Mean","Variance","%"
-        # Look for any rows with Item "Mean" and generate a row with the prev Item label
-        if "Number of consumer units (in thousands)" in str(r[0]):
-            usdict["Number of consumer units (in thousands)"] = r[1]
-        if r.Item == "Mean":
-            usdict[lastitem]=r[1]
-        lastitem = r.Item
+def oe_bls_cex_totals_parse(ustotal):
+    """
+    Interprets the national summary report.  The total row labels its own value
+    but all other Items have a label followed by rows for "Mean", "Standard error"
+    etc, so each "Mean" row is paired with the label above it.
 
-    ussum = pd.DataFrame.from_dict({"Item":usdict.keys(),"Amount":usdict.values()})
-    ussum["Amount"] = ussum.Amount.fillna(np.nan).apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    
-    return ussum
\ No newline at end of file
+    Unlike the original row-wise parser, amounts written as text are read after
+    removing "$", "," and "b/ " where it made them NaN, and "$" is removed from
+    the Items, where its rule removed only a literal "\\$".
+
+    :param  ustotal:   the report dataframe from oe_bls_cex_tables_read
+    :return usmeans:   a dataframe with the mean values for each Item
+    """
+    ustotal = ustotal.copy()
+    ustotal["Item"] = oe_bls_cex_tables_clean_labels(ustotal["Item"], oe_bls_cex_totals_label_marks)
+    ussum = oe_bls_cex_tables_means(ustotal, "Item", totals=["Number of consumer units (in thousands)"])
+    ussum["Amount"] = oe_bls_cex_tables_clean_values(ussum, ["Amount"])["Amount"]
+    return ussum
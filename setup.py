@@ -15,7 +15,7 @@ setup(
     author='Michael Bryan',
     author_email="<michael.bryan@openenvironments>",
     packages=find_packages(),
-    install_requires=['datetime','json','pandas','requests','sys'],  
+    install_requires=['datetime','json','pandas','requests','sys','scipy'],  
     license=LICENSE
 )
 
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# The modules sit at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from oe_bls_cex_synthetic import oe_bls_cex_synthetic_pumd
+
+
+@pytest.fixture(scope='session')
+def pumddir(tmp_path_factory):
+    """A small synthetic pumddir for 2018"""
+    return oe_bls_cex_synthetic_pumd(str(tmp_path_factory.mktemp('pumd')), ['2018'], rows=3000)
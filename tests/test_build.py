@@ -0,0 +1,43 @@
+import os
+import shutil
+import zipfile
+import oe_bls_cex_build
+from oe_bls_cex_build import oe_bls_cex_build_pumd
+from oe_bls_cex_pumd import oe_bls_cex_pumd_read_dictionary
+from oe_bls_cex_synthetic import oe_bls_cex_synthetic_pumd
+
+
+def _change_member(zippath, prefix):
+    # Rewrites the zip with the first member named prefix* changed: its last row repeated
+    with zipfile.ZipFile(zippath) as zf:
+        members = {m: zf.read(m) for m in zf.namelist()}
+    changed = sorted(m for m in members if m.split('/')[-1].startswith(prefix))[0]
+    members[changed] += members[changed].rstrip(b'\n').split(b'\n')[-1] + b'\n'
+    with zipfile.ZipFile(zippath, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for m, data in members.items():
+            zf.writestr(m, data)
+
+
+def test_member_change_rebuilds_year(pumddir, tmp_path):
+    pumd = str(tmp_path / 'pumd')
+    shutil.copytree(pumddir, pumd)
+    outdir = str(tmp_path / 'output')
+    assert oe_bls_cex_build_pumd(['2018'], pumd, outdir) == ['2018']
+    assert oe_bls_cex_build_pumd(['2018'], pumd, outdir) == []
+
+    _change_member(os.path.join(pumd, 'intrvw18.zip'), 'memi')
+    assert oe_bls_cex_build_pumd(['2018'], pumd, outdir) == ['2018']
+    _change_member(os.path.join(pumd, 'diary18.zip'), 'memd')
+    assert oe_bls_cex_build_pumd(['2018'], pumd, outdir) == ['2018']
+
+
+def test_dictionary_is_read_once_per_build(tmp_path, monkeypatch):
+    years = ['2018', '2019', '2020']
+    pumd = oe_bls_cex_synthetic_pumd(str(tmp_path / 'pumd'), years, rows=1000)
+    reads = []
+    def read_dictionary(*args):
+        reads.append(args)
+        return oe_bls_cex_pumd_read_dictionary(*args)
+    monkeypatch.setattr(oe_bls_cex_build, 'oe_bls_cex_pumd_read_dictionary', read_dictionary)
+    assert oe_bls_cex_build_pumd(years, pumd, str(tmp_path / 'output')) == years
+    assert len(reads) == 1
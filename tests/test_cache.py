@@ -0,0 +1,46 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from oe_bls_cex_cache import oe_bls_cex_cache_frame, oe_bls_cex_cache_object
+
+
+def _counted(value):
+    calls = []
+    def build():
+        calls.append(1)
+        return value
+    return build, calls
+
+
+def test_entries_are_rebuilt_when_a_source_changes(tmp_path):
+    source = tmp_path / 'source.csv'
+    source.write_text('a\n1\n')
+    cachedir = str(tmp_path / 'cache')
+    frame, framecalls = _counted(pd.DataFrame({"a": [1, 2]}))
+    obj, objcalls = _counted({"a": [1, 2]})
+
+    for _ in range(2):
+        pd.testing.assert_frame_equal(oe_bls_cex_cache_frame('f', [str(source)], frame, cachedir), frame())
+        assert oe_bls_cex_cache_object('o', [str(source)], obj, cachedir) == obj()
+    assert (len(framecalls), len(objcalls)) == (3, 3)
+
+    source.write_text('a\n1\n2\n')
+    oe_bls_cex_cache_frame('f', [str(source)], frame, cachedir)
+    oe_bls_cex_cache_object('o', [str(source)], obj, cachedir)
+    assert (len(framecalls), len(objcalls)) == (4, 4)
+    assert sorted(os.listdir(cachedir)) == ['f.json', 'f.parquet', 'o.json', 'o.pkl']
+
+
+def _build_shared(source, cachedir):
+    frame = pd.DataFrame({"a": range(200000)})
+    return len(oe_bls_cex_cache_frame('shared', [source], lambda: frame, cachedir))
+
+
+def test_processes_share_a_cold_cache(tmp_path):
+    source = tmp_path / 'source.csv'
+    source.write_text('a\n1\n')
+    cachedir = str(tmp_path / 'cache')
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(_build_shared, str(source), cachedir) for _ in range(8)]
+        assert [f.result() for f in futures] == [200000] * 8
+    assert sorted(os.listdir(cachedir)) == ['shared.json', 'shared.parquet']
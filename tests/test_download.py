@@ -0,0 +1,59 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from oe_bls_cex_download import oe_bls_cex_download_file
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    # Serves CONTENT at any path, honouring "Range: bytes=<start>-", and records the requests
+    requests = []
+
+    def do_GET(self):
+        header = self.headers.get('Range')
+        self.requests.append((self.path, header))
+        start = int(header.split('=')[1].rstrip('-')) if header else 0
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.end_headers()
+            return
+        body = CONTENT[start:]
+        self.send_response(206 if header else 200)
+        if header:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(CONTENT) - 1, len(CONTENT)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    _RangeHandler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1], _RangeHandler.requests
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_partial_download_is_resumed_then_skipped(server, tmp_path):
+    base, requests = server
+    destdir = str(tmp_path)
+    with open(os.path.join(destdir, 'intrvw18.zip.part'), 'wb') as f:
+        f.write(CONTENT[:300000])
+
+    path = oe_bls_cex_download_file(base + '/pumd/data/comma/intrvw18.zip', destdir)
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+    assert requests == [('/pumd/data/comma/intrvw18.zip', 'bytes=300000-')]
+    assert not os.path.exists(path + '.part')
+
+    # A complete file matching its manifest entry is not requested again
+    assert oe_bls_cex_download_file(base + '/pumd/data/comma/intrvw18.zip', destdir, verify=True) == path
+    assert len(requests) == 1
@@ -0,0 +1,23 @@
+import numpy as np
+from oe_bls_cex_metrics import PipelineMetrics
+
+
+def _run(metrics):
+    with metrics.stage('large'):
+        np.ones(50 * (1 << 20) // 8).sum()
+    with metrics.stage('small'):
+        np.ones(1000).sum()
+    return metrics.to_frame().set_index('stage')
+
+
+def test_peak_is_measured_per_stage():
+    df = _run(PipelineMetrics(trace_memory=True))
+    assert df.loc['large', 'peak_mb'] >= 50
+    assert df.loc['small', 'peak_mb'] < 5
+
+
+def test_process_peak_is_reported_apart():
+    df = _run(PipelineMetrics())
+    assert df['peak_mb'].isna().all()
+    assert (df['maxrss_mb'] > 0).all()
+    assert df.loc['small', 'maxrss_mb'] >= df.loc['large', 'maxrss_mb']
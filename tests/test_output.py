@@ -0,0 +1,39 @@
+import os
+import pandas as pd
+import pytest
+from oe_bls_cex_output import oe_bls_cex_output_write, oe_bls_cex_output_read
+
+
+def _frame(value):
+    return pd.DataFrame({"source": ["fmli", "fmld"], "COST": [value, value]})
+
+
+def _read(outdir):
+    return sorted(oe_bls_cex_output_read('costs', str(outdir), ['2018'])["COST"])
+
+
+def test_failed_swap_keeps_the_previous_year(tmp_path, monkeypatch):
+    oe_bls_cex_output_write(_frame(1.0), '2018', str(tmp_path), 'costs', partition_cols=['source'])
+    replace = os.replace
+    def failing_replace(src, dst):
+        if os.path.basename(src).startswith('_tmp-year='):
+            raise OSError('disk full')
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', failing_replace)
+    with pytest.raises(OSError):
+        oe_bls_cex_output_write(_frame(2.0), '2018', str(tmp_path), 'costs', partition_cols=['source'])
+    assert _read(tmp_path) == [1.0, 1.0]
+
+
+def test_interrupted_swap_is_restored_by_the_next_write(tmp_path):
+    oe_bls_cex_output_write(_frame(1.0), '2018', str(tmp_path), 'costs', partition_cols=['source'])
+    # A process that died between the renames leaves the year aside
+    os.replace(tmp_path / 'costs' / 'year=2018', tmp_path / 'costs' / '_old-year=2018')
+    # Even a write that fails puts it back
+    with pytest.raises(ValueError):
+        oe_bls_cex_output_write(_frame(2.0).assign(year='2019'), '2018', str(tmp_path), 'costs',
+                                partition_cols=['source'])
+    assert _read(tmp_path) == [1.0, 1.0]
+    oe_bls_cex_output_write(_frame(2.0), '2018', str(tmp_path), 'costs', partition_cols=['source'])
+    assert _read(tmp_path) == [2.0, 2.0]
+    assert sorted(os.listdir(tmp_path / 'costs')) == ['year=2018']
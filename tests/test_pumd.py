@@ -0,0 +1,118 @@
+import pandas as pd
+import oe_bls_cex_pumd
+from oe_bls_cex_keys import KeyEncoder
+from oe_bls_cex_pumd import (oe_bls_cex_pumd_read_dictionary, oe_bls_cex_pumd_dtypes,
+                             oe_bls_cex_pumd_read_filetype, oe_bls_cex_pumd_iter_csv, oe_bls_cex_pumd_open_files,
+                             oe_bls_cex_pumd_interpret_meta, oe_bls_cex_pumd_interpret_data,
+                             oe_bls_cex_pumd_process_years, oe_bls_cex_pumd_interpret_stream)
+from oe_bls_cex_synthetic import oe_bls_cex_synthetic_pumd
+
+
+def _fmli_dtypes(pumddir):
+    vardict, codedict = oe_bls_cex_pumd_read_dictionary(pumddir)
+    dtypes = oe_bls_cex_pumd_dtypes(vardict, codedict, 'fmli')
+    # PSU is a dictionary variable without codes, so it is typed numeric
+    assert dtypes["PSU"] == 'float64'
+    return dtypes
+
+
+def test_typed_read_keeps_text_column(pumddir):
+    typed = oe_bls_cex_pumd_read_filetype('2018', 'fmli', pumddir, dtypes=_fmli_dtypes(pumddir))
+    untyped = oe_bls_cex_pumd_read_filetype('2018', 'fmli', pumddir)
+    assert typed["PSU"].notna().any()
+    pd.testing.assert_series_equal(typed["PSU"].astype(object), untyped["PSU"].astype(object), check_dtype=False)
+    assert pd.api.types.is_numeric_dtype(typed["AGE_REF"])
+
+
+def test_typed_read_keeps_text_past_the_checked_rows(pumddir, monkeypatch):
+    # With no rows checked up front, the text is found when the numeric parse fails
+    monkeypatch.setattr(oe_bls_cex_pumd, "oe_bls_cex_pumd_sniffrows", 0)
+    typed = oe_bls_cex_pumd_read_filetype('2018', 'fmli', pumddir, dtypes=_fmli_dtypes(pumddir))
+    untyped = oe_bls_cex_pumd_read_filetype('2018', 'fmli', pumddir)
+    pd.testing.assert_series_equal(typed["PSU"].astype(object), untyped["PSU"].astype(object), check_dtype=False)
+
+
+def test_streamed_read_keeps_text_column(pumddir):
+    chunks = list(oe_bls_cex_pumd_iter_csv('2018', 'fmli', pumddir, _fmli_dtypes(pumddir), chunksize=10))
+    psu = pd.concat(chunks)["PSU"]
+    assert psu.notna().any() and not pd.api.types.is_numeric_dtype(psu)
+
+
+def test_interpret_data_returns_costs_when_asked(pumddir):
+    pumd, hg, vardict, codedict = oe_bls_cex_pumd_open_files(['2018'], pumddir)
+    hg, sumrules, vardict, codedict = oe_bls_cex_pumd_interpret_meta(hg, vardict, codedict, '2018')
+    pubfile, family, expend, fmli, fmld, mtbi, expd = \
+        oe_bls_cex_pumd_interpret_data(pumd, vardict, '2018', sumrules)
+    *_, costs = oe_bls_cex_pumd_interpret_data(pumd, vardict, '2018', sumrules, summarize=True)
+    assert costs.index.equals(pd.Index(family["NEWID"], name="NEWID"))
+
+
+def test_interpret_data_codes_integer_newids_as_keys(pumddir):
+    # A plain read_csv gives int64 NEWIDs, which are keys to code, not codes
+    pumd, hg, vardict, codedict = oe_bls_cex_pumd_open_files(['2018'], pumddir)
+    hg, sumrules, vardict, codedict = oe_bls_cex_pumd_interpret_meta(hg, vardict, codedict, '2018')
+    ints = {'2018': {ftype: df.assign(NEWID=df["NEWID"].astype('int64')) if "NEWID" in df.columns else df
+                     for ftype, df in pumd['2018'].items()}}
+    expected = oe_bls_cex_pumd_interpret_data(pumd, vardict, '2018', sumrules, summarize=True)
+    for keys in ({name: KeyEncoder(name) for name in ('UCC', 'NEWID')}, None):
+        result = oe_bls_cex_pumd_interpret_data(ints, vardict, '2018', sumrules, keys=keys, summarize=True)
+        pd.testing.assert_frame_equal(result[1], expected[1])
+        pd.testing.assert_frame_equal(result[-1], expected[-1])
+
+
+def test_workers_share_a_cold_cache(tmp_path):
+    years = ['2018', '2019', '2020']
+    pumd = oe_bls_cex_synthetic_pumd(str(tmp_path / 'pumd'), years, rows=1000)
+    parallel = oe_bls_cex_pumd_process_years(years, pumd, str(tmp_path / 'cache'), workers=3)
+    serial = oe_bls_cex_pumd_process_years(years, pumd, workers=1)
+    for yr in years:
+        pd.testing.assert_frame_equal(parallel[yr][1], serial[yr][1])
+        pd.testing.assert_frame_equal(parallel[yr][2], serial[yr][2])
+
+
+def test_streamed_costs_match_interpret_data(pumddir):
+    pumd, hg, vardict, codedict = oe_bls_cex_pumd_open_files(['2018'], pumddir)
+    hg, sumrules, vardict, codedict = oe_bls_cex_pumd_interpret_meta(hg, vardict, codedict, '2018')
+    result = oe_bls_cex_pumd_interpret_data(pumd, vardict, '2018', sumrules, summarize=True)
+    lazy, *_ = oe_bls_cex_pumd_open_files(['2018'], pumddir, lazy=True)
+    family, costs, rcost = oe_bls_cex_pumd_interpret_stream(lazy, vardict, '2018', sumrules, chunksize=500)
+    pd.testing.assert_frame_equal(family, result[1])
+    pd.testing.assert_frame_equal(costs, result[-1])
+
+
+def _rollup_by_level(expend, sumrules, newids):
+    # The original plan for the roll-up: pivot the costs to a column per UCC, then
+    # march up the HG from the deepest level, summing each rule's children
+    expend = expend.assign(COST=pd.to_numeric(expend["COST"], errors='coerce').fillna(0))
+    costs = expend.pivot_table(index='NEWID', columns='UCC', values='COST', aggfunc='sum', fill_value=0.0)
+    costs = costs.reindex(pd.Index(newids, name="NEWID"), fill_value=0.0)
+    for level in sorted(sumrules["level"].unique(), reverse=True):
+        for name, children in sumrules.loc[sumrules["level"] == level, ["name", "rule"]].itertuples(index=False):
+            costs[name] = costs.reindex(columns=children, fill_value=0.0).sum(axis=1)
+    return costs
+
+
+def test_sparse_rollup_matches_the_level_by_level_sums(pumddir):
+    pumd, hg, vardict, codedict = oe_bls_cex_pumd_open_files(['2018'], pumddir)
+    hg, sumrules, vardict, codedict = oe_bls_cex_pumd_interpret_meta(hg, vardict, codedict, '2018')
+    pubfile, family, expend, *_, costs = oe_bls_cex_pumd_interpret_data(pumd, vardict, '2018', sumrules,
+                                                                        summarize=True)
+    expected = _rollup_by_level(expend, sumrules, family["NEWID"])
+    assert sumrules["level"].nunique() > 1
+    pd.testing.assert_frame_equal(costs[expected.columns], expected, check_names=False, check_dtype=False,
+                                  check_column_type=False)
+
+
+def test_member_files_are_read_only_when_asked(pumddir, monkeypatch):
+    pumd, hg, vardict, codedict = oe_bls_cex_pumd_open_files(['2018'], pumddir)
+    hg, sumrules, vardict, codedict = oe_bls_cex_pumd_interpret_meta(hg, vardict, codedict, '2018')
+    reads = []
+    read = oe_bls_cex_pumd.PumdStore.read
+    monkeypatch.setattr(oe_bls_cex_pumd.PumdStore, 'read',
+                        lambda self, year, ftype: reads.append(ftype) or read(self, year, ftype))
+    for members in (False, True):
+        reads.clear()
+        lazy, *_ = oe_bls_cex_pumd_open_files(['2018'], pumddir, lazy=True)
+        family = oe_bls_cex_pumd_interpret_data(lazy, vardict, '2018', sumrules, members=members)[1]
+        assert {'memi', 'memd'}.issubset(reads) == members
+        assert ("MEM_COUNT" in family.columns) == members
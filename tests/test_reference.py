@@ -0,0 +1,38 @@
+import os
+import pytest
+import oe_bls_cex_reference
+from oe_bls_cex_reference import oe_bls_cex_reference_fetch
+
+URL = 'https://www.bls.gov/cex/tables/report.xlsx'
+
+
+def _download(content):
+    def download(url, destdir):
+        path = os.path.join(destdir, url.split('/')[-1])
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+    return download
+
+
+def _failing_download(url, destdir):
+    with open(os.path.join(destdir, url.split('/')[-1] + '.part'), 'w') as f:
+        f.write('partial')
+    raise IOError('Incomplete download of ' + url)
+
+
+def test_failed_refresh_keeps_the_local_copy(tmp_path, monkeypatch):
+    refdir = str(tmp_path)
+    monkeypatch.setattr(oe_bls_cex_reference, 'oe_bls_cex_download_file', _download('old'))
+    path = oe_bls_cex_reference_fetch(URL, refdir)
+
+    monkeypatch.setattr(oe_bls_cex_reference, 'oe_bls_cex_download_file', _failing_download)
+    with pytest.raises(IOError):
+        oe_bls_cex_reference_fetch(URL, refdir, refresh=True)
+    assert open(path).read() == 'old'
+    assert os.listdir(refdir) == ['report.xlsx']
+
+    monkeypatch.setattr(oe_bls_cex_reference, 'oe_bls_cex_download_file', _download('new'))
+    assert oe_bls_cex_reference_fetch(URL, refdir, refresh=True) == path
+    assert open(path).read() == 'new'
+    assert os.listdir(refdir) == ['report.xlsx']